@@ -0,0 +1,73 @@
+"""Measures how endpoint selection scales with the number of threads selecting endpoints at the same time. Prints the results as JSON.
+
+    python -m benchmarks.contention
+    python -m benchmarks.contention --threads 1,16 --operations 20000
+"""
+import argparse
+import json
+import os
+import platform
+import tempfile
+from datetime import timedelta
+from openai_load_balancer import LoadBalancer, MmapHealthState
+from benchmarks.run import API_KEY_ENV, run_threads, summarize
+
+
+def make_load_balancer(scenario, endpoint_count, state_dir):
+    configs = [{"api_type": "open_ai", "base_url": f"https://endpoint-{i}",
+                "api_key_env": API_KEY_ENV} for i in range(endpoint_count)]
+    if scenario in ("rate_limited", "shared_rate_limited"):
+        # Limits that are high enough to never run out, so that the cost of checking them is measured
+        for config in configs:
+            config.update(requests_per_minute=10 ** 9,
+                          tokens_per_minute=10 ** 12)
+    # The shared scenarios keep the endpoints' state in a memory-mapped file, as it would be shared between worker processes
+    health_state = MmapHealthState(os.path.join(state_dir, scenario)) if scenario.startswith(
+        "shared") else None
+    load_balancer = LoadBalancer(
+        configs, failure_threshold=1, cooldown_period=timedelta(minutes=10), health_state=health_state)
+    if scenario == "cooldown":
+        load_balancer.record_failure(
+            load_balancer.api_endpoints[0], Exception("Failed request"))
+    return load_balancer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", default="1,2,4,8,16,64,256")
+    parser.add_argument("--operations", type=int, default=200000,
+                        help="Total number of selections per run, split between the threads")
+    parser.add_argument("--endpoints", type=int, default=8)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    thread_counts = [int(count) for count in args.threads.split(",")]
+
+    results = {"python": platform.python_version(),
+               "endpoints": args.endpoints, "scenarios": {}}
+    for scenario in ("healthy", "cooldown", "rate_limited", "shared", "shared_rate_limited"):
+        scenario_results = {}
+        for thread_count in thread_counts:
+            with tempfile.TemporaryDirectory() as state_dir:
+                load_balancer = make_load_balancer(
+                    scenario, args.endpoints, state_dir)
+                latencies, errors, duration = run_threads(
+                    thread_count, max(args.operations // thread_count, 1), load_balancer.get_next_active_endpoint)
+            scenario_results[thread_count] = summarize(
+                latencies, errors, duration)
+        single_thread_throughput = scenario_results[thread_counts[0]]["throughput"]
+        for result in scenario_results.values():
+            # How much of the throughput of the first thread count is kept with more threads. Python threads share one interpreter lock, so 1.0 means selection doesn't get slower under contention.
+            result["relative_throughput"] = result["throughput"] / \
+                single_thread_throughput if single_thread_throughput else None
+        results["scenarios"][scenario] = scenario_results
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
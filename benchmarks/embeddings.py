@@ -0,0 +1,78 @@
+"""Compares the latency and memory of embedding responses as lists of Python floats, converted from lists to a NumPy matrix, and with return_format="numpy", against a local fake server. Prints the results as JSON.
+
+    python -m benchmarks.embeddings
+    python -m benchmarks.embeddings --requests 50 --inputs 256 --dimensions 3072
+"""
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+import numpy as np
+from benchmarks.fake_server import FakeServerThread
+from benchmarks.run import make_load_balancer, percentile
+
+# How the embeddings end up in memory in each mode
+MODES = {
+    "list": lambda embedding, **kwargs: embedding.create(**kwargs),
+    "list_to_numpy": lambda embedding, **kwargs: np.array([item["embedding"] for item in embedding.create(**kwargs)["data"]], dtype=np.float32),
+    "numpy": lambda embedding, **kwargs: embedding.create(return_format="numpy", **kwargs),
+}
+
+
+def benchmark_mode(embedding, mode, request_count, input_count):
+    """Returns the latency percentiles of request_count requests with input_count inputs each, and the memory the responses of the requests take, measured separately so that tracing allocations doesn't slow down the timed requests"""
+    create = MODES[mode]
+    kwargs = {"model": "text-embedding-ada-002",
+              "input": [f"Input {i}" for i in range(input_count)]}
+    create(embedding, **kwargs)
+
+    latencies = []
+    for _ in range(request_count):
+        start_time = time.perf_counter()
+        create(embedding, **kwargs)
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    responses = [create(embedding, **kwargs) for _ in range(request_count)]
+    memory = tracemalloc.get_traced_memory()[0] - start_memory
+    tracemalloc.stop()
+    del responses
+    return {
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p99": percentile(latencies, 0.99),
+        "bytes_per_embedding": memory / (request_count * input_count),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--inputs", type=int, default=128,
+                        help="Inputs per request")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = {"python": platform.python_version(), "numpy": np.__version__, "requests": args.requests,
+               "inputs": args.inputs, "dimensions": args.dimensions, "float32_bytes_per_embedding": 4 * args.dimensions, "modes": {}}
+    with FakeServerThread() as server_thread:
+        server = server_thread.start_server(
+            embedding_dimensions=args.dimensions)
+        openai_load_balancer = make_load_balancer([server])
+        for mode in MODES:
+            results["modes"][mode] = benchmark_mode(
+                openai_load_balancer.Embedding, mode, args.requests, args.inputs)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
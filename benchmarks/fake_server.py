@@ -0,0 +1,160 @@
+import array
+import asyncio
+import base64
+import random
+import threading
+from aiohttp import web
+
+
+def constant(seconds):
+    """Returns a latency distribution that always takes the passed in number of seconds"""
+    return lambda rng: seconds
+
+
+def uniform(low, high):
+    return lambda rng: rng.uniform(low, high)
+
+
+def lognormal(median, sigma=0.5):
+    """Returns a long tailed latency distribution, which is closer to what the OpenAI API does than a constant latency"""
+    return lambda rng: rng.lognormvariate(0, sigma) * median
+
+
+class FakeServer:
+    """A local stand-in for the OpenAI and Azure OpenAI chat completion, completion and embedding routes, which answers after a latency drawn from the passed in distribution. A fraction of the requests can be answered with a 429 (rate_limit_rate), a 500 (error_rate) or hang for hang_time seconds (hang_rate). If max_concurrency is set, at most that many requests are processed at once and the rest wait their turn, like a deployment at its capacity. Embeddings have embedding_dimensions values, as lists of floats or, if the request asks for encoding_format="base64", as base64 float32 strings. Setting dead makes every request fail with a 503, or hang if dead is "hang". Runs on the event loop of a FakeServerThread, so it can be used from any thread."""
+
+    def __init__(self, latency=constant(0.0), rate_limit_rate=0.0, error_rate=0.0, hang_rate=0.0, hang_time=60.0, seed=None, max_concurrency=None, embedding_dimensions=3):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_time = hang_time
+        self.dead = False
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.rng = random.Random(seed)
+        self.embedding_vector = [round(self.rng.uniform(-0.1, 0.1), 6)
+                          for _ in range(embedding_dimensions)]
+        self.base64_embedding = base64.b64encode(
+            array.array("f", self.embedding_vector).tobytes()).decode("ascii")
+        self.request_count = 0
+        self.status_counts = {}
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        if self.max_concurrency is not None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        app = web.Application()
+        for prefix in ("/v1", "/openai/deployments/{engine}"):
+            app.router.add_post(f"{prefix}/chat/completions",
+                                self.chat_completion)
+            app.router.add_post(f"{prefix}/completions", self.completion)
+            app.router.add_post(f"{prefix}/embeddings", self.embedding)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, backlog=1024)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def count(self, status):
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    async def _handle(self, request):
+        """Returns the request body, or the error response to answer with"""
+        body = await request.json()
+        self.request_count += 1
+        if self.dead:
+            if self.dead == "hang":
+                await asyncio.sleep(self.hang_time)
+            self.count(503)
+            return body, web.json_response({"error": {"message": "The server is unavailable.", "type": "server_error"}}, status=503)
+        draw = self.rng.random()
+        if draw < self.hang_rate:
+            await asyncio.sleep(self.hang_time)
+        if self.semaphore is not None:
+            async with self.semaphore:
+                await asyncio.sleep(self.latency(self.rng))
+        else:
+            await asyncio.sleep(self.latency(self.rng))
+        if draw < self.hang_rate + self.rate_limit_rate:
+            self.count(429)
+            return body, web.json_response({"error": {"message": "Rate limit reached.", "type": "requests"}}, status=429, headers={"Retry-After": "1"})
+        if draw < self.hang_rate + self.rate_limit_rate + self.error_rate:
+            self.count(500)
+            return body, web.json_response({"error": {"message": "The server had an error.", "type": "server_error"}}, status=500)
+        self.count(200)
+        return body, None
+
+    async def chat_completion(self, request):
+        body, error_response = await self._handle(request)
+        if error_response is not None:
+            return error_response
+        return web.json_response({
+            "id": f"chatcmpl-{self.request_count}",
+            "object": "chat.completion",
+            "model": body.get("model", request.match_info.get("engine")),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hello!"}}],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7},
+        })
+
+    async def completion(self, request):
+        body, error_response = await self._handle(request)
+        if error_response is not None:
+            return error_response
+        return web.json_response({
+            "id": f"cmpl-{self.request_count}",
+            "object": "text_completion",
+            "model": body.get("model", request.match_info.get("engine")),
+            "choices": [{"index": 0, "finish_reason": "stop", "text": "Hello!"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+        })
+
+    async def embedding(self, request):
+        body, error_response = await self._handle(request)
+        if error_response is not None:
+            return error_response
+        inputs = body["input"] if isinstance(
+            body["input"], list) else [body["input"]]
+        embedding = self.base64_embedding if body.get(
+            "encoding_format") == "base64" else self.embedding_vector
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model", request.match_info.get("engine")),
+            "data": [{"object": "embedding", "index": i, "embedding": embedding} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        })
+
+
+class FakeServerThread:
+    """Runs fake servers on an event loop in a background thread, so that they keep answering while the benchmark blocks the main thread"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="fake-openai-server", daemon=True)
+        self.servers = []
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in self.servers:
+            self.run(server.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def start_server(self, **kwargs):
+        server = self.run(FakeServer(**kwargs).start())
+        self.servers.append(server)
+        return server
@@ -0,0 +1,350 @@
+"""Measures the load balancer's own overhead, its throughput and latency under load, how long it takes to fail over when an endpoint dies, and how a scheduler keeps interactive requests fast under batch load, against local fake servers. Prints the results as JSON, so that runs can be compared to catch regressions.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --quick --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from openai_load_balancer import initialize_load_balancer, LoadBalancer, RetryPolicy, RequestScheduler
+from benchmarks.fake_server import FakeServerThread, lognormal
+
+API_KEY_ENV = "BENCHMARK_API_KEY"
+MESSAGES = [{"role": "user", "content": "Hello! This is a benchmark."}]
+
+
+class ContentionLock:
+    """A drop-in replacement for threading.Lock that counts how often and how long threads waited to acquire it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended_acquisitions = 0
+        self.wait_time = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(blocking=False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start_time = time.perf_counter()
+        acquired = self.lock.acquire(timeout=timeout)
+        if acquired:
+            # The counters are only updated while holding the lock
+            self.acquisitions += 1
+            self.contended_acquisitions += 1
+            self.wait_time += time.perf_counter() - start_time
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def stats(self):
+        return {
+            "acquisitions": self.acquisitions,
+            "contended_acquisitions": self.contended_acquisitions,
+            "contention_rate": self.contended_acquisitions / self.acquisitions if self.acquisitions else 0.0,
+            "wait_seconds": self.wait_time,
+        }
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "duration_seconds": duration,
+        "throughput": len(latencies) / duration if duration else 0.0,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if latencies else None,
+    }
+
+
+def endpoint_configs(servers):
+    """Alternates OpenAI and Azure endpoints, so both code paths are measured"""
+    os.environ.setdefault(API_KEY_ENV, "sk-benchmark")
+    configs = []
+    for i, server in enumerate(servers):
+        if i % 2 == 0:
+            configs.append({"api_type": "open_ai", "base_url": f"{server.url}/v1",
+                            "api_key_env": API_KEY_ENV, "name": f"openai-{i}"})
+        else:
+            os.environ[f"BENCHMARK_AZURE_BASE_URL_{i}"] = server.url
+            configs.append({"api_type": "azure", "base_url": f"BENCHMARK_AZURE_BASE_URL_{i}",
+                            "api_key_env": API_KEY_ENV, "version": "2023-05-15", "name": f"azure-{i}"})
+    return configs
+
+
+def make_load_balancer(servers, strategy=None, failure_threshold=5, cooldown_period=timedelta(minutes=10), scheduler=None):
+    openai_load_balancer = initialize_load_balancer(
+        endpoint_configs(servers), failure_threshold=failure_threshold, cooldown_period=cooldown_period, strategy=strategy,
+        retry_policy=RetryPolicy(min_backoff=0.05, max_backoff=0.5), scheduler=scheduler)
+    openai_load_balancer.load_balancer.lock = ContentionLock()
+    return openai_load_balancer
+
+
+def run_threads(thread_count, requests_per_thread, send):
+    """Calls send from thread_count threads, requests_per_thread times each, and returns the latencies, the number of errors and the duration"""
+    latencies = []
+    errors = [0]
+    results_lock = threading.Lock()
+    start_barrier = threading.Barrier(thread_count)
+
+    def worker():
+        thread_latencies = []
+        thread_errors = 0
+        start_barrier.wait()
+        for _ in range(requests_per_thread):
+            start_time = time.perf_counter()
+            try:
+                send()
+            except Exception:
+                thread_errors += 1
+                continue
+            thread_latencies.append(time.perf_counter() - start_time)
+        with results_lock:
+            latencies.extend(thread_latencies)
+            errors[0] += thread_errors
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        for future in [executor.submit(worker) for _ in range(thread_count)]:
+            future.result()
+    return latencies, errors[0], time.perf_counter() - start_time
+
+
+def benchmark_selection_overhead(thread_counts, operations_per_thread, endpoint_count=4):
+    """Measures get_next_active_endpoint and try_send_request without any network, so the results are the load balancer's own overhead"""
+    configs = [{"api_type": "open_ai", "base_url": f"https://endpoint-{i}",
+                "api_key_env": API_KEY_ENV} for i in range(endpoint_count)]
+    response = {"object": "chat.completion", "choices": [],
+                "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7}}
+    results = {}
+    for thread_count in thread_counts:
+        load_balancer = LoadBalancer(
+            configs, failure_threshold=5, cooldown_period=timedelta(minutes=10))
+        load_balancer.lock = ContentionLock()
+        latencies, errors, duration = run_threads(
+            thread_count, operations_per_thread, load_balancer.get_next_active_endpoint)
+        selection = summarize(latencies, errors, duration)
+        selection["lock"] = load_balancer.lock.stats()
+
+        load_balancer.send_request = lambda endpoint, method_name, **kwargs: response
+        latencies, errors, duration = run_threads(
+            thread_count, operations_per_thread, lambda: load_balancer.try_send_request('chat_completion_create', model="gpt-3.5-turbo", messages=MESSAGES))
+        results[thread_count] = {
+            "get_next_active_endpoint": selection,
+            "try_send_request": summarize(latencies, errors, duration),
+        }
+    return results
+
+
+def benchmark_threaded_throughput(server_thread, thread_counts, requests_per_thread, latency, strategy=None):
+    results = {}
+    for thread_count in thread_counts:
+        servers = [server_thread.start_server(
+            latency=lognormal(latency), seed=i) for i in range(4)]
+        openai_load_balancer = make_load_balancer(servers, strategy)
+        latencies, errors, duration = run_threads(thread_count, requests_per_thread, lambda: openai_load_balancer.ChatCompletion.create(
+            model="gpt-3.5-turbo", messages=MESSAGES))
+        results[thread_count] = summarize(latencies, errors, duration)
+        results[thread_count]["lock"] = openai_load_balancer.load_balancer.lock.stats()
+    return results
+
+
+def benchmark_async_throughput(server_thread, concurrencies, requests_per_task, latency, strategy=None):
+    async def run(concurrency):
+        servers = [server_thread.start_server(
+            latency=lognormal(latency), seed=i) for i in range(4)]
+        openai_load_balancer = make_load_balancer(servers, strategy)
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for _ in range(requests_per_task):
+                start_time = time.perf_counter()
+                try:
+                    await openai_load_balancer.ChatCompletion.acreate(model="gpt-3.5-turbo", messages=MESSAGES)
+                except Exception:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        duration = time.perf_counter() - start_time
+        await openai_load_balancer.load_balancer.aclose()
+        result = summarize(latencies, errors, duration)
+        result["lock"] = openai_load_balancer.load_balancer.lock.stats()
+        return result
+
+    return {concurrency: asyncio.run(run(concurrency)) for concurrency in concurrencies}
+
+
+def benchmark_failover(server_thread, mode, thread_count, latency, duration=3.0, request_timeout=1.0):
+    """Kills one of three endpoints in the middle of a steady load, and measures how long it takes until the load balancer stops sending requests to it, and how the requests in flight at that time were affected. mode is "error" for an endpoint that answers with 503s, or "hang" for one that stops answering."""
+    servers = [server_thread.start_server(
+        latency=lognormal(latency), hang_time=5, seed=i) for i in range(3)]
+    openai_load_balancer = make_load_balancer(servers, failure_threshold=3)
+    load_balancer = openai_load_balancer.load_balancer
+    dead_endpoint = load_balancer.api_endpoints[0]
+    stop = threading.Event()
+    samples = []
+    samples_lock = threading.Lock()
+
+    def worker():
+        while not stop.is_set():
+            start_time = time.perf_counter()
+            try:
+                openai_load_balancer.ChatCompletion.create(
+                    model="gpt-3.5-turbo", messages=MESSAGES, request_timeout=request_timeout)
+                failed = False
+            except Exception:
+                failed = True
+            with samples_lock:
+                samples.append(
+                    (start_time, time.perf_counter() - start_time, failed))
+
+    threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration / 3)
+    kill_time = time.perf_counter()
+    servers[0].dead = "hang" if mode == "hang" else True
+    # The endpoint has failed over once it is in cooldown, and no new requests are sent to it
+    inactive_time = None
+    while time.perf_counter() - kill_time < duration:
+        if inactive_time is None and not dead_endpoint.is_active(load_balancer.failure_threshold, load_balancer.cooldown_period):
+            inactive_time = time.perf_counter()
+        time.sleep(0.001)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    servers[0].dead = False
+
+    before = [latency for start_time, latency,
+              failed in samples if start_time < kill_time and not failed]
+    after = [latency for start_time, latency,
+             failed in samples if start_time >= kill_time and not failed]
+    return {
+        "mode": mode,
+        "threads": thread_count,
+        "time_to_fail_over": inactive_time - kill_time if inactive_time is not None else None,
+        "errors_after_kill": sum(1 for start_time, _, failed in samples if start_time >= kill_time and failed),
+        "before_kill": summarize(before, 0, kill_time - samples[0][0] if samples else 0.0),
+        "after_kill": summarize(after, 0, duration),
+        "metrics": {name: endpoint["requests"] for name, endpoint in load_balancer.get_metrics()["endpoints"].items()},
+    }
+
+
+def benchmark_priority_scheduling(server_thread, latency, duration=3.0, batch_threads=32, interactive_threads=4, server_concurrency=8):
+    """Runs interactive requests next to a flood of batch requests against two endpoints that can only process server_concurrency requests each at a time, once without a scheduler and once with a RequestScheduler that keeps the endpoints at their capacity and serves interactive requests first. Reports the latency of each priority class."""
+    results = {}
+    for mode in ("no_scheduler", "scheduler"):
+        servers = [server_thread.start_server(latency=lognormal(latency), max_concurrency=server_concurrency, seed=i)
+                   for i in range(2)]
+        scheduler = RequestScheduler(
+            max_concurrency=2 * server_concurrency, max_endpoint_concurrency=server_concurrency) if mode == "scheduler" else None
+        openai_load_balancer = make_load_balancer(
+            servers, scheduler=scheduler)
+        stop = threading.Event()
+        latencies = {"interactive": [], "batch": []}
+        errors = {"interactive": 0, "batch": 0}
+        results_lock = threading.Lock()
+
+        def worker(priority):
+            while not stop.is_set():
+                start_time = time.perf_counter()
+                try:
+                    openai_load_balancer.ChatCompletion.create(
+                        model="gpt-3.5-turbo", messages=MESSAGES, priority=priority)
+                except Exception:
+                    with results_lock:
+                        errors[priority] += 1
+                    continue
+                with results_lock:
+                    latencies[priority].append(
+                        time.perf_counter() - start_time)
+
+        threads = [threading.Thread(target=worker, args=("batch",)) for _ in range(batch_threads)] + \
+            [threading.Thread(target=worker, args=("interactive",))
+             for _ in range(interactive_threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        results[mode] = {priority: summarize(latencies[priority], errors[priority], duration)
+                         for priority in latencies}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", default="1,4,16,64,256",
+                        help="Comma separated thread counts, which are also used as asyncio concurrencies")
+    parser.add_argument("--requests-per-thread", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Median latency of the fake servers in seconds")
+    parser.add_argument("--strategy", default=None)
+    parser.add_argument("--quick", action="store_true",
+                        help="Run fewer threads and requests, e.g. for a smoke test")
+    parser.add_argument("--output", default=None,
+                        help="Write the results to this file instead of stdout")
+    args = parser.parse_args()
+    thread_counts = [int(count) for count in args.threads.split(",")]
+    requests_per_thread = args.requests_per_thread
+    if args.quick:
+        thread_counts = [count for count in thread_counts if count <= 16]
+        requests_per_thread = min(requests_per_thread, 5)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "strategy": args.strategy or "round_robin",
+        "selection_overhead": benchmark_selection_overhead(thread_counts, 2000 if args.quick else 20000),
+    }
+    with FakeServerThread() as server_thread:
+        results["threaded"] = benchmark_threaded_throughput(
+            server_thread, thread_counts, requests_per_thread, args.latency, args.strategy)
+        results["asyncio"] = benchmark_async_throughput(
+            server_thread, thread_counts, requests_per_thread, args.latency, args.strategy)
+        results["failover"] = [benchmark_failover(server_thread, mode, 16, args.latency, duration=1.5 if args.quick else 3.0)
+                               for mode in ("error", "hang")]
+        results["priority_scheduling"] = benchmark_priority_scheduling(
+            server_thread, args.latency, duration=1.5 if args.quick else 3.0)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,17 @@
 from .load_balancer import LoadBalancer
 from .openai_interface import OpenAILoadBalancer
+from .strategies import SelectionStrategy, AdaptiveWeightPolicy, AffinityStrategy
+from .hedging import HedgingPolicy
+from .batching import EmbeddingBatcher
+from .cache import ResponseCache
+from .retry_policy import RetryPolicy
+from .metrics import MetricsRegistry
+from .health_state import HealthStateBackend, EndpointState, MmapHealthState
+from .scheduler import RequestScheduler
+from .single_flight import SingleFlight
+from .circuit_breaker import CircuitBreaker
+from .bulk import run_bulk, arun_bulk, read_embeddings
+from .embedding_arrays import EmbeddingArray
 from datetime import timedelta
 
 DEFAULT_MODEL_ENGINE_MAPPING = {
@@ -9,18 +21,52 @@ DEFAULT_MODEL_ENGINE_MAPPING = {
 }
 
 
-def initialize_load_balancer(endpoints, model_engine_mapping=DEFAULT_MODEL_ENGINE_MAPPING, failure_threshold=5, cooldown_period=timedelta(minutes=10), load_balancing_enabled=True):
+def initialize_load_balancer(endpoints, model_engine_mapping=DEFAULT_MODEL_ENGINE_MAPPING, failure_threshold=5, cooldown_period=timedelta(minutes=10), load_balancing_enabled=True, strategy=None, rate_limit_queue_size=100, rate_limit_queue_timeout=60, hedging_policy=None, retry_policy=None, embedding_batching=False, response_cache=False, metrics=None, adaptive_weights=False, health_state=None, scheduler=None, single_flight=False, circuit_breaker=False):
     """Initializes the load balancer with the endpoint settings and other configs. 
-    @param endpoints: A list of dictionaries containing the OpenAI API endpoint configurations. 
+    @param endpoints: A list of dictionaries containing the OpenAI API endpoint configurations. An endpoint that only serves some models can list them in "models", or map each model to its Azure deployment name on that endpoint with a dict. "weight" sets the endpoint's share of the requests relative to the other endpoints (default 1), and "priority" puts it in a fallback tier: endpoints with a higher priority number are only used when no endpoint with a lower one is available (default 0).
     @param model_engine_mapping: A dictionary mapping the OpenAI model names to the Azure engine names.
     @param failure_threshold: The number of consecutive failures of a request to an endpoint before the endpoint is temporarily marked as inactive
     @param cooldown_period: The minimum amount of time an endpoint is marked as inactive before it is reset to active.
-    @param load_balancing_enabled: Whether or not to enable load balancing. If false, the first active endpoint will always be used, and other endpoints will only be used in case the first one fails.
+    @param load_balancing_enabled: Whether or not to enable load balancing. If false, the first active endpoint will always be used, and other endpoints will only be used in case the first one fails, as if every endpoint had its own priority in list order.
+    @param strategy: How to pick the endpoint for each request when load balancing is enabled. One of "round_robin" (default), "weighted_round_robin" (default if any endpoint has a weight other than 1), "least_outstanding", "ewma", "power_of_two" or "affinity" (requests with the same prompt prefix, or affinity_key, go to the same endpoint), or a SelectionStrategy instance, e.g. AffinityStrategy(prefix_messages=2).
+    @param rate_limit_queue_size: The maximum number of requests that wait for budget when every endpoint has used up its requests_per_minute or tokens_per_minute limit. Further requests fail immediately.
+    @param rate_limit_queue_timeout: The maximum number of seconds a request waits for rate limit budget.
+    @param hedging_policy: A HedgingPolicy that configures requests made with hedge=True. Defaults to hedging after the endpoint's p95 latency, for at most 5% of requests.
+    @param retry_policy: A RetryPolicy that configures how failed requests are retried. Defaults to at most 5 attempts, with a random exponential backoff between 1 and 60 seconds.
+    @param embedding_batching: Whether or not to coalesce concurrent Embedding.create calls into batched requests. Pass True for the default batching settings, or a dict of EmbeddingBatcher options (max_wait, max_batch_size, max_batch_tokens).
+    @param response_cache: Whether or not to cache the responses of deterministic requests (embeddings and temperature 0 completions by default). Pass True for an in-memory cache with the default settings, or a dict of ResponseCache options (max_entries, ttl, path for a persistent SQLite cache, is_cacheable).
+    @param metrics: A MetricsRegistry that collects the metrics of the load balancer. Defaults to one with latency buckets from 0.1 to 120 seconds.
+    @param adaptive_weights: Whether or not to lower the weight of endpoints that answer with 429s, and give it back while they don't. Pass True for the default settings, or an AdaptiveWeightPolicy.
+    @param health_state: A HealthStateBackend that shares the endpoints' cooldowns and rate limits with the load balancers of other processes, e.g. MmapHealthState("/dev/shm/openai-load-balancer") for the worker processes on one host. Defaults to keeping them in this process.
+    @param scheduler: A RequestScheduler, or a dict of RequestScheduler options (max_concurrency, max_endpoint_concurrency, max_queue_size, priorities, reserved_concurrency, max_queue_time), that bounds the number of requests in flight and queues the rest by their priority, e.g. create(priority="batch"). By default, requests are sent right away.
+    @param single_flight: Whether or not identical requests that are in flight at the same time share one upstream call and its response or error. Pass True to share deterministic requests (embeddings and temperature 0 completions), or a dict of SingleFlight options (is_shareable).
+    @param circuit_breaker: Whether or not to probe endpoints that reached the failure_threshold in a background thread, and let them back in with a trickle of requests as soon as a probe succeeds instead of after the cooldown_period. Pass True for the default settings, or a CircuitBreaker, or a dict of CircuitBreaker options (probe, probe_interval, max_probe_interval, probe_timeout, half_open_requests, success_threshold, history_size).
     """
+    if isinstance(scheduler, dict):
+        scheduler = RequestScheduler(**scheduler)
+    if isinstance(circuit_breaker, dict):
+        circuit_breaker = CircuitBreaker(**circuit_breaker)
     load_balancer = LoadBalancer(
         endpoints,
         failure_threshold=failure_threshold,
         cooldown_period=cooldown_period,
-        load_balancing_enabled=load_balancing_enabled, model_engine_mapping=model_engine_mapping
+        load_balancing_enabled=load_balancing_enabled, model_engine_mapping=model_engine_mapping,
+        strategy=strategy, rate_limit_queue_size=rate_limit_queue_size,
+        rate_limit_queue_timeout=rate_limit_queue_timeout, hedging_policy=hedging_policy,
+        retry_policy=retry_policy, metrics=metrics, adaptive_weights=adaptive_weights,
+        health_state=health_state, scheduler=scheduler, circuit_breaker=circuit_breaker
     )
-    return OpenAILoadBalancer(load_balancer)
+    embedding_batcher = None
+    if embedding_batching:
+        embedding_batcher = EmbeddingBatcher(
+            load_balancer, **(embedding_batching if isinstance(embedding_batching, dict) else {}))
+    cache = None
+    if response_cache:
+        # The load balancer's mapping also maps the deployment names of endpoints that declare their own models back to the model
+        cache = ResponseCache(model_engine_mapping=model_engine_mapping, engine_model_mapping=load_balancer.engine_model_mapping,
+                              **(response_cache if isinstance(response_cache, dict) else {}))
+    flight = None
+    if single_flight:
+        flight = SingleFlight(engine_model_mapping=load_balancer.engine_model_mapping,
+                              **(single_flight if isinstance(single_flight, dict) else {}))
+    return OpenAILoadBalancer(load_balancer, embedding_batcher, cache, flight)
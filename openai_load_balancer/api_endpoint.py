@@ -1,36 +1,342 @@
+import asyncio
+import math
+import os
 import threading
-from datetime import datetime
+import time
+from collections import deque, namedtuple
+from datetime import timedelta
+import aiohttp
+from openai_load_balancer.rate_limiter import TokenBucket
+
+# The failure state of an endpoint. It is immutable and replaced as a whole, so it can be read without a lock. Times are time.monotonic() values.
+# half_open_successes is the number of successful requests in a row since the endpoint was half opened by a circuit breaker, or None if it isn't half open.
+EndpointHealth = namedtuple(
+    "EndpointHealth", ["failure_count", "last_failed_time", "cooldown_started_time", "half_open_successes"])
+HEALTHY = EndpointHealth(0, None, None, None)
+
+
+def to_seconds(period):
+    """Returns the number of seconds of a timedelta, or period itself if it is already a number of seconds"""
+    return period.total_seconds() if isinstance(period, timedelta) else period
 
 
 class ApiEndpoint:
-    def __init__(self, api_type, base_url, api_key_env, version=None):
+    __slots__ = ("name", "api_type", "base_url", "api_key_env", "version", "models", "deployments", "weight", "effective_weight", "priority", "api_base", "api_key", "max_connections", "aiohttp_sessions",
+                 "health", "cooldown_time", "in_flight", "latency_ewma", "latency_samples", "time_to_first_token_ewma", "tokens_per_second_ewma",
+                 "request_bucket", "token_bucket", "throttled_until", "shared_state", "lock")
+
+    # How much weight each new latency sample gets in the exponentially weighted moving average
+    LATENCY_EWMA_ALPHA = 0.3
+    # The number of recent latency samples kept to compute latency percentiles
+    LATENCY_WINDOW_SIZE = 200
+
+    def __init__(self, api_type, base_url, api_key_env, version=None, max_connections=100, requests_per_minute=None, tokens_per_minute=None, name=None, models=None, weight=1, priority=0):
         """Inits an API endpoint based on the passed in configuration. You can make adjustments to your configurations in config.py"""
+        # The name the endpoint is reported under in metrics. Never includes the api key.
+        self.name = name or f"{api_type}:{base_url}"
         self.api_type = api_type
         self.base_url = base_url
         self.api_key_env = api_key_env
         self.version = version
-        self.failure_count = 0
-        self.last_failed_time = None
-        self.lock = threading.Lock()  # Adding a lock for thread safety
-
-    def is_active(self, failure_threshold, cooldown_period):
-        """Checks if the endpoint is active. If it has failed more than failure_threshold times, it is inactive. If it is currently marked as failed with a last_failed_time within the cooldown_period, it is inactive. If the cooldown_period has passed since the last failure, the endpoint will be reset to active and returns true."""
-        with self.lock:  # Ensure thread-safe read
-            if self.failure_count < failure_threshold:
-                return True
-            if self.last_failed_time and datetime.now() - self.last_failed_time > cooldown_period:
-                self.reset()
-                return True
+        # The models the endpoint serves, or None if it serves every model. A dict maps each model to the name of its deployment on this endpoint, for Azure resources whose deployment names differ from the model_engine_mapping.
+        self.models = frozenset(models) if models is not None else None
+        self.deployments = dict(models) if isinstance(models, dict) else {}
+        if weight < 0:
+            raise ValueError("Endpoint weights can't be negative.")
+        # The share of traffic the endpoint gets relative to the other endpoints, e.g. its tokens_per_minute quota. effective_weight is the weight that is currently used, which adaptive weights lower while the endpoint is rate limiting us.
+        self.weight = weight
+        self.effective_weight = weight
+        # Endpoints with a higher priority number are only used when no endpoint with a lower one is available
+        self.priority = priority
+        # openai has a standard base_url, whereas for azure we'll read it from the environment variable. Both are resolved once here rather than on every request
+        self.api_base = str(os.getenv(base_url)
+                            ) if api_type == "azure" else base_url
+        self.api_key = str(os.getenv(api_key_env))
+        self.max_connections = max_connections
+        # The aiohttp session of each event loop that sent requests to the endpoint, since a session can only be used on the loop it was created on
+        self.aiohttp_sessions = {}
+        self.health = HEALTHY
+        # How many seconds the endpoint spent in cooldown, not counting the current cooldown
+        self.cooldown_time = 0.0
+        self.in_flight = 0
+        self.latency_ewma = None
+        self.latency_samples = deque(maxlen=self.LATENCY_WINDOW_SIZE)
+        # Moving averages of streamed responses
+        self.time_to_first_token_ewma = None
+        self.tokens_per_second_ewma = None
+        # Client-side rate limits, so that we stop sending requests before the endpoint starts answering with 429s
+        self.request_bucket = TokenBucket(
+            requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(
+            tokens_per_minute) if tokens_per_minute else None
+        # Set when the endpoint answers with a 429, so that it isn't used again before its Retry-After has passed
+        self.throttled_until = None
+        # The EndpointState that replaces the failure state and rate limits above when they are shared with other processes
+        self.shared_state = None
+        # Guards changes to the endpoint's state. Reading the health doesn't need it.
+        self.lock = threading.Lock()
+
+    def share_state(self, health_state):
+        """Keeps the endpoint's failure state and rate limits in the passed in HealthStateBackend, shared with every other load balancer that uses it"""
+        self.shared_state = health_state.endpoint_state(
+            self.name,
+            self.request_bucket.capacity if self.request_bucket is not None else None,
+            self.token_bucket.capacity if self.token_bucket is not None else None)
+
+    def get_health(self):
+        shared_state = self.shared_state
+        return self.health if shared_state is None else shared_state.get_health()
+
+    def set_health(self, **fields):
+        if self.shared_state is not None:
+            self.shared_state.set_health(**fields)
+            return
+        with self.lock:
+            self.health = self.health._replace(**fields)
+
+    @property
+    def failure_count(self):
+        return self.get_health().failure_count
+
+    @failure_count.setter
+    def failure_count(self, failure_count):
+        self.set_health(failure_count=failure_count)
+
+    @property
+    def last_failed_time(self):
+        return self.get_health().last_failed_time
+
+    @last_failed_time.setter
+    def last_failed_time(self, last_failed_time):
+        self.set_health(last_failed_time=last_failed_time)
+
+    @property
+    def cooldown_started_time(self):
+        return self.get_health().cooldown_started_time
+
+    def is_active(self, failure_threshold, cooldown_period, half_open=False):
+        """Checks if the endpoint is active. If it has failed more than failure_threshold times, it is inactive. If it is currently marked as failed with a last_failed_time within the cooldown_period, it is inactive. If the cooldown_period has passed since the last failure, the endpoint will be reset to active and returns true, or, if half_open, only half opened. A half open endpoint is active. Only takes the lock when the endpoint goes into or comes out of cooldown."""
+        health = self.get_health()
+        if health.failure_count < failure_threshold or health.half_open_successes is not None:
+            return True
+        if health.last_failed_time is not None and time.monotonic() - health.last_failed_time > to_seconds(cooldown_period):
+            if half_open:
+                self.half_open(health)
+            else:
+                self.recover(health)
+            return True
+        if health.cooldown_started_time is None:
+            # The cooldown started with the failure that reached the failure_threshold
+            self.compare_and_set_health(health, health._replace(
+                cooldown_started_time=health.last_failed_time or time.monotonic()))
+        return False
+
+    def compare_and_set_health(self, expected, health):
+        """Replaces the endpoint's health with health, unless it changed since expected was read"""
+        if self.shared_state is not None:
+            return self.shared_state.compare_and_set_health(expected, health)
+        with self.lock:
+            if self.health is not expected:
+                return False
+            if health is HEALTHY:
+                self._reset()
+            else:
+                self.health = health
+            return True
+
+    def recover(self, health):
+        """Resets the endpoint once its cooldown has passed, unless it failed again since its health was read"""
+        self.compare_and_set_health(health, HEALTHY)
+
+    def half_open(self, health):
+        """Lets a trickle of requests through to the endpoint in cooldown, to find out whether it has recovered, unless it changed since its health was read. Returns whether it was half opened."""
+        return self.compare_and_set_health(health, health._replace(half_open_successes=0))
+
+    def record_success(self, success_threshold=1):
+        """Resets the endpoint after a successful request. A half open endpoint is only reset after success_threshold successful requests in a row. Returns whether the endpoint was reset."""
+        health = self.get_health()
+        if health == HEALTHY:
+            return False
+        if health.half_open_successes is not None and health.half_open_successes + 1 < success_threshold:
+            self.compare_and_set_health(health, health._replace(
+                half_open_successes=health.half_open_successes + 1))
             return False
+        self.reset()
+        return True
 
     def reset(self):
         """Resets the endpoint to active by setting failure_count to 0 and last_failed_time to None"""
+        if self.shared_state is not None:
+            self.shared_state.reset()
+            return
+        if self.health is HEALTHY:
+            # Most requests succeed on an endpoint that hasn't failed, which doesn't need the lock
+            return
         with self.lock:  # Ensure thread-safe state update
-            self.failure_count = 0
-            self.last_failed_time = None
+            self._reset()
+
+    def _reset(self):
+        if self.health.cooldown_started_time is not None:
+            self.cooldown_time += time.monotonic() - self.health.cooldown_started_time
+        self.health = HEALTHY
+
+    def total_cooldown_time(self):
+        """Returns the number of seconds the endpoint has spent in cooldown, including the current cooldown"""
+        if self.shared_state is not None:
+            return self.shared_state.total_cooldown_time()
+        cooldown_started_time = self.health.cooldown_started_time
+        if cooldown_started_time is None:
+            return self.cooldown_time
+        return self.cooldown_time + time.monotonic() - cooldown_started_time
 
     def mark_failed(self):
-        """Marks the endpoint as failed by incrementing failure_count and setting last_failed_time to the current time"""
+        """Marks the endpoint as failed by incrementing failure_count and setting last_failed_time to the current time. A half open endpoint is no longer half open."""
+        if self.shared_state is not None:
+            self.shared_state.mark_failed()
+            return
         with self.lock:  # Ensure thread-safe state update
-            self.failure_count += 1
-            self.last_failed_time = datetime.now()
+            self.health = self.health._replace(
+                failure_count=self.health.failure_count + 1, last_failed_time=time.monotonic(), half_open_successes=None)
+
+    def start_request(self):
+        """Records that a request to this endpoint has started"""
+        with self.lock:
+            self.in_flight += 1
+
+    def finish_request(self, latency=None):
+        """Records that a request to this endpoint has finished. If latency (in seconds) is passed in, it is added to the endpoint's latency moving average."""
+        with self.lock:
+            self.in_flight -= 1
+            if latency is not None:
+                self.latency_samples.append(latency)
+                self.latency_ewma = self._ewma(self.latency_ewma, latency)
+
+    def record_stream(self, time_to_first_token, tokens_per_second=None):
+        """Adds a completed stream's time to first token (in seconds) and, if known, its tokens per second to the endpoint's moving averages"""
+        with self.lock:
+            self.time_to_first_token_ewma = self._ewma(
+                self.time_to_first_token_ewma, time_to_first_token)
+            if tokens_per_second is not None:
+                self.tokens_per_second_ewma = self._ewma(
+                    self.tokens_per_second_ewma, tokens_per_second)
+
+    def _ewma(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.LATENCY_EWMA_ALPHA * (sample - average)
+
+    def latency_percentile(self, q, min_samples=1):
+        """Returns the q-th percentile (0 to 1) of the endpoint's recent latencies in seconds, or None if it has fewer than min_samples samples"""
+        with self.lock:
+            samples = sorted(self.latency_samples)
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, math.ceil(q * len(samples)) - 1)]
+
+    def has_capacity(self, tokens=0):
+        """Checks if the endpoint's rate limits leave enough budget for a request using the passed in number of tokens"""
+        if self.shared_state is not None:
+            return self.shared_state.has_capacity(tokens)
+        if self.request_bucket is None and self.token_bucket is None and self.throttled_until is None:
+            # Endpoints without rate limits don't need the lock
+            return True
+        with self.lock:
+            return self._has_capacity(tokens)
+
+    def _has_capacity(self, tokens):
+        if self.throttled_until is not None:
+            if time.monotonic() < self.throttled_until:
+                return False
+            # Clearing it lets has_capacity skip the lock again
+            self.throttled_until = None
+        if self.request_bucket is not None and not self.request_bucket.has_capacity(1):
+            return False
+        if self.token_bucket is not None and not self.token_bucket.has_capacity(tokens):
+            return False
+        return True
+
+    def try_acquire(self, tokens=0):
+        """Takes the budget for one request using the passed in number of tokens from the endpoint's rate limits. Returns False, without taking anything, if there isn't enough budget left."""
+        if self.shared_state is not None:
+            return self.shared_state.try_acquire(tokens)
+        if self.request_bucket is None and self.token_bucket is None and self.throttled_until is None:
+            return True
+        with self.lock:
+            if not self._has_capacity(tokens):
+                return False
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+            return True
+
+    def time_until_capacity(self, tokens=0):
+        """Returns the number of seconds until the endpoint's rate limits have budget for a request using the passed in number of tokens"""
+        if self.shared_state is not None:
+            return self.shared_state.time_until_capacity(tokens)
+        with self.lock:
+            wait_time = 0.0
+            if self.throttled_until is not None:
+                wait_time = max(self.throttled_until - time.monotonic(), 0.0)
+            if self.request_bucket is not None:
+                wait_time = max(
+                    wait_time, self.request_bucket.time_until_available(1))
+            if self.token_bucket is not None:
+                wait_time = max(
+                    wait_time, self.token_bucket.time_until_available(tokens))
+            return wait_time
+
+    def throttle(self, seconds):
+        """Stops using the endpoint for the passed in number of seconds"""
+        if self.shared_state is not None:
+            self.shared_state.throttle(seconds)
+            return
+        with self.lock:
+            throttled_until = time.monotonic() + seconds
+            if self.throttled_until is None or throttled_until > self.throttled_until:
+                self.throttled_until = throttled_until
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Corrects the token budget taken by try_acquire once the actual number of tokens used by the request is known"""
+        if self.token_bucket is None:
+            return
+        if self.shared_state is not None:
+            self.shared_state.record_usage(actual_tokens - estimated_tokens)
+            return
+        with self.lock:
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+
+    def client_kwargs(self):
+        """Returns the credentials to pass along with each OpenAI request to this endpoint, so that requests never depend on the global openai configuration"""
+        return {
+            "api_key": self.api_key,
+            "api_base": self.api_base,
+            "api_type": self.api_type,
+            "api_version": self.version,
+        }
+
+    async def aget_aiohttp_session(self):
+        """Returns this endpoint's aiohttp session for the current event loop, creating it on first use. The session keeps a pool of keep-alive connections to the endpoint that is reused by every async request on the loop. Closes the sessions of event loops that were closed without calling aclose."""
+        loop = asyncio.get_running_loop()
+        session = self.aiohttp_sessions.get(loop)
+        if session is not None and not session.closed:
+            return session
+        with self.lock:
+            stale_sessions = [self.aiohttp_sessions.pop(stale_loop) for stale_loop in list(self.aiohttp_sessions)
+                              if stale_loop.is_closed()]
+            session = self.aiohttp_sessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections))
+        for stale_session in stale_sessions:
+            # The connections died with their loop, so this only releases the session
+            await stale_session.close()
+        return session
+
+    async def aclose(self):
+        """Closes this endpoint's aiohttp session of the current event loop and its pooled connections, and the sessions of event loops that were already closed"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            sessions = [self.aiohttp_sessions.pop(session_loop) for session_loop in list(self.aiohttp_sessions)
+                        if session_loop is loop or session_loop.is_closed()]
+        for session in sessions:
+            if not session.closed:
+                await session.close()
@@ -0,0 +1,128 @@
+import json
+import threading
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.rate_limiter import count_tokens
+
+
+def normalize_embedding_input(value):
+    """Returns the embedding input as a list of inputs. A string or a list of token ids is a single input."""
+    if isinstance(value, str):
+        return [value]
+    if value and all(isinstance(item, int) for item in value):
+        return [value]
+    return list(value)
+
+
+def split_usage(total, weights):
+    """Splits total into integer parts proportional to weights, which add up to exactly total"""
+    weight_sum = sum(weights)
+    if not weight_sum:
+        weights, weight_sum = [1] * len(weights), len(weights)
+    parts = [total * weight // weight_sum for weight in weights]
+    # Hand out what was lost to rounding, one at a time
+    for i in range(total - sum(parts)):
+        parts[i % len(parts)] += 1
+    return parts
+
+
+class EmbeddingBatch:
+    """The inputs of concurrent embedding requests that are sent together in one request"""
+
+    def __init__(self, kwargs):
+        self.kwargs = kwargs
+        self.inputs = []
+        # (start, count, tokens) of each caller's inputs
+        self.slots = []
+        self.tokens = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.responses = None
+        self.error = None
+
+    def add(self, inputs, tokens):
+        self.slots.append((len(self.inputs), len(inputs), tokens))
+        self.inputs.extend(inputs)
+        self.tokens += tokens
+        return len(self.slots) - 1
+
+    def split_response(self, response):
+        """Splits the batched response into one response per caller, with the data re-indexed and the usage split proportionally to each caller's tokens"""
+        data = sorted(response["data"], key=lambda item: item["index"])
+        usage = response.get("usage") or {}
+        weights = [tokens for _, _, tokens in self.slots]
+        split_usages = {key: split_usage(value, weights)
+                        for key, value in usage.items() if isinstance(value, int)}
+        responses = []
+        for i, (start, count, _) in enumerate(self.slots):
+            responses.append(OpenAIObject.construct_from({
+                "object": response.get("object", "list"),
+                "model": response.get("model"),
+                "data": [dict(item, index=index) for index, item in enumerate(data[start:start + count])],
+                "usage": {key: values[i] for key, values in split_usages.items()},
+            }))
+        return responses
+
+
+class EmbeddingBatcher:
+    """Coalesces concurrent Embedding.create calls with the same model and arguments into one request with a list of inputs. The first caller of a batch waits up to max_wait seconds for other callers to join, sends the batch once it's full or the wait is over, and hands each caller back its own part of the response."""
+
+    def __init__(self, load_balancer, max_wait=0.01, max_batch_size=256, max_batch_tokens=50000):
+        self.load_balancer = load_balancer
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.pending_batches = {}
+        self.request_count = 0
+        self.batch_count = 0
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        inputs = normalize_embedding_input(kwargs.pop("input"))
+        tokens = count_tokens(inputs)
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+
+        with self.lock:
+            self.request_count += 1
+            batch = self.pending_batches.get(key)
+            if batch is not None and (len(batch.inputs) + len(inputs) > self.max_batch_size or batch.tokens + tokens > self.max_batch_tokens):
+                # This caller doesn't fit, so send the pending batch right away and start a new one
+                del self.pending_batches[key]
+                batch.full.set()
+                batch = None
+            is_leader = batch is None
+            if is_leader:
+                batch = EmbeddingBatch(kwargs)
+                self.pending_batches[key] = batch
+            slot = batch.add(inputs, tokens)
+            if len(batch.inputs) >= self.max_batch_size or batch.tokens >= self.max_batch_tokens:
+                del self.pending_batches[key]
+                batch.full.set()
+
+        if is_leader:
+            self.send_batch(key, batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.responses[slot]
+
+    def send_batch(self, key, batch):
+        batch.full.wait(self.max_wait)
+        with self.lock:
+            if self.pending_batches.get(key) is batch:
+                del self.pending_batches[key]
+            self.batch_count += 1
+        try:
+            response = self.load_balancer.try_send_request(
+                'embedding_create', input=batch.inputs, **batch.kwargs)
+            batch.responses = batch.split_response(response)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def stats(self):
+        """Returns the number of embedding requests received and the number of batched requests actually sent"""
+        with self.lock:
+            return {"requests": self.request_count, "batches": self.batch_count}
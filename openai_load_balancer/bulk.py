@@ -0,0 +1,282 @@
+"""Sends every request of a JSONL file through the load balancer and writes the responses to another JSONL file.
+
+    python -m openai_load_balancer.bulk in.jsonl out.jsonl --config config.json
+
+Each input line is either a request in the OpenAI batch format, {"custom_id": ..., "url": "/v1/chat/completions", "body": {...}}, or just the arguments of the request, which is then sent with --method. Each output line is {"id": ..., "line": ..., "response": {...}}, or {"id": ..., "line": ..., "error": {...}} if the request failed. The id is the custom_id, or the line number, starting at 1. The config file is a JSON object with the arguments of initialize_load_balancer, e.g. {"endpoints": [...]}, with cooldown_period in seconds.
+
+The output file is also the checkpoint: when it already exists, the lines that have a response are skipped and the failed lines are sent again.
+
+With --return-format numpy, embeddings are requested and written as base64 float32 strings, which take a quarter of the space of JSON floats, and read_embeddings loads them into a float32 matrix.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from openai_load_balancer.embedding_arrays import RETURN_FORMATS, check_return_format, decode_embedding, np
+
+# The method each route of the OpenAI batch format is sent with
+URL_METHODS = {
+    "/v1/chat/completions": "chat_completion_create",
+    "/v1/completions": "completion_create",
+    "/v1/embeddings": "embedding_create",
+}
+# The --method option's names for the methods
+METHODS = {
+    "chat": "chat_completion_create",
+    "completion": "completion_create",
+    "embedding": "embedding_create",
+}
+# The number of requests sent at once for each active endpoint, if neither concurrency nor the load balancer's scheduler bound it
+DEFAULT_CONCURRENCY_PER_ENDPOINT = 8
+# An invalid line doesn't get a retry classification, as it was never sent
+INVALID_LINE = "invalid_line"
+
+
+def parse_request(line, default_method):
+    """Returns the method name, the arguments and the custom id of a line of the input file"""
+    request = json.loads(line)
+    if not isinstance(request, dict):
+        raise ValueError("Each line has to be a JSON object.")
+    method_name, kwargs, custom_id = default_method, request, None
+    if "body" in request:
+        url = request.get("url", "/v1/chat/completions")
+        if url not in URL_METHODS:
+            raise ValueError(f"Unknown url {url!r}.")
+        method_name, kwargs, custom_id = URL_METHODS[url], dict(
+            request["body"]), request.get("custom_id")
+    if kwargs.get("stream"):
+        raise ValueError("Streamed requests can't be written to the output file.")
+    return method_name, kwargs, custom_id
+
+
+def read_checkpoint(output_path):
+    """Returns the line numbers of the input lines that already have a response in the output file. Drops the failed lines and a last line that was cut off by a crash from the file, so that they can be sent again."""
+    if not os.path.exists(output_path):
+        return set()
+    done = set()
+    kept_lines = []
+    dropped = False
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line) if line.endswith("\n") else None
+            except ValueError:
+                record = None
+            if record is None or "response" not in record:
+                dropped = True
+                continue
+            done.add(record["line"])
+            kept_lines.append(line)
+    if dropped:
+        temporary_path = output_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.writelines(kept_lines)
+        os.replace(temporary_path, output_path)
+    return done
+
+
+class BulkStats:
+    """Counts the lines of a bulk run, and the tokens used"""
+
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.lines = 0
+        self.skipped = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.errors = {}
+
+    def record_response(self, response):
+        self.succeeded += 1
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage:
+            self.prompt_tokens += usage.get("prompt_tokens") or 0
+            self.completion_tokens += usage.get("completion_tokens") or 0
+
+    def record_error(self, error_type):
+        self.failed += 1
+        self.errors[error_type] = self.errors.get(error_type, 0) + 1
+
+    def to_dict(self):
+        duration = time.monotonic() - self.start_time
+        return {
+            "lines": self.lines,
+            "skipped": self.skipped,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "errors": dict(self.errors),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "duration_seconds": duration,
+            "throughput": self.succeeded / duration if duration else 0.0,
+        }
+
+
+def default_concurrency(load_balancer):
+    scheduler = load_balancer.scheduler
+    if scheduler is not None and scheduler.max_concurrency is not None:
+        # Keep the scheduler's queue busy, without queueing the whole file
+        return 2 * scheduler.max_concurrency
+    return DEFAULT_CONCURRENCY_PER_ENDPOINT * max(len(load_balancer.get_health().active_endpoints), 1)
+
+
+async def arun_bulk(openai_load_balancer, input_path, output_path, concurrency=None, ordered=False, resume=True, method="chat_completion_create", priority="batch", progress=None, return_format=None):
+    """Sends every request of the JSONL file at input_path through the OpenAILoadBalancer, concurrency requests at a time, and appends the responses to the JSONL file at output_path as they finish, or in the order of the input file if ordered. The input file is read as the requests are sent, so it is never loaded into memory. If resume, the lines that already have a response in the output file are skipped. If the load balancer has a scheduler, the requests are sent with priority. progress is called with the BulkStats after each line. With return_format="numpy", embeddings are written as base64 strings, to be loaded with read_embeddings. Returns the stats of the run."""
+    if return_format is not None:
+        check_return_format(return_format)
+    load_balancer = openai_load_balancer.load_balancer
+    resources = {resource.method_name: resource for resource in (
+        openai_load_balancer.ChatCompletion, openai_load_balancer.Completion, openai_load_balancer.Embedding)}
+    concurrency = concurrency or default_concurrency(load_balancer)
+    done = read_checkpoint(output_path) if resume else set()
+    stats = BulkStats()
+    # Bounds the lines that were read but not written yet, which, in order, includes the lines waiting for an earlier line to finish
+    window = asyncio.Semaphore(concurrency * 4 if ordered else concurrency)
+    # The records waiting to be written in order, by line number
+    pending_records = {}
+    pending_lines = deque()
+
+    with open(input_path, encoding="utf-8") as input_file, open(output_path, "a" if resume else "w", encoding="utf-8", buffering=1) as output_file:
+        # Line numbers start at 1, like in an editor
+        lines = enumerate(input_file, 1)
+
+        def write(line_number, record):
+            if not ordered:
+                output_file.write(json.dumps(record) + "\n")
+                window.release()
+                return
+            pending_records[line_number] = record
+            while pending_lines and pending_lines[0] in pending_records:
+                output_file.write(json.dumps(
+                    pending_records.pop(pending_lines.popleft())) + "\n")
+                window.release()
+
+        async def send(line_number, line):
+            record = {"id": line_number, "line": line_number}
+            try:
+                method_name, kwargs, custom_id = parse_request(line, method)
+            except (ValueError, TypeError) as e:
+                stats.record_error(INVALID_LINE)
+                record["error"] = {"type": INVALID_LINE, "message": str(e)}
+                return record
+            if custom_id is not None:
+                record["id"] = custom_id
+            if return_format is not None and method_name == "embedding_create":
+                kwargs.setdefault("encoding_format", "base64")
+            if load_balancer.scheduler is not None and priority in load_balancer.scheduler.ranks:
+                kwargs.setdefault("priority", priority)
+            try:
+                response = await resources[method_name].acreate(**kwargs)
+            except Exception as e:
+                error_type = load_balancer.retry_policy.classify(e)
+                stats.record_error(error_type)
+                record["error"] = {"type": error_type, "message": str(e)}
+                return record
+            stats.record_response(response)
+            record["response"] = response
+            return record
+
+        async def worker():
+            while True:
+                await window.acquire()
+                line_number, line = next(lines, (None, None))
+                if line is None:
+                    window.release()
+                    return
+                if not line.strip():
+                    window.release()
+                    continue
+                stats.lines += 1
+                if line_number in done:
+                    stats.skipped += 1
+                    window.release()
+                    continue
+                pending_lines.append(line_number)
+                write(line_number, await send(line_number, line))
+                if progress is not None:
+                    progress(stats)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await load_balancer.aclose()
+    return stats.to_dict()
+
+
+def read_embeddings(output_path):
+    """Returns the ids and the embeddings of the successful embedding responses in the output file of a bulk run, in the order of the input file. The embeddings are a float32 matrix with a row for each input, and ids has the id of the line of each row."""
+    if np is None:
+        check_return_format("numpy")
+    records = []
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "response" in record:
+                records.append(record)
+    records.sort(key=lambda record: record["line"])
+    ids = []
+    rows = []
+    for record in records:
+        for item in sorted(record["response"]["data"], key=lambda item: item["index"]):
+            ids.append(record["id"])
+            rows.append(decode_embedding(item["embedding"]))
+    if not rows:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    return ids, np.stack(rows)
+
+
+def run_bulk(openai_load_balancer, input_path, output_path, **kwargs):
+    """Runs arun_bulk on a new event loop. Takes the same arguments."""
+    return asyncio.run(arun_bulk(openai_load_balancer, input_path, output_path, **kwargs))
+
+
+def load_config(path):
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    if "endpoints" not in config:
+        raise ValueError(f"The config file {path} has no endpoints.")
+    return config
+
+
+def main(argv=None):
+    from openai_load_balancer import initialize_load_balancer
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("input_path")
+    parser.add_argument("output_path")
+    parser.add_argument("--config", required=True,
+                        help="A JSON file with the arguments of initialize_load_balancer")
+    parser.add_argument("--method", choices=METHODS, default="chat",
+                        help="How lines that only contain the arguments of the request are sent")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="The number of requests sent at once. Defaults to a number sized to the endpoints.")
+    parser.add_argument("--ordered", action="store_true",
+                        help="Write the responses in the order of the input file, instead of as they finish")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Overwrite the output file instead of skipping the lines it already has a response for")
+    parser.add_argument("--return-format", choices=RETURN_FORMATS, default=None,
+                        help="numpy writes embeddings as base64 float32 strings, to be loaded with read_embeddings")
+    parser.add_argument("--progress-interval", type=float, default=10.0,
+                        help="Seconds between progress reports on stderr")
+    args = parser.parse_args(argv)
+
+    openai_load_balancer = initialize_load_balancer(
+        **load_config(args.config))
+    last_report_time = [time.monotonic()]
+
+    def report_progress(stats):
+        if time.monotonic() - last_report_time[0] >= args.progress_interval:
+            last_report_time[0] = time.monotonic()
+            print(json.dumps(stats.to_dict()), file=sys.stderr)
+
+    stats = run_bulk(openai_load_balancer, args.input_path, args.output_path, concurrency=args.concurrency,
+                     ordered=args.ordered, resume=not args.no_resume, method=METHODS[args.method], progress=report_progress, return_format=args.return_format)
+    print(json.dumps(stats, indent=2))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from openai.openai_object import OpenAIObject
+
+# Arguments that change how a request is sent, but not its response
+NON_SEMANTIC_ARGUMENTS = ("request_timeout", "timeout",
+                          "headers", "priority", "affinity_key")
+
+
+def is_deterministic(method_name, kwargs):
+    """Returns True for requests that always get the same response: embeddings, and non-streaming temperature 0 completions with a single choice"""
+    if kwargs.get("stream"):
+        return False
+    if method_name == 'embedding_create':
+        return True
+    return kwargs.get("temperature") == 0 and (kwargs.get("n") or 1) == 1
+
+
+def request_key(method_name, kwargs, model_engine_mapping=None, engine_model_mapping=None):
+    """Returns a canonical hash of the request. Azure engine names are mapped back to OpenAI model names first, so the same request to Azure and OpenAI endpoints gets the same key. Pass the inverted engine_model_mapping instead of model_engine_mapping to avoid inverting it on every call."""
+    normalized = {key: value for key, value in kwargs.items()
+                  if key not in NON_SEMANTIC_ARGUMENTS}
+    deployment_id = normalized.pop("deployment_id", None)
+    engine = normalized.pop("engine", deployment_id)
+    if engine is not None and "model" not in normalized:
+        if engine_model_mapping is None:
+            engine_model_mapping = {engine: model for model,
+                                    engine in (model_engine_mapping or {}).items()}
+        normalized["model"] = engine_model_mapping.get(engine, engine)
+    payload = json.dumps([method_name, normalized], sort_keys=True,
+                         separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Caches the responses of deterministic requests in a bounded in-memory LRU, and optionally in an SQLite database at path that survives restarts. Entries expire after ttl seconds (never if ttl is None). is_cacheable(method_name, kwargs) decides which requests are cached. Azure engine names are mapped back to OpenAI model names with the inverse of model_engine_mapping, or with engine_model_mapping if passed in, which can map several engines to one model. Cached responses are shared between callers, so treat them as read-only."""
+
+    def __init__(self, max_entries=1024, ttl=24 * 60 * 60, path=None, is_cacheable=is_deterministic, model_engine_mapping=None, engine_model_mapping=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.is_cacheable = is_cacheable
+        self.model_engine_mapping = model_engine_mapping
+        if engine_model_mapping is None:
+            engine_model_mapping = {engine: model for model,
+                                    engine in (model_engine_mapping or {}).items()}
+        self.engine_model_mapping = engine_model_mapping
+        # key -> (expiry time, response), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires_at REAL, response TEXT)")
+            self.db.commit()
+
+    def key(self, method_name, kwargs):
+        return request_key(method_name, kwargs, engine_model_mapping=self.engine_model_mapping)
+
+    def get(self, key):
+        """Returns the cached response for the key, or None if there is none or it has expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at is None or expires_at > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self.entries[key]
+            if self.db is not None:
+                row = self.db.execute(
+                    "SELECT expires_at, response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and (row[0] is None or row[0] > now):
+                    response = OpenAIObject.construct_from(json.loads(row[1]))
+                    self.store_in_memory(key, row[0], response)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return response
+            self.misses += 1
+            return None
+
+    def set(self, key, response):
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.store_in_memory(key, expires_at, response)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                                (key, expires_at, json.dumps(response)))
+                self.db.commit()
+
+    def store_in_memory(self, key, expires_at, response):
+        self.entries[key] = (expires_at, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Removes every entry from both the memory and the disk cache"""
+        with self.lock:
+            self.entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def stats(self):
+        """Returns the number of hits (of which disk hits), misses and LRU evictions, and the number of entries in memory"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+            }
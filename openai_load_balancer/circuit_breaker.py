@@ -0,0 +1,173 @@
+import threading
+import time
+from collections import deque
+from openai import api_requestor
+from openai_load_balancer.metrics import endpoint_names
+
+# The states of an endpoint's circuit. A closed circuit gets every request it is picked for, an open one gets none, and a half open one gets a trickle of requests that decide whether it closes again.
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def circuit_state(health, failure_threshold):
+    """Returns the state of the circuit of an endpoint with the passed in EndpointHealth"""
+    if health.half_open_successes is not None:
+        return HALF_OPEN
+    if health.failure_count >= failure_threshold:
+        return OPEN
+    return CLOSED
+
+
+def list_models(load_balancer, endpoint, timeout):
+    """Probes the endpoint by listing its models, which checks that it is reachable and accepts our key without using any quota"""
+    requestor = api_requestor.APIRequestor(
+        endpoint.api_key, api_base=endpoint.api_base, api_type=endpoint.api_type, api_version=endpoint.version)
+    url = f"/openai/models?api-version={endpoint.version}" if endpoint.api_type == "azure" else "/models"
+    requestor.request("get", url, request_timeout=timeout)
+
+
+class Circuit:
+    """The circuit breaker's view of one endpoint: its state, when it is probed next, and how often it tripped"""
+
+    def __init__(self, probe_interval):
+        self.state = CLOSED
+        self.probe_interval = probe_interval
+        self.next_probe_time = None
+        self.trip_count = 0
+        self.last_trip_time = None
+        self.probe_count = 0
+        self.failed_probe_count = 0
+
+
+class CircuitBreaker:
+    """Opens the circuit of an endpoint that reached the load balancer's failure_threshold, and probes it in a background thread instead of waiting for the cooldown_period to pass. The first probe is sent probe_interval seconds after the circuit opened, and every probe that fails doubles the wait, up to max_probe_interval. Once a probe succeeds, the circuit is half open: at most half_open_requests requests are sent to the endpoint at a time, and after success_threshold of them succeed in a row, the circuit closes. If one fails, the circuit opens again, and is probed after twice the previous wait. If the cooldown_period passes before a probe succeeds, the circuit is half opened as well. probe(load_balancer, endpoint, timeout) sends the probe and raises if it failed; by default it lists the endpoint's models. The last history_size changes of state are kept, with the time (time.time()) and reason of each."""
+
+    def __init__(self, probe=list_models, probe_interval=2.0, max_probe_interval=30.0, probe_timeout=5.0, half_open_requests=1, success_threshold=3, history_size=100):
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.max_probe_interval = max_probe_interval
+        self.probe_timeout = probe_timeout
+        self.half_open_requests = half_open_requests
+        self.success_threshold = success_threshold
+        self.circuits = {}
+        self.history = deque(maxlen=history_size)
+        self.lock = threading.Lock()
+        self.load_balancer = None
+        self.thread = None
+        # Set to wake up the prober early, when a circuit opened or the breaker is stopped
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def attach(self, load_balancer):
+        self.load_balancer = load_balancer
+        for endpoint in load_balancer.api_endpoints:
+            self.circuits[endpoint] = Circuit(self.probe_interval)
+
+    def update(self, endpoint, reason):
+        """Reads the state of the endpoint's circuit, which the load balancer, the prober or another process may have changed, and records it in the history if it changed. Schedules a probe for circuits that just opened. Returns the state."""
+        state = circuit_state(endpoint.get_health(),
+                              self.load_balancer.failure_threshold)
+        with self.lock:
+            circuit = self.circuits.get(endpoint)
+            if circuit is None or circuit.state == state:
+                return state
+            previous_state, circuit.state = circuit.state, state
+            now = time.monotonic()
+            if state == OPEN:
+                circuit.trip_count += 1
+                circuit.last_trip_time = time.time()
+                # A circuit that fails again while half open has been probed successfully before, so wait longer before believing the next probe
+                circuit.probe_interval = min(circuit.probe_interval * 2, self.max_probe_interval) \
+                    if previous_state == HALF_OPEN else self.probe_interval
+                circuit.next_probe_time = now + circuit.probe_interval
+            elif state == CLOSED:
+                circuit.probe_interval = self.probe_interval
+                circuit.next_probe_time = None
+            self.history.append({"endpoint": endpoint.name, "time": time.time(),
+                                 "from": previous_state, "to": state, "reason": reason})
+        if state == OPEN:
+            self.start()
+        return state
+
+    def probe_endpoint(self, endpoint):
+        """Sends a probe to the endpoint with an open circuit, and half opens it if the probe succeeds"""
+        health = endpoint.get_health()
+        try:
+            self.probe(self.load_balancer, endpoint, self.probe_timeout)
+        except Exception:
+            with self.lock:
+                circuit = self.circuits[endpoint]
+                circuit.probe_count += 1
+                circuit.failed_probe_count += 1
+                circuit.probe_interval = min(
+                    circuit.probe_interval * 2, self.max_probe_interval)
+                circuit.next_probe_time = time.monotonic() + circuit.probe_interval
+            return False
+        with self.lock:
+            self.circuits[endpoint].probe_count += 1
+        if circuit_state(health, self.load_balancer.failure_threshold) == OPEN and endpoint.half_open(health):
+            self.update(endpoint, "probe succeeded")
+            self.load_balancer.refresh_health()
+        return True
+
+    def run_once(self):
+        """Probes the endpoints whose probe is due. Returns the number of seconds until the next probe is due, or None if no circuit is open."""
+        # Refreshing the health half opens the circuits whose cooldown_period has passed
+        self.load_balancer.get_health()
+        next_probe_times = []
+        for endpoint in self.load_balancer.api_endpoints:
+            if self.update(endpoint, "changed elsewhere") != OPEN:
+                continue
+            with self.lock:
+                next_probe_time = self.circuits[endpoint].next_probe_time
+            if next_probe_time is not None and time.monotonic() >= next_probe_time:
+                self.probe_endpoint(endpoint)
+                with self.lock:
+                    next_probe_time = self.circuits[endpoint].next_probe_time
+            if self.circuits[endpoint].state == OPEN and next_probe_time is not None:
+                next_probe_times.append(next_probe_time)
+        if not next_probe_times:
+            return None
+        return max(min(next_probe_times) - time.monotonic(), 0.0)
+
+    def run(self):
+        while not self.stopped:
+            wait_time = self.run_once()
+            # Without open circuits, only check now and then whether another process opened one
+            self.wakeup.wait(self.max_probe_interval if wait_time is None else wait_time)
+            self.wakeup.clear()
+
+    def start(self):
+        """Starts the prober thread, unless it is running"""
+        with self.lock:
+            if self.thread is not None or self.stopped:
+                self.wakeup.set()
+                return
+            self.thread = threading.Thread(
+                target=self.run, name="openai-load-balancer-prober", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the prober thread"""
+        self.stopped = True
+        self.wakeup.set()
+
+    def stats(self):
+        """Returns the state of each endpoint's circuit, how often it tripped and was probed, and the number of seconds until its next probe"""
+        now = time.monotonic()
+        names = endpoint_names(self.load_balancer.api_endpoints)
+        with self.lock:
+            return {names[endpoint]: {
+                "state": circuit.state,
+                "trips": circuit.trip_count,
+                "last_trip_time": circuit.last_trip_time,
+                "probes": circuit.probe_count,
+                "failed_probes": circuit.failed_probe_count,
+                "next_probe_in": max(circuit.next_probe_time - now, 0.0) if circuit.state == OPEN and circuit.next_probe_time is not None else None,
+            } for endpoint, circuit in self.circuits.items() if endpoint in names}
+
+    def get_history(self, name=None):
+        """Returns the recorded changes of state, oldest first, of every endpoint or of the endpoint with the passed in name"""
+        with self.lock:
+            return [dict(change) for change in self.history if name is None or change["endpoint"] == name]
@@ -0,0 +1,44 @@
+import base64
+from collections import namedtuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for return_format="numpy"
+    np = None
+
+RETURN_FORMATS = ("numpy",)
+
+# The embeddings of a request as one contiguous float32 matrix with a row per input, in input order, and the usage and model of the response
+EmbeddingArray = namedtuple("EmbeddingArray", ["embeddings", "usage", "model"])
+
+
+def check_return_format(return_format):
+    if return_format not in RETURN_FORMATS:
+        raise ValueError(
+            f"Unknown return_format {return_format!r}. Choose one of {', '.join(RETURN_FORMATS)}.")
+    if np is None:
+        raise ImportError(
+            'return_format="numpy" needs numpy. Install it with pip install numpy.')
+
+
+def decode_embedding(embedding):
+    """Returns a float32 vector of an embedding, which is either a base64 string of little endian float32s or a list of floats, if the endpoint doesn't support encoding_format="base64". The base64 string is read with np.frombuffer, so its values never become Python floats."""
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def to_embedding_array(response):
+    """Returns the embeddings of the response as an EmbeddingArray. Each vector is copied once, from the decoded bytes into its row of the matrix."""
+    data = response["data"]
+    usage = response.get("usage")
+    model = response.get("model")
+    if not data:
+        return EmbeddingArray(np.empty((0, 0), dtype=np.float32), usage, model)
+    rows = sorted(data, key=lambda item: item["index"])
+    first_row = decode_embedding(rows[0]["embedding"])
+    embeddings = np.empty((len(rows), len(first_row)), dtype=np.float32)
+    embeddings[0] = first_row
+    for i, item in enumerate(rows[1:], 1):
+        embeddings[i] = decode_embedding(item["embedding"])
+    return EmbeddingArray(embeddings, usage, model)
@@ -0,0 +1,373 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from openai_load_balancer.api_endpoint import EndpointHealth, HEALTHY
+from openai_load_balancer.rate_limiter import TokenBucket
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class HealthStateBackend:
+    """Stores the failure state and rate limit budget of endpoints outside of the ApiEndpoint objects, so that several LoadBalancers, usually one per worker process, share one cooldown state and one set of rate limits. Endpoints are identified by their name. By default, each LoadBalancer keeps this state in its own process instead. Subclass it, and EndpointState, to keep the state in an external store."""
+
+    def endpoint_state(self, name, requests_per_minute=None, tokens_per_minute=None):
+        """Returns the EndpointState of the endpoint with the passed in name and rate limits, creating it if no process has used it yet"""
+        raise NotImplementedError
+
+    def version(self):
+        """Returns a number that changes whenever an endpoint fails or is reset, in any process, so that load balancers know when to rebuild their health snapshot"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class EndpointState:
+    """The shared failure state and rate limit budget of one endpoint. Health is an EndpointHealth, and times are time.monotonic() values, which are the same for every process on a host. Every method has to be atomic across processes."""
+
+    def get_health(self):
+        raise NotImplementedError
+
+    def set_health(self, **fields):
+        """Replaces the passed in fields of the endpoint's health"""
+        raise NotImplementedError
+
+    def compare_and_set_health(self, expected, health):
+        """Replaces the endpoint's health with health if it is still expected. Returns whether it was replaced."""
+        raise NotImplementedError
+
+    def mark_failed(self):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def total_cooldown_time(self):
+        raise NotImplementedError
+
+    def has_capacity(self, tokens=0):
+        raise NotImplementedError
+
+    def try_acquire(self, tokens=0):
+        raise NotImplementedError
+
+    def time_until_capacity(self, tokens=0):
+        raise NotImplementedError
+
+    def throttle(self, seconds):
+        raise NotImplementedError
+
+    def record_usage(self, tokens):
+        """Takes tokens from the endpoint's token budget, or gives them back if tokens is negative"""
+        raise NotImplementedError
+
+
+# The layout of the state file: a header, followed by one fixed size slot per endpoint
+HEADER = struct.Struct("<8sqq")  # magic, version, slot count
+MAGIC = b"OLBHS\x00\x00\x02"
+# Name digest, sequence number, failure count, last failed time, cooldown started time, cooldown time, throttled until time,
+# request bucket tokens and update time, token bucket tokens and update time, half open successes. Times and counts that aren't set are NaN.
+SLOT = struct.Struct("<16sqq9d")
+SEQUENCE = struct.Struct("<q")
+SEQUENCE_OFFSET = 16
+# The fields after the sequence number, which are written while it is odd
+PAYLOAD = struct.Struct("<q9d")
+PAYLOAD_OFFSET = 24
+VERSION_OFFSET = 8
+NOT_SET = float("nan")
+
+
+def to_time(value):
+    return None if math.isnan(value) else value
+
+
+def from_time(value):
+    return NOT_SET if value is None else value
+
+
+class MmapHealthState(HealthStateBackend):
+    """Shares the endpoints' state between the processes on a host through a memory-mapped file at path, e.g. between gunicorn workers. Every process has to use the same path, endpoint names and rate limits. Updates take a thread lock and an fcntl lock on the endpoint's slot of the file, so that updates to different endpoints don't wait for each other, and reads take no lock: each slot has a sequence number that is odd while it is being written, and readers retry if it changed while they read. The file has room for max_endpoints endpoints. Only available on POSIX systems."""
+
+    def __init__(self, path, max_endpoints=64):
+        if fcntl is None:
+            raise Exception("MmapHealthState needs fcntl, which is only available on POSIX systems.")
+        self.path = path
+        self.max_endpoints = max_endpoints
+        self.size = HEADER.size + max_endpoints * SLOT.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # fcntl locks are held per process, so threads of this process also need a lock. Each slot has its own, and the header has this one.
+        self.header_lock = self.locked(0, HEADER.size)
+        with self.header_lock:
+            if os.fstat(self.fd).st_size < self.size:
+                os.ftruncate(self.fd, self.size)
+            self.mmap = mmap.mmap(self.fd, self.size)
+            magic, _, slot_count = HEADER.unpack_from(self.mmap, 0)
+            if magic != MAGIC:
+                # A new file, or one with the slot layout of another version, which starts over
+                self.mmap[:] = bytes(self.size)
+                HEADER.pack_into(self.mmap, 0, MAGIC, 0, max_endpoints)
+            elif slot_count != max_endpoints:
+                raise ValueError(
+                    f"The health state file {path} was created with max_endpoints={slot_count}.")
+        self.states = {}
+
+    def locked(self, start, length):
+        """Returns a lock on length bytes of the file at start, for the threads of this process and other processes"""
+        return FileLock(self.fd, threading.Lock(), start, length)
+
+    def endpoint_state(self, name, requests_per_minute=None, tokens_per_minute=None):
+        if name in self.states:
+            return self.states[name]
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=16).digest()
+        # Slots are only claimed while holding the header's lock. Locking the whole file instead would release the slot locks of other threads of this process when unlocked, since fcntl locks are held per process.
+        with self.header_lock:
+            if name in self.states:
+                return self.states[name]
+            for index in range(self.max_endpoints):
+                offset = HEADER.size + index * SLOT.size
+                slot_digest = SLOT.unpack_from(self.mmap, offset)[0]
+                if slot_digest == digest:
+                    break
+                if slot_digest == bytes(16):
+                    now = time.monotonic()
+                    SLOT.pack_into(self.mmap, offset, digest, 0, 0, NOT_SET, NOT_SET, 0.0, NOT_SET,
+                                   float(requests_per_minute or 0), now, float(tokens_per_minute or 0), now, NOT_SET)
+                    break
+            else:
+                raise Exception(
+                    f"The health state file {self.path} has no room for more than {self.max_endpoints} endpoints.")
+            # Created under the lock, so that every thread uses the slot's one thread lock
+            state = self.states[name] = MmapEndpointState(
+                self, offset, requests_per_minute, tokens_per_minute)
+        return state
+
+    def version(self):
+        return SEQUENCE.unpack_from(self.mmap, VERSION_OFFSET)[0]
+
+    def increment_version(self):
+        with self.header_lock:
+            SEQUENCE.pack_into(self.mmap, VERSION_OFFSET, self.version() + 1)
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+
+class FileLock:
+    """Holds a thread lock and an fcntl lock on length bytes of the file at start"""
+
+    def __init__(self, fd, thread_lock, start, length):
+        self.fd = fd
+        self.thread_lock = thread_lock
+        self.start = start
+        self.length = length
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, self.length, self.start)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.length, self.start)
+        finally:
+            self.thread_lock.release()
+
+
+class MmapEndpointState(EndpointState):
+    """An endpoint's slot in an MmapHealthState file"""
+
+    def __init__(self, backend, offset, requests_per_minute=None, tokens_per_minute=None):
+        self.backend = backend
+        self.mmap = backend.mmap
+        self.offset = offset
+        # Reused to compute the rate limits, with the tokens loaded from and stored to the slot
+        self.request_bucket = TokenBucket(
+            requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(
+            tokens_per_minute) if tokens_per_minute else None
+        self.lock = backend.locked(offset, SLOT.size)
+
+    # How many times a reader retries while the slot is being written, before it waits for the writer's lock. A slot stays odd if its writer died while writing it.
+    READ_ATTEMPTS = 100
+
+    def read(self, locked=False):
+        """Reads the slot without a lock, retrying while another thread or process writes it. Pass locked=True while holding the slot's lock."""
+        if not locked:
+            for _ in range(self.READ_ATTEMPTS):
+                sequence = SEQUENCE.unpack_from(
+                    self.mmap, self.offset + SEQUENCE_OFFSET)[0]
+                values = SLOT.unpack_from(self.mmap, self.offset)
+                if sequence % 2 == 0 and values[1] == sequence and SEQUENCE.unpack_from(self.mmap, self.offset + SEQUENCE_OFFSET)[0] == sequence:
+                    return list(values)
+                time.sleep(0)
+            with self.lock:
+                return self.read(locked=True)
+        return list(SLOT.unpack_from(self.mmap, self.offset))
+
+    def write(self, values):
+        """Writes the slot. Must be called while holding the slot's lock."""
+        # Odd while the slot is being written
+        sequence = values[1] | 1
+        SEQUENCE.pack_into(self.mmap, self.offset + SEQUENCE_OFFSET, sequence)
+        PAYLOAD.pack_into(self.mmap, self.offset +
+                          PAYLOAD_OFFSET, *values[2:])
+        # Even again once the whole payload is written, so readers never see a new sequence number with old fields
+        values[1] = sequence + 1
+        SEQUENCE.pack_into(self.mmap, self.offset +
+                           SEQUENCE_OFFSET, values[1])
+
+    @staticmethod
+    def health(values):
+        return EndpointHealth(values[2], to_time(values[3]), to_time(values[4]),
+                              None if math.isnan(values[11]) else int(values[11]))
+
+    @staticmethod
+    def set_values(values, health):
+        values[2] = health.failure_count
+        values[3] = from_time(health.last_failed_time)
+        values[4] = from_time(health.cooldown_started_time)
+        values[11] = NOT_SET if health.half_open_successes is None else float(
+            health.half_open_successes)
+
+    def get_health(self):
+        return self.health(self.read())
+
+    def set_health(self, **fields):
+        with self.lock:
+            values = self.read(locked=True)
+            self.set_values(values, self.health(values)._replace(**fields))
+            self.write(values)
+        self.backend.increment_version()
+
+    def compare_and_set_health(self, expected, health):
+        with self.lock:
+            values = self.read(locked=True)
+            if self.health(values) != expected:
+                return False
+            if health == HEALTHY and not math.isnan(values[4]):
+                # Adds the cooldown that just ended to the cooldown time
+                values[5] += time.monotonic() - values[4]
+            self.set_values(values, health)
+            self.write(values)
+        if health.failure_count != expected.failure_count or (health.half_open_successes is None) != (expected.half_open_successes is None):
+            # The endpoint went into or out of cooldown, or was half opened
+            self.backend.increment_version()
+        return True
+
+    def mark_failed(self):
+        with self.lock:
+            values = self.read(locked=True)
+            values[2] += 1
+            values[3] = time.monotonic()
+            values[11] = NOT_SET
+            self.write(values)
+        self.backend.increment_version()
+
+    def reset(self):
+        if self.get_health() == HEALTHY:
+            return
+        with self.lock:
+            values = self.read(locked=True)
+            if not math.isnan(values[4]):
+                values[5] += time.monotonic() - values[4]
+            self.set_values(values, HEALTHY)
+            self.write(values)
+        self.backend.increment_version()
+
+    def total_cooldown_time(self):
+        values = self.read()
+        if math.isnan(values[4]):
+            return values[5]
+        return values[5] + time.monotonic() - values[4]
+
+    def load_buckets(self, values):
+        if self.request_bucket is not None:
+            self.request_bucket.tokens, self.request_bucket.updated_time = values[7], values[8]
+        if self.token_bucket is not None:
+            self.token_bucket.tokens, self.token_bucket.updated_time = values[9], values[10]
+
+    def store_buckets(self, values):
+        if self.request_bucket is not None:
+            values[7], values[8] = self.request_bucket.tokens, self.request_bucket.updated_time
+        if self.token_bucket is not None:
+            values[9], values[10] = self.token_bucket.tokens, self.token_bucket.updated_time
+
+    def _has_capacity(self, values, tokens):
+        if not math.isnan(values[6]) and time.monotonic() < values[6]:
+            return False
+        if self.request_bucket is not None and not self.request_bucket.has_capacity(1):
+            return False
+        if self.token_bucket is not None and not self.token_bucket.has_capacity(tokens):
+            return False
+        return True
+
+    def has_capacity(self, tokens=0):
+        if self.request_bucket is None and self.token_bucket is None:
+            # Only the throttle applies, which can be read without the lock
+            throttled_until = self.read()[6]
+            return math.isnan(throttled_until) or time.monotonic() >= throttled_until
+        with self.lock:
+            values = self.read(locked=True)
+            self.load_buckets(values)
+            return self._has_capacity(values, tokens)
+
+    def try_acquire(self, tokens=0):
+        if self.request_bucket is None and self.token_bucket is None:
+            return self.has_capacity(tokens)
+        with self.lock:
+            values = self.read(locked=True)
+            self.load_buckets(values)
+            if not self._has_capacity(values, tokens):
+                return False
+            if self.request_bucket is not None:
+                self.request_bucket.consume(1)
+            if self.token_bucket is not None:
+                self.token_bucket.consume(tokens)
+            self.store_buckets(values)
+            self.write(values)
+            return True
+
+    def time_until_capacity(self, tokens=0):
+        with self.lock:
+            values = self.read(locked=True)
+            self.load_buckets(values)
+            wait_time = 0.0
+            if not math.isnan(values[6]):
+                wait_time = max(values[6] - time.monotonic(), 0.0)
+            if self.request_bucket is not None:
+                wait_time = max(
+                    wait_time, self.request_bucket.time_until_available(1))
+            if self.token_bucket is not None:
+                wait_time = max(
+                    wait_time, self.token_bucket.time_until_available(tokens))
+            return wait_time
+
+    def throttle(self, seconds):
+        with self.lock:
+            values = self.read(locked=True)
+            throttled_until = time.monotonic() + seconds
+            if math.isnan(values[6]) or throttled_until > values[6]:
+                values[6] = throttled_until
+                self.write(values)
+
+    def record_usage(self, tokens):
+        if self.token_bucket is None:
+            return
+        with self.lock:
+            values = self.read(locked=True)
+            self.load_buckets(values)
+            self.token_bucket.consume(tokens)
+            self.store_buckets(values)
+            self.write(values)
@@ -0,0 +1,55 @@
+import threading
+
+
+class HedgingPolicy:
+    """Decides when a hedged request sends a backup request to a second endpoint, and keeps the hedging metrics. A backup request is sent once the primary request has been in flight for longer than delay seconds or, if delay is None, longer than the primary endpoint's live latency percentile. At most max_hedge_ratio of hedged requests send a backup request, which bounds the extra cost."""
+
+    def __init__(self, delay=None, percentile=0.95, min_samples=20, max_hedge_ratio=0.05, max_workers=64):
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        # The number of threads used to run the primary and backup requests of synchronous hedged requests
+        self.max_workers = max_workers
+        self.request_count = 0
+        self.hedge_count = 0
+        self.hedge_win_count = 0
+        self.lock = threading.Lock()
+
+    def hedge_delay(self, endpoint):
+        """Returns the number of seconds to wait for the passed in primary endpoint before sending a backup request, or None if there aren't enough latency samples to know yet"""
+        if self.delay is not None:
+            return self.delay
+        return endpoint.latency_percentile(self.percentile, self.min_samples)
+
+    def record_request(self):
+        with self.lock:
+            self.request_count += 1
+
+    def try_start_hedge(self):
+        """Returns True, and counts the hedge, if sending another backup request stays within max_hedge_ratio"""
+        with self.lock:
+            if self.hedge_count >= self.max_hedge_ratio * self.request_count:
+                return False
+            self.hedge_count += 1
+            return True
+
+    def cancel_hedge(self):
+        """Uncounts a hedge that couldn't be sent, e.g. because there was no other active endpoint"""
+        with self.lock:
+            self.hedge_count -= 1
+
+    def record_hedge_win(self):
+        with self.lock:
+            self.hedge_win_count += 1
+
+    def stats(self):
+        """Returns the number of hedged requests, how many of them sent a backup request and how often the backup request answered first"""
+        with self.lock:
+            return {
+                "requests": self.request_count,
+                "hedges": self.hedge_count,
+                "hedge_wins": self.hedge_win_count,
+                "hedge_rate": self.hedge_count / self.request_count if self.request_count else 0.0,
+                "hedge_win_rate": self.hedge_win_count / self.hedge_count if self.hedge_count else 0.0,
+            }
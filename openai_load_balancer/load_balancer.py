@@ -1,101 +1,670 @@
-import os
 import dotenv
 import openai
 from openai_load_balancer.api_endpoint import ApiEndpoint
-from tenacity import retry, wait_random_exponential, stop_after_attempt
+from openai_load_balancer.strategies import get_strategy, AdaptiveWeightPolicy
+from openai_load_balancer.rate_limiter import estimate_tokens
+from openai_load_balancer.hedging import HedgingPolicy
+from openai_load_balancer.streaming import StreamedResponse, AsyncStreamedResponse, finish_abandoned_streams
+from openai_load_balancer.retry_policy import RetryPolicy, RequestAttempts, RATE_LIMITED, DO_NOT_RETRY
+from openai_load_balancer.metrics import MetricsRegistry, SUCCESS, CANCELLED, to_prometheus
+from openai_load_balancer.circuit_breaker import CircuitBreaker
+import asyncio
+import functools
 import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 dotenv.load_dotenv()
 
+# Maps the method names used by OpenAILoadBalancer to the OpenAI API resource that serves them
+API_RESOURCES = {
+    'completion_create': openai.Completion,
+    'chat_completion_create': openai.ChatCompletion,
+    'embedding_create': openai.Embedding,
+}
+
+# Which endpoints are active, and which of them serve each model. It is immutable and only replaced when an endpoint goes into cooldown or recovers, so requests can read it without a lock.
+# model_endpoints maps each model that an endpoint declared to the active endpoints that serve it, and default_endpoints are the active endpoints that serve every model.
+# version is the version of the shared health state the snapshot was built from, if the endpoints share their state with other processes.
+# half_open_endpoints are the active endpoints whose circuit is half open, which only get a trickle of requests.
+HealthSnapshot = namedtuple(
+    "HealthSnapshot", ["endpoints", "active_endpoints", "inactive_endpoints", "model_endpoints", "default_endpoints", "serves_every_model", "version", "half_open_endpoints"])
+
 
 class LoadBalancer:
-    def __init__(self, endpoint_configs, failure_threshold, cooldown_period, load_balancing_enabled=True, model_engine_mapping=None):
+    def __init__(self, endpoint_configs, failure_threshold, cooldown_period, load_balancing_enabled=True, model_engine_mapping=None, strategy=None, rate_limit_queue_size=100, rate_limit_queue_timeout=60, hedging_policy=None, retry_policy=None, metrics=None, adaptive_weights=False, health_state=None, scheduler=None, circuit_breaker=None):
         """Initializes the load balancer with the passed in endpoint configurations and other configs"""
         self.api_endpoints = [ApiEndpoint(**config)
                               for config in endpoint_configs]
-        self.current_index = 0
+        # Shares the endpoints' failure state and rate limits with the load balancers of other processes, if set
+        self.health_state = health_state
+        if health_state is not None:
+            names = [endpoint.name for endpoint in self.api_endpoints]
+            if len(set(names)) != len(names):
+                raise ValueError(
+                    "Endpoints need unique names to share their state.")
+            for endpoint in self.api_endpoints:
+                endpoint.share_state(health_state)
+        # Lowers the weight of endpoints that answer with 429s, if enabled
+        self.adaptive_weights = AdaptiveWeightPolicy() if adaptive_weights is True else (
+            adaptive_weights or None)
+        if strategy is None and (self.adaptive_weights is not None or any(endpoint.weight != 1 for endpoint in self.api_endpoints)):
+            # Endpoints with different weights are balanced by weight
+            strategy = "weighted_round_robin"
+        self.strategy = get_strategy(strategy)
+        self.has_priorities = any(
+            endpoint.priority != 0 for endpoint in self.api_endpoints)
         self.failure_threshold = failure_threshold
         self.cooldown_period = cooldown_period
+        # Also decides how the endpoints are split into priority tiers
         self.load_balancing_enabled = load_balancing_enabled
-        self.model_engine_mapping = model_engine_mapping
-        self.lock = threading.Lock()  # Lock for thread safety
+        self.model_engine_mapping = model_engine_mapping or {}
+        # Maps Azure engine and deployment names back to OpenAI model names. It is built once, so rewriting requests doesn't build dicts.
+        self.engine_model_mapping = {
+            engine: model for model, engine in self.model_engine_mapping.items()}
+        for endpoint in self.api_endpoints:
+            for model, deployment in endpoint.deployments.items():
+                self.engine_model_mapping.setdefault(deployment, model)
+        # Only taken to replace the health snapshot, selecting an endpoint doesn't need it
+        self.lock = threading.Lock()
+        # Token estimates are only needed when at least one endpoint has a tokens_per_minute limit
+        self.token_limited = any(
+            endpoint.token_bucket is not None for endpoint in self.api_endpoints)
+        # Bounds the number of callers waiting for rate limit budget when every endpoint is saturated
+        self.rate_limit_queue = threading.BoundedSemaphore(
+            rate_limit_queue_size)
+        self.rate_limit_queue_timeout = rate_limit_queue_timeout
+        # Bounds the number of requests in flight and queues the rest by priority, if set
+        self.scheduler = scheduler
+        self.hedging_policy = hedging_policy or HedgingPolicy()
+        self.hedging_executor = None
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.metrics = metrics or MetricsRegistry()
+        # Probes endpoints in cooldown and lets them recover through a half open state, if set, instead of waiting for the cooldown_period
+        self.circuit_breaker = CircuitBreaker() if circuit_breaker is True else (
+            circuit_breaker or None)
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.attach(self)
+        self.refresh_health()
 
-    def get_next_active_endpoint(self):
-        """Gets the next active endpoint to use. If load balancing is disabled, always returns the first endpoint, unless the first endpoint is in_active, then proceeds to find the next one. If load balancing is enabled, returns the next active endpoint."""
-        with self.lock:  # Acquire lock for thread-safe access
-            if not self.load_balancing_enabled:
-                # If load balancing is disabled, always try the first active endpoint
-                if self.api_endpoints[0].is_active(self.failure_threshold, self.cooldown_period):
-                    return self.api_endpoints[0]
-                else:
-                    # If the first endpoint is inactive, proceed to find the next active one
-                    self.current_index = 1
+    @property
+    def load_balancing_enabled(self):
+        return self._load_balancing_enabled
 
-            for _ in range(len(self.api_endpoints)):
-                # get the current endpoint
-                endpoint = self.api_endpoints[self.current_index]
+    @load_balancing_enabled.setter
+    def load_balancing_enabled(self, load_balancing_enabled):
+        """Without load balancing, every endpoint gets its own priority tier, in list order within its priority, so the first available endpoint is always used"""
+        self._load_balancing_enabled = load_balancing_enabled
+        # Priority tiers are only computed if they split the endpoints, so the endpoints otherwise share one tier
+        self.prioritized = self.has_priorities or not load_balancing_enabled
+        self.priority_tiers = {}
 
-                # Increment the current index (so the next time we call this function, we'll get the next endpoint in the list). If we've reached the end of the list, loop back to the beginning
-                self.current_index = (
-                    self.current_index + 1) % len(self.api_endpoints)
+    def is_endpoint_active(self, endpoint):
+        return endpoint.is_active(self.failure_threshold, self.cooldown_period, self.circuit_breaker is not None)
 
-                if endpoint.is_active(self.failure_threshold, self.cooldown_period):
-                    return endpoint
+    def refresh_health(self):
+        """Rebuilds the health snapshot from the endpoints' current state"""
+        with self.lock:
+            # Read first, so that changes made while the snapshot is built rebuild it again
+            version = self.health_state.version() if self.health_state is not None else None
+            endpoints = self.api_endpoints
+            active = [self.is_endpoint_active(endpoint)
+                      for endpoint in endpoints]
+            active_endpoints = tuple(endpoint for endpoint, is_active in zip(
+                endpoints, active) if is_active)
+            models = {model for endpoint in endpoints if endpoint.models is not None
+                      for model in endpoint.models}
+            self.health = HealthSnapshot(
+                endpoints,
+                active_endpoints,
+                tuple(endpoint for endpoint, is_active in zip(
+                    endpoints, active) if not is_active),
+                {model: tuple(endpoint for endpoint in active_endpoints if endpoint.models is None or model in endpoint.models)
+                 for model in models},
+                tuple(
+                    endpoint for endpoint in active_endpoints if endpoint.models is None),
+                any(endpoint.models is None for endpoint in endpoints),
+                version,
+                frozenset(endpoint for endpoint in active_endpoints if endpoint.get_health().half_open_successes is not None)
+                if self.circuit_breaker is not None else frozenset())
+            self.priority_tiers = {}
+            return self.health
+
+    def get_health(self):
+        """Returns the health snapshot. It is rebuilt if api_endpoints was replaced, an endpoint in cooldown has recovered, or another process changed the shared health state, which only costs anything while an endpoint is in cooldown."""
+        health = self.health
+        if health.endpoints is not self.api_endpoints or (health.inactive_endpoints and any(self.is_endpoint_active(endpoint) for endpoint in health.inactive_endpoints)) or (
+                health.version is not None and health.version != self.health_state.version()):
+            health = self.refresh_health()
+        return health
+
+    def request_model(self, kwargs):
+        """Returns the OpenAI model name of the request, whether it names the model or an Azure engine, or None if it names neither"""
+        model = kwargs.get("model")
+        if model is None:
+            engine = kwargs.get("engine") or kwargs.get("deployment_id")
+            if engine is not None:
+                return self.engine_model_mapping.get(engine, engine)
+        return model
 
+    def get_model_endpoints(self, model=None):
+        """Returns the active endpoints that serve the model, or every active endpoint if model is None"""
+        health = self.get_health()
+        if model is None:
+            return health.active_endpoints
+        endpoints = health.model_endpoints.get(model)
+        if endpoints is not None:
+            return endpoints
+        if not health.serves_every_model:
+            raise Exception(f"No endpoint serves the model {model}.")
+        return health.default_endpoints
+
+    def get_priority_tiers(self, endpoints):
+        """Groups the endpoints by priority, lowest priority number first. If load balancing is disabled, every endpoint is a tier of its own, in list order within its priority."""
+        priority_tiers = self.priority_tiers
+        tiers = priority_tiers.get(endpoints)
+        if tiers is None:
+            if not self.load_balancing_enabled:
+                # sorted is stable, so endpoints with the same priority stay in list order
+                tiers = tuple((endpoint,) for endpoint in (sorted(endpoints, key=lambda endpoint: endpoint.priority)
+                                                          if self.has_priorities else endpoints))
+            else:
+                priorities = sorted(
+                    {endpoint.priority for endpoint in endpoints})
+                tiers = tuple(tuple(endpoint for endpoint in endpoints if endpoint.priority == priority)
+                              for priority in priorities)
+            priority_tiers[endpoints] = tiers
+        return tiers
+
+    def select_endpoint(self, endpoints, is_available, affinity_key=None):
+        if affinity_key is not None:
+            return self.strategy.select(endpoints, is_available, affinity_key)
+        return self.strategy.select(endpoints, is_available)
+
+    def get_next_active_endpoint(self, tokens=0, exclude=(), model=None, is_allowed=None, affinity_key=None):
+        """Gets the next active endpoint to use, other than the endpoints in exclude and the endpoints is_allowed returns False for, and takes the budget for a request using the passed in number of tokens from its rate limits. If load balancing is disabled, always returns the first endpoint, unless the first endpoint is in_active or out of budget, then proceeds to find the next one. If load balancing is enabled, the selection strategy picks one of the active endpoints with budget left, by the request's affinity_key from the strategy's request_affinity if it has one. If endpoints have priorities, endpoints with a higher priority number are only used when no endpoint with a lower one is available. If a model is passed in, only endpoints that serve it are used. Returns None if there are active endpoints, but none of them has budget left. Takes no lock, unless an endpoint has rate limits."""
+        if self.adaptive_weights is not None and self.adaptive_weights.update(self.api_endpoints):
+            self.strategy.weights_changed()
+        endpoints = self.get_model_endpoints(model)
+        if not endpoints or (exclude and all(endpoint in exclude for endpoint in endpoints)):
             # If we've tried all endpoints and none are active, raise an exception
             raise Exception("All endpoints are inactive.")
+        tiers = self.get_priority_tiers(
+            endpoints) if self.prioritized else (endpoints,)
+        # Endpoints whose budget was taken by another request between selecting and acquiring it
+        raced_endpoints = ()
 
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(5))
-    def send_request(self, endpoint, method_name, **kwargs):
-        """Calls OpenAI's API with the corresponding method and arguments to the passed in endpoint. If it fails, raises an exception"""
-        # openai has a standard base_url, whereas for azure we'll read it from the environment variable
-        openai.api_base = str(os.getenv(
-            endpoint.base_url)) if endpoint.api_type == "azure" else endpoint.base_url
-        openai.api_version = endpoint.version
-        openai.api_key = str(os.getenv(endpoint.api_key_env))
-        openai.api_type = endpoint.api_type
+        half_open_endpoints = self.health.half_open_endpoints
+        half_open_requests = self.circuit_breaker.half_open_requests if self.circuit_breaker is not None else 1
+
+        def is_available(endpoint):
+            return endpoint not in exclude and endpoint not in raced_endpoints and (is_allowed is None or is_allowed(endpoint)) and endpoint.has_capacity(tokens) and (
+                # Half open endpoints only get a trickle of requests until they have proven they recovered
+                not half_open_endpoints or endpoint not in half_open_endpoints or endpoint.in_flight < half_open_requests)
+
+        for _ in range(len(endpoints)):
+            endpoint = None
+            for tier in tiers:
+                endpoint = self.select_endpoint(
+                    tier, is_available, affinity_key)
+                if endpoint is not None:
+                    break
+            if endpoint is None:
+                return None
+            if endpoint.try_acquire(tokens):
+                return endpoint
+            raced_endpoints = set(raced_endpoints) | {endpoint}
+        return None
 
-        model_engine_mapping = self.model_engine_mapping or {}
+    def get_endpoint(self, name):
+        """Returns the endpoint with the passed in name"""
+        for endpoint in self.api_endpoints:
+            if endpoint.name == name:
+                return endpoint
+        raise ValueError(f"Unknown endpoint {name!r}.")
+
+    def set_weight(self, endpoint, weight):
+        """Changes the weight of an endpoint, or of the endpoint with the passed in name, while requests keep flowing. A weight of 0 drains the endpoint: it only gets requests when no other endpoint is available."""
+        if weight < 0:
+            raise ValueError("Endpoint weights can't be negative.")
+        if isinstance(endpoint, str):
+            endpoint = self.get_endpoint(endpoint)
+        endpoint.weight = weight
+        endpoint.effective_weight = weight
+        self.strategy.weights_changed()
+
+    def has_untried_endpoint(self, tokens=0, exclude=(), model=None):
+        """Checks if there is an active endpoint serving the model with rate limit budget that isn't in exclude"""
+        return any(endpoint not in exclude and endpoint.has_capacity(tokens)
+                   for endpoint in self.get_model_endpoints(model))
+
+    def time_until_capacity(self, tokens=0, model=None):
+        """Returns the number of seconds until one of the active endpoints serving the model has rate limit budget for a request using the passed in number of tokens"""
+        return min((endpoint.time_until_capacity(tokens) for endpoint in self.get_model_endpoints(model)), default=0.0)
+
+    def reserve_endpoint(self, tokens=0, exclude=(), timeout=None, model=None, affinity_key=None):
+        """Returns the next active endpoint with rate limit budget for the request, other than the endpoints in exclude. If every active endpoint is out of budget, waits in the bounded rate limit queue until budget returns, for at most timeout seconds if passed in."""
+        endpoint = self.get_next_active_endpoint(
+            tokens, exclude, model, affinity_key=affinity_key)
+        if endpoint is not None:
+            return endpoint
+        if not self.rate_limit_queue.acquire(blocking=False):
+            raise Exception(
+                "All endpoints are rate limited and the rate limit queue is full.")
+        try:
+            deadline = time.monotonic() + min(self.rate_limit_queue_timeout,
+                                              timeout if timeout is not None else self.rate_limit_queue_timeout)
+            while True:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    raise Exception(
+                        "Timed out waiting for rate limit budget.")
+                time.sleep(min(max(self.time_until_capacity(
+                    tokens, model), 0.01), remaining_time))
+                endpoint = self.get_next_active_endpoint(
+                    tokens, exclude, model, affinity_key=affinity_key)
+                if endpoint is not None:
+                    return endpoint
+        finally:
+            self.rate_limit_queue.release()
+
+    async def areserve_endpoint(self, tokens=0, exclude=(), timeout=None, model=None, affinity_key=None):
+        """Async version of reserve_endpoint, which waits for rate limit budget without blocking the event loop"""
+        endpoint = self.get_next_active_endpoint(
+            tokens, exclude, model, affinity_key=affinity_key)
+        if endpoint is not None:
+            return endpoint
+        if not self.rate_limit_queue.acquire(blocking=False):
+            raise Exception(
+                "All endpoints are rate limited and the rate limit queue is full.")
+        try:
+            deadline = time.monotonic() + min(self.rate_limit_queue_timeout,
+                                              timeout if timeout is not None else self.rate_limit_queue_timeout)
+            while True:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    raise Exception(
+                        "Timed out waiting for rate limit budget.")
+                await asyncio.sleep(min(max(self.time_until_capacity(tokens, model), 0.01), remaining_time))
+                endpoint = self.get_next_active_endpoint(
+                    tokens, exclude, model, affinity_key=affinity_key)
+                if endpoint is not None:
+                    return endpoint
+        finally:
+            self.rate_limit_queue.release()
+
+    def schedule_endpoint(self, tokens=0, exclude=(), timeout=None, model=None, priority=None, affinity_key=None):
+        """Like reserve_endpoint, but if the load balancer has a scheduler, waits for a free slot in the scheduler's queue instead. The slot has to be given back once the request has finished."""
+        if self.scheduler is not None:
+            return self.scheduler.acquire(self, tokens, exclude, timeout, model, priority, affinity_key)
+        return self.reserve_endpoint(tokens, exclude, timeout, model, affinity_key)
+
+    async def aschedule_endpoint(self, tokens=0, exclude=(), timeout=None, model=None, priority=None, affinity_key=None):
+        """Async version of schedule_endpoint"""
+        if self.scheduler is not None:
+            return await self.scheduler.aacquire(self, tokens, exclude, timeout, model, priority, affinity_key)
+        return await self.areserve_endpoint(tokens, exclude, timeout, model, affinity_key)
+
+    def record_usage(self, endpoint, tokens, response):
+        """Corrects the endpoint's token budget with the token usage reported in the response"""
+        if not self.token_limited:
+            return
+        usage = response.get("usage") if isinstance(
+            response, dict) else None
+        if usage and "total_tokens" in usage:
+            endpoint.record_usage(tokens, usage["total_tokens"])
+
+    def prepare_request(self, endpoint, **kwargs):
+        """Returns the request arguments adjusted for the endpoint's api_type, including the endpoint's credentials. The global openai configuration is never modified, so concurrent requests to different endpoints can't use each other's keys or urls."""
+        kwargs.update(endpoint.client_kwargs())
 
         # Adjust arguments for Azure
         if endpoint.api_type == "azure":
-            # In Azure, instead of using the model keyword, you use the engine keyword. Get the appropriate engine name for the passed in model
-            if "model" in kwargs:
-                engine_name = model_engine_mapping.get(
-                    kwargs["model"], kwargs["model"])
-                kwargs["engine"] = engine_name
-                del kwargs["model"]
+            # In Azure, instead of using the model keyword, you use the engine keyword. Get the endpoint's engine name for the passed in model, or for the model of the passed in engine, as engine names can differ between endpoints
+            model = kwargs.pop("model", None)
+            engine = kwargs.pop("engine", None) or kwargs.pop(
+                "deployment_id", None)
+            if model is None and engine is not None:
+                model = self.engine_model_mapping.get(engine, engine)
+            if model is not None:
+                kwargs["engine"] = endpoint.deployments.get(
+                    model) or self.model_engine_mapping.get(model, model)
         if endpoint.api_type == "open_ai":
             # Do the same for switching from Azure engine to OpenAI model
-            if "engine" in kwargs:
-                # since MODEL_ENGINE_MAPPING is a dict going from model -> engine, we need to invert it to get engine -> model
-                model_name = {v: k for k, v in model_engine_mapping.items()}.get(
-                    kwargs["engine"], kwargs["engine"])
-                kwargs["model"] = model_name
-                del kwargs["engine"]
+            engine = kwargs.pop("engine", None) or kwargs.pop(
+                "deployment_id", None)
+            if engine is not None and "model" not in kwargs:
+                kwargs["model"] = self.engine_model_mapping.get(engine, engine)
+        return kwargs
+
+    def send_request(self, endpoint, method_name, **kwargs):
+        """Calls OpenAI's API with the corresponding method and arguments to the passed in endpoint. If it fails, raises an exception. The endpoint's state is updated by send_to_endpoint, as a streamed response hasn't succeeded yet when this returns."""
+        kwargs = self.prepare_request(endpoint, **kwargs)
         # Map method_name to the actual OpenAI function
-        if method_name == 'completion_create':
-            response = openai.Completion.create(**kwargs)
-        elif method_name == 'chat_completion_create':
-            response = openai.ChatCompletion.create(**kwargs)
-        elif method_name == 'embedding_create':
-            response = openai.Embedding.create(**kwargs)
-
-        endpoint.failure_count = 0  # Reset on successful request
+        response = API_RESOURCES[method_name].create(**kwargs)
         return response
 
-    def try_send_request(self, method_name, **kwargs):
-        """Try to send the request to active endpoints. If it fails, mark as failed and try the next active endpoint."""
-        for _ in range(len(self.api_endpoints)):
-            endpoint = self.get_next_active_endpoint()
+    async def asend_request(self, endpoint, method_name, **kwargs):
+        """Async version of send_request. Uses OpenAI's acreate calls through the endpoint's pooled aiohttp session, and waits between retries without blocking the event loop"""
+        kwargs = self.prepare_request(endpoint, **kwargs)
+        # openai.aiosession is a context variable, so setting it only affects the current task
+        token = openai.aiosession.set(await endpoint.aget_aiohttp_session())
+        try:
+            response = await API_RESOURCES[method_name].acreate(**kwargs)
+        finally:
+            openai.aiosession.reset(token)
+        return response
+
+    def record_failure(self, endpoint, exception):
+        """Marks the endpoint as failed, unless the failure wasn't the endpoint's fault. If the endpoint is rate limiting us, it isn't used until its Retry-After has passed."""
+        if self.retry_policy.classify(exception) == RATE_LIMITED:
+            endpoint.throttle(self.retry_policy.retry_after(
+                exception) or self.retry_policy.min_backoff)
+            if self.adaptive_weights is not None:
+                self.adaptive_weights.record_rate_limit(endpoint)
+        if self.retry_policy.counts_as_failure(exception):
+            # Mark the endpoint as failed
+            endpoint.mark_failed()
+            if not self.is_endpoint_active(endpoint) and endpoint in self.health.active_endpoints:
+                # This failure reached the failure_threshold, or failed a half open endpoint, so stop sending requests to the endpoint
+                self.refresh_health()
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.update(
+                        endpoint, f"request failed with {type(exception).__name__}")
+
+    def record_success(self, endpoint):
+        """Resets the endpoint after a successful request. If the endpoint's circuit is half open, it only closes after the circuit breaker's success_threshold successful requests in a row."""
+        if self.circuit_breaker is None:
+            endpoint.reset()
+            return
+        if endpoint.record_success(self.circuit_breaker.success_threshold) and endpoint in self.health.half_open_endpoints:
+            # The endpoint has recovered, so it gets every request it is picked for again
+            self.refresh_health()
+            self.circuit_breaker.update(endpoint, "trial requests succeeded")
+
+    def record_outcome(self, endpoint, method_name, kwargs, latency, response=None, exception=None, completed=True):
+        """Records the outcome of a request sent to the endpoint in the metrics. Failed requests are counted under the retry policy's classification of their error, and requests the caller cancelled or stopped reading as cancelled."""
+        if exception is None:
+            outcome = SUCCESS if completed else CANCELLED
+        elif isinstance(exception, Exception):
+            outcome = self.retry_policy.classify(exception)
+        else:
+            outcome = CANCELLED
+        self.metrics.record_request(
+            endpoint, method_name, kwargs, outcome, latency, response)
+
+    def finish_stream(self, endpoint, method_name, kwargs, latency, exception=None, completed=True, scheduled=False):
+        """Records the outcome of a streamed response once the stream ends. An error in the middle of the stream counts as a failure of the endpoint. A scheduled stream holds its scheduler slot until it ends."""
+        if scheduled:
+            self.scheduler.release(endpoint)
+        if exception is not None:
+            self.record_failure(endpoint, exception)
+        elif completed:
+            self.record_success(endpoint)
+        self.record_outcome(endpoint, method_name, kwargs,
+                            latency, exception=exception, completed=completed)
+
+    def send_to_endpoint(self, endpoint, method_name, tokens=0, scheduled=False, **kwargs):
+        """Sends the request to the passed in endpoint once and records the outcome on the endpoint. If it fails, records the failure and raises the exception. If scheduled, gives back the request's scheduler slot once it has finished."""
+        if self.metrics.before_request_hooks:
+            self.metrics.before_request(endpoint, method_name, kwargs)
+        endpoint.start_request()
+        start_time = time.monotonic()
+        try:
+            response = self.send_request(endpoint, method_name, **kwargs)
+            if kwargs.get("stream"):
+                # Wait for the first chunk, so that a failure before anything was received can still fail over to the next endpoint
+                first_chunk = next(response, None)
+        except BaseException as e:
+            endpoint.finish_request()
+            if scheduled:
+                self.scheduler.release(endpoint)
+            # Give back the tokens, failed requests don't count against the endpoint's quota
+            endpoint.record_usage(tokens, 0)
+            if isinstance(e, Exception):
+                self.record_failure(endpoint, e)
+            self.record_outcome(endpoint, method_name, kwargs,
+                                time.monotonic() - start_time, exception=e)
+            raise
+        if kwargs.get("stream"):
+            return StreamedResponse(endpoint, response, first_chunk, start_time, functools.partial(self.finish_stream, endpoint, method_name, kwargs, scheduled=scheduled))
+        # Record the latency so latency-aware strategies can use it, and reset the endpoint on a successful request
+        latency = time.monotonic() - start_time
+        endpoint.finish_request(latency)
+        if scheduled:
+            self.scheduler.release(endpoint)
+        self.record_usage(endpoint, tokens, response)
+        self.record_success(endpoint)
+        self.record_outcome(endpoint, method_name, kwargs, latency, response)
+        return response
+
+    async def asend_to_endpoint(self, endpoint, method_name, tokens=0, scheduled=False, **kwargs):
+        """Async version of send_to_endpoint. If the task is cancelled, the endpoint isn't marked as failed."""
+        if self.metrics.before_request_hooks:
+            self.metrics.before_request(endpoint, method_name, kwargs)
+        endpoint.start_request()
+        start_time = time.monotonic()
+        try:
+            response = await self.asend_request(endpoint, method_name, **kwargs)
+            if kwargs.get("stream"):
+                # Wait for the first chunk, so that a failure before anything was received can still fail over to the next endpoint
+                try:
+                    first_chunk = await response.__anext__()
+                except StopAsyncIteration:
+                    first_chunk = None
+        except BaseException as e:
+            endpoint.finish_request()
+            if scheduled:
+                self.scheduler.release(endpoint)
+            # Give back the tokens, failed requests don't count against the endpoint's quota
+            endpoint.record_usage(tokens, 0)
+            if isinstance(e, Exception):
+                self.record_failure(endpoint, e)
+            self.record_outcome(endpoint, method_name, kwargs,
+                                time.monotonic() - start_time, exception=e)
+            raise
+        if kwargs.get("stream"):
+            return AsyncStreamedResponse(endpoint, response, first_chunk, start_time, functools.partial(self.finish_stream, endpoint, method_name, kwargs, scheduled=scheduled))
+        # Record the latency so latency-aware strategies can use it, and reset the endpoint on a successful request
+        latency = time.monotonic() - start_time
+        endpoint.finish_request(latency)
+        if scheduled:
+            self.scheduler.release(endpoint)
+        self.record_usage(endpoint, tokens, response)
+        self.record_success(endpoint)
+        self.record_outcome(endpoint, method_name, kwargs, latency, response)
+        return response
+
+    def try_send_request(self, method_name, timeout=None, priority=None, affinity_key=None, **kwargs):
+        """Try to send the request to active endpoints. If it fails, fail over to the next active endpoint that hasn't failed yet. Once every endpoint has failed, back off and retry them if the errors were transient or rate limits, within the limits of the retry policy. Errors that no endpoint could fix, such as invalid requests, are raised right away. If a timeout (in seconds) is passed in, it bounds the whole request, including waiting in the scheduler's queue or for rate limits, backoffs and failovers. priority is the request's priority class in the scheduler's queue. affinity_key routes the request with the affinity strategy: requests with the same key go to the same endpoint while it is available."""
+        finish_abandoned_streams()
+        attempts = RequestAttempts(
+            self.retry_policy, len(self.api_endpoints), timeout)
+        tokens = estimate_tokens(
+            method_name, kwargs) if self.token_limited else 0
+        model = self.request_model(kwargs)
+        affinity_key = self.strategy.request_affinity(
+            method_name, kwargs, affinity_key)
+        while True:
+            if attempts.failed_endpoints and not self.has_untried_endpoint(tokens, attempts.failed_endpoints, model):
+                backoff = attempts.start_retry()
+                if backoff is None:
+                    break
+                self.metrics.record_retry()
+                time.sleep(backoff)
+            elif attempts.failed_endpoints:
+                self.metrics.record_failover()
+            endpoint = self.schedule_endpoint(
+                tokens, attempts.failed_endpoints, attempts.remaining_time(), model, priority, affinity_key)
+            try:
+                return self.send_to_endpoint(endpoint, method_name, tokens, self.scheduler is not None, **attempts.request_kwargs(kwargs))
+            except Exception as e:
+                attempts.record_failure(endpoint, e)
+            if attempts.exhausted():
+                break
+
+        # If all endpoints have been tried and failed, raise an exception
+        raise attempts.error() from attempts.last_error
 
+    async def atry_send_request(self, method_name, timeout=None, priority=None, affinity_key=None, **kwargs):
+        """Async version of try_send_request. Endpoint selection only holds the lock briefly and never across an await, so it is safe to call from many tasks on the same event loop."""
+        finish_abandoned_streams()
+        attempts = RequestAttempts(
+            self.retry_policy, len(self.api_endpoints), timeout)
+        tokens = estimate_tokens(
+            method_name, kwargs) if self.token_limited else 0
+        model = self.request_model(kwargs)
+        affinity_key = self.strategy.request_affinity(
+            method_name, kwargs, affinity_key)
+        while True:
+            if attempts.failed_endpoints and not self.has_untried_endpoint(tokens, attempts.failed_endpoints, model):
+                backoff = attempts.start_retry()
+                if backoff is None:
+                    break
+                self.metrics.record_retry()
+                await asyncio.sleep(backoff)
+            elif attempts.failed_endpoints:
+                self.metrics.record_failover()
+            endpoint = await self.aschedule_endpoint(
+                tokens, attempts.failed_endpoints, attempts.remaining_time(), model, priority, affinity_key)
             try:
-                response = self.send_request(endpoint, method_name, **kwargs)
-                # Reset the endpoint on a successful request
-                endpoint.reset()
-                return response
+                return await self.asend_to_endpoint(endpoint, method_name, tokens, self.scheduler is not None, **attempts.request_kwargs(kwargs))
             except Exception as e:
-                # Mark the endpoint as failed
-                endpoint.mark_failed()
+                attempts.record_failure(endpoint, e)
+            if attempts.exhausted():
+                break
 
         # If all endpoints have been tried and failed, raise an exception
-        raise Exception("All endpoints failed.")
+        raise attempts.error() from attempts.last_error
+
+    def get_hedging_executor(self):
+        with self.lock:
+            if self.hedging_executor is None:
+                self.hedging_executor = ThreadPoolExecutor(
+                    max_workers=self.hedging_policy.max_workers, thread_name_prefix="openai-load-balancer-hedge")
+            return self.hedging_executor
+
+    def get_backup_endpoint(self, tokens, primary_endpoint, model=None, affinity_key=None):
+        """Returns an active endpoint other than the primary endpoint for the backup request of a hedged request, and takes the budget for it. Returns None if there is none, in which case the hedged request just waits for the primary endpoint."""
+        if not self.has_untried_endpoint(tokens, {primary_endpoint}, model):
+            return None
+        return self.get_next_active_endpoint(tokens, exclude={primary_endpoint}, model=model, affinity_key=affinity_key)
+
+    def try_send_hedged_request(self, method_name, timeout=None, priority=None, affinity_key=None, **kwargs):
+        """Like try_send_request, but if the endpoint hasn't answered within the hedging policy's delay, sends the same request to a different active endpoint as well. The first successful response is returned. If both requests fail, falls back to try_send_request. Hedged requests are latency sensitive and bounded by the hedging policy, so they skip the scheduler's queue, unless they fall back."""
+        finish_abandoned_streams()
+        policy = self.hedging_policy
+        policy.record_request()
+        attempts = RequestAttempts(
+            self.retry_policy, len(self.api_endpoints), timeout)
+        request_kwargs = attempts.request_kwargs(kwargs)
+        tokens = estimate_tokens(
+            method_name, kwargs) if self.token_limited else 0
+        model = self.request_model(kwargs)
+        request_affinity = self.strategy.request_affinity(
+            method_name, kwargs, affinity_key)
+        primary_endpoint = self.reserve_endpoint(
+            tokens, timeout=attempts.remaining_time(), model=model, affinity_key=request_affinity)
+        executor = self.get_hedging_executor()
+        futures = {executor.submit(
+            self.send_to_endpoint, primary_endpoint, method_name, tokens, **request_kwargs)}
+        done, _ = wait(futures, timeout=policy.hedge_delay(primary_endpoint))
+        backup_future = None
+        if not done and policy.try_start_hedge():
+            backup_endpoint = self.get_backup_endpoint(
+                tokens, primary_endpoint, model, request_affinity)
+            if backup_endpoint is None:
+                policy.cancel_hedge()
+            else:
+                backup_future = executor.submit(
+                    self.send_to_endpoint, backup_endpoint, method_name, tokens, **request_kwargs)
+                futures.add(backup_future)
+
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None and self.retry_policy.classify(future.exception()) == DO_NOT_RETRY:
+                    raise future.exception()
+                if future.exception() is None:
+                    if future is backup_future:
+                        policy.record_hedge_win()
+                    # The loser can't be interrupted once it has been sent, but its response is discarded
+                    for loser in futures:
+                        loser.cancel()
+                    return future.result()
+
+        # Both requests failed, so fail over as usual
+        return self.try_send_request(method_name, timeout=attempts.remaining_time(), priority=priority, affinity_key=affinity_key, **kwargs)
+
+    async def atry_send_hedged_request(self, method_name, timeout=None, priority=None, affinity_key=None, **kwargs):
+        """Async version of try_send_hedged_request. The request that loses the race is cancelled."""
+        finish_abandoned_streams()
+        policy = self.hedging_policy
+        policy.record_request()
+        attempts = RequestAttempts(
+            self.retry_policy, len(self.api_endpoints), timeout)
+        request_kwargs = attempts.request_kwargs(kwargs)
+        tokens = estimate_tokens(
+            method_name, kwargs) if self.token_limited else 0
+        model = self.request_model(kwargs)
+        request_affinity = self.strategy.request_affinity(
+            method_name, kwargs, affinity_key)
+        primary_endpoint = await self.areserve_endpoint(tokens, timeout=attempts.remaining_time(), model=model, affinity_key=request_affinity)
+        tasks = {asyncio.ensure_future(self.asend_to_endpoint(
+            primary_endpoint, method_name, tokens, **request_kwargs))}
+        backup_task = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=policy.hedge_delay(primary_endpoint))
+            if not done and policy.try_start_hedge():
+                backup_endpoint = self.get_backup_endpoint(
+                    tokens, primary_endpoint, model, request_affinity)
+                if backup_endpoint is None:
+                    policy.cancel_hedge()
+                else:
+                    backup_task = asyncio.ensure_future(self.asend_to_endpoint(
+                        backup_endpoint, method_name, tokens, **request_kwargs))
+                    tasks.add(backup_task)
+
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None and self.retry_policy.classify(task.exception()) == DO_NOT_RETRY:
+                        raise task.exception()
+                    if task.exception() is None:
+                        if task is backup_task:
+                            policy.record_hedge_win()
+                        return task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Both requests failed, so fail over as usual
+        return await self.atry_send_request(method_name, timeout=attempts.remaining_time(), priority=priority, affinity_key=affinity_key, **kwargs)
+
+    def get_metrics(self):
+        """Returns a snapshot of the load balancer's metrics: requests, latency histograms and token usage by endpoint and model, in flight requests and cooldown time of each endpoint, retries, failovers, hedging and, if the load balancer has them, the scheduler's queue and the state of each endpoint's circuit"""
+        finish_abandoned_streams()
+        snapshot = self.metrics.snapshot(self.api_endpoints)
+        snapshot["hedging"] = self.hedging_policy.stats()
+        if self.scheduler is not None:
+            snapshot["scheduler"] = self.scheduler.stats()
+        if self.circuit_breaker is not None:
+            snapshot["circuit_breaker"] = self.circuit_breaker.stats()
+        return snapshot
+
+    def get_prometheus_metrics(self):
+        """Returns the load balancer's metrics in the Prometheus text exposition format"""
+        return to_prometheus(self.get_metrics())
+
+    def close(self):
+        """Shuts down the threads used for hedged requests and the circuit breaker's prober"""
+        if self.hedging_executor is not None:
+            self.hedging_executor.shutdown(wait=False)
+            self.hedging_executor = None
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.stop()
+
+    async def aclose(self):
+        """Closes the pooled aiohttp sessions of every endpoint. Call this before the event loop that made async requests is closed."""
+        for endpoint in self.api_endpoints:
+            await endpoint.aclose()
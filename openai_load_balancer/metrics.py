@@ -0,0 +1,241 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Outcomes of a request sent to an endpoint, besides the retry policy's classification of the error it failed with
+SUCCESS = "success"
+# The caller cancelled the request or stopped reading the stream, which says nothing about the endpoint
+CANCELLED = "cancelled"
+# The Prometheus values of the circuit breaker's states
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, like a Prometheus histogram"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        cumulative_counts = []
+        total = 0
+        for count in self.counts[:-1]:
+            total += count
+            cumulative_counts.append(total)
+        return {
+            "buckets": dict(zip(self.buckets, cumulative_counts)),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+def endpoint_names(endpoints):
+    """Returns the name of each endpoint. Endpoints that share a name are told apart by their position in the list."""
+    name_counts = defaultdict(int)
+    for endpoint in endpoints:
+        name_counts[endpoint.name] += 1
+    return {endpoint: endpoint.name if name_counts[endpoint.name] == 1 else f"{endpoint.name}#{index}"
+            for index, endpoint in enumerate(endpoints)}
+
+
+def model_name(kwargs):
+    return kwargs.get("model") or kwargs.get("engine") or kwargs.get("deployment_id") or ""
+
+
+class MetricsRegistry:
+    """Collects the metrics of a load balancer: requests by endpoint, model and outcome, request latency histograms, retries, failovers and token usage. In flight requests and cooldown time are read from the endpoints when a snapshot is taken. Hooks registered with add_before_request_hook and add_after_request_hook are called around every request sent to an endpoint, and cost nothing when none are registered."""
+
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS):
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self.lock = threading.Lock()
+        # Keyed by (endpoint, model, outcome)
+        self.request_counts = defaultdict(int)
+        # Keyed by (endpoint, model)
+        self.latency_histograms = {}
+        self.prompt_tokens = defaultdict(int)
+        self.completion_tokens = defaultdict(int)
+        self.retry_count = 0
+        self.failover_count = 0
+        self.before_request_hooks = []
+        self.after_request_hooks = []
+
+    def add_before_request_hook(self, hook):
+        """Registers hook(endpoint, method_name, kwargs), which is called before every request sent to an endpoint"""
+        self.before_request_hooks.append(hook)
+
+    def add_after_request_hook(self, hook):
+        """Registers hook(endpoint, method_name, kwargs, outcome, latency, response), which is called after every request sent to an endpoint. For a streamed response it is called once the stream ends, with the time to the first chunk as latency and no response."""
+        self.after_request_hooks.append(hook)
+
+    def before_request(self, endpoint, method_name, kwargs):
+        for hook in self.before_request_hooks:
+            hook(endpoint, method_name, kwargs)
+
+    def record_request(self, endpoint, method_name, kwargs, outcome, latency, response=None):
+        """Records the outcome of a request sent to the endpoint. Failed requests are counted under the retry policy's classification of their error."""
+        model = model_name(kwargs)
+        usage = response.get("usage") if isinstance(response, dict) else None
+        with self.lock:
+            self.request_counts[(endpoint, model, outcome)] += 1
+            if outcome != CANCELLED:
+                histogram = self.latency_histograms.get((endpoint, model))
+                if histogram is None:
+                    histogram = self.latency_histograms[(endpoint, model)] = Histogram(
+                        self.latency_buckets)
+                histogram.observe(latency)
+            if usage:
+                self.prompt_tokens[(endpoint, model)] += usage.get("prompt_tokens") or 0
+                self.completion_tokens[(endpoint, model)] += usage.get(
+                    "completion_tokens") or 0
+        for hook in self.after_request_hooks:
+            hook(endpoint, method_name, kwargs, outcome, latency, response)
+
+    def record_retry(self):
+        """Records that every endpoint failed and the request is retried after a backoff"""
+        with self.lock:
+            self.retry_count += 1
+
+    def record_failover(self):
+        """Records that a request failed on one endpoint and is sent to another"""
+        with self.lock:
+            self.failover_count += 1
+
+    def snapshot(self, endpoints):
+        """Returns the metrics of the passed in endpoints as a dict, keyed by endpoint name"""
+        names = endpoint_names(endpoints)
+        snapshot = {"retries": 0, "failovers": 0, "endpoints": {}}
+        for endpoint, name in names.items():
+            snapshot["endpoints"][name] = {
+                "in_flight": endpoint.in_flight,
+                "failure_count": endpoint.failure_count,
+                "in_cooldown": endpoint.cooldown_started_time is not None,
+                "cooldown_seconds": endpoint.total_cooldown_time(),
+                "requests": defaultdict(dict),
+                "latency": {},
+                "tokens": {},
+            }
+        with self.lock:
+            snapshot["retries"] = self.retry_count
+            snapshot["failovers"] = self.failover_count
+            for (endpoint, model, outcome), count in self.request_counts.items():
+                if endpoint in names:
+                    snapshot["endpoints"][names[endpoint]
+                                          ]["requests"][model][outcome] = count
+            for (endpoint, model), histogram in self.latency_histograms.items():
+                if endpoint in names:
+                    snapshot["endpoints"][names[endpoint]
+                                          ]["latency"][model] = histogram.snapshot()
+            for key in self.prompt_tokens.keys() | self.completion_tokens.keys():
+                endpoint, model = key
+                if endpoint in names:
+                    snapshot["endpoints"][names[endpoint]]["tokens"][model] = {
+                        "prompt": self.prompt_tokens.get(key, 0),
+                        "completion": self.completion_tokens.get(key, 0),
+                    }
+        for endpoint_snapshot in snapshot["endpoints"].values():
+            endpoint_snapshot["requests"] = dict(
+                endpoint_snapshot["requests"])
+        return snapshot
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(**labels):
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def to_prometheus(snapshot, prefix="openai_load_balancer"):
+    """Renders a snapshot returned by MetricsRegistry.snapshot in the Prometheus text exposition format"""
+    lines = []
+
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(
+                f"{prefix}_{name}{suffix}{format_labels(**labels) if labels else ''} {format_value(value)}")
+
+    endpoints = snapshot["endpoints"]
+    metric("requests_total", "counter", "Requests sent to each endpoint, by model and outcome.", [
+        ("", {"endpoint": endpoint, "model": model, "outcome": outcome}, count)
+        for endpoint, endpoint_snapshot in endpoints.items()
+        for model, outcomes in endpoint_snapshot["requests"].items()
+        for outcome, count in outcomes.items()])
+
+    latency_samples = []
+    for endpoint, endpoint_snapshot in endpoints.items():
+        for model, histogram in endpoint_snapshot["latency"].items():
+            labels = {"endpoint": endpoint, "model": model}
+            for upper_bound, count in histogram["buckets"].items():
+                latency_samples.append(
+                    ("_bucket", dict(labels, le=format_value(float(upper_bound))), count))
+            latency_samples.append(
+                ("_bucket", dict(labels, le="+Inf"), histogram["count"]))
+            latency_samples.append(("_sum", labels, histogram["sum"]))
+            latency_samples.append(("_count", labels, histogram["count"]))
+    metric("request_latency_seconds", "histogram",
+           "Latency of requests sent to each endpoint, or the time to the first chunk of streamed responses.", latency_samples)
+
+    metric("tokens_total", "counter", "Tokens used by each endpoint, as reported in the response usage.", [
+        ("", {"endpoint": endpoint, "model": model, "type": token_type}, tokens[token_type])
+        for endpoint, endpoint_snapshot in endpoints.items()
+        for model, tokens in endpoint_snapshot["tokens"].items()
+        for token_type in ("prompt", "completion")])
+    metric("in_flight_requests", "gauge", "Requests currently in flight to each endpoint.", [
+        ("", {"endpoint": endpoint}, endpoint_snapshot["in_flight"]) for endpoint, endpoint_snapshot in endpoints.items()])
+    metric("endpoint_in_cooldown", "gauge", "Whether the endpoint is in cooldown after reaching the failure threshold.", [
+        ("", {"endpoint": endpoint}, int(endpoint_snapshot["in_cooldown"])) for endpoint, endpoint_snapshot in endpoints.items()])
+    metric("cooldown_seconds_total", "counter", "Time each endpoint has spent in cooldown.", [
+        ("", {"endpoint": endpoint}, endpoint_snapshot["cooldown_seconds"]) for endpoint, endpoint_snapshot in endpoints.items()])
+    metric("retries_total", "counter", "Times every endpoint failed and the request was retried after a backoff.", [
+        ("", {}, snapshot["retries"])])
+    metric("failovers_total", "counter", "Times a request failed on one endpoint and was sent to another.", [
+        ("", {}, snapshot["failovers"])])
+    if "hedging" in snapshot:
+        hedging = snapshot["hedging"]
+        metric("hedged_requests_total", "counter", "Requests sent with hedging enabled.", [
+            ("", {}, hedging["requests"])])
+        metric("hedges_total", "counter", "Backup requests sent by hedged requests.", [
+            ("", {}, hedging["hedges"])])
+        metric("hedge_wins_total", "counter", "Backup requests that answered before the primary request.", [
+            ("", {}, hedging["hedge_wins"])])
+    if "scheduler" in snapshot:
+        scheduler = snapshot["scheduler"]
+        metric("scheduler_in_flight_requests", "gauge", "Requests holding a scheduler slot.", [
+            ("", {}, scheduler["in_flight"])])
+        metric("scheduler_queued_requests", "gauge", "Requests waiting in the scheduler's queue.", [
+            ("", {}, scheduler["queued"])])
+        metric("scheduler_rejected_requests_total", "counter", "Requests rejected because the scheduler's queue was full.", [
+            ("", {}, scheduler["rejected"])])
+        metric("scheduler_timed_out_requests_total", "counter", "Requests that timed out waiting in the scheduler's queue.", [
+            ("", {}, scheduler["timed_out"])])
+    if "circuit_breaker" in snapshot:
+        circuits = snapshot["circuit_breaker"]
+        metric("circuit_state", "gauge", "The state of each endpoint's circuit: 0 closed, 1 half open, 2 open.", [
+            ("", {"endpoint": endpoint}, CIRCUIT_STATE_VALUES[circuit["state"]]) for endpoint, circuit in circuits.items()])
+        metric("circuit_trips_total", "counter", "Times each endpoint's circuit opened.", [
+            ("", {"endpoint": endpoint}, circuit["trips"]) for endpoint, circuit in circuits.items()])
+        metric("circuit_probes_total", "counter", "Probes sent to each endpoint while its circuit was open, by result.", [
+            sample for endpoint, circuit in circuits.items() for sample in (
+                ("", {"endpoint": endpoint, "result": "success"}, circuit["probes"] - circuit["failed_probes"]),
+                ("", {"endpoint": endpoint, "result": "failure"}, circuit["failed_probes"]))])
+    return "\n".join(lines) + "\n"
@@ -1,30 +1,102 @@
 from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.batching import EmbeddingBatcher
+from openai_load_balancer.cache import ResponseCache
+from openai_load_balancer.single_flight import SingleFlight
+from openai_load_balancer.embedding_arrays import check_return_format, to_embedding_array
+
+
+class ApiResource:
+    """Base class for the OpenAI resources of OpenAILoadBalancer, which sends their requests through the load balancer"""
+    method_name = None
+
+    def __init__(self, load_balancer: LoadBalancer, cache: ResponseCache = None, single_flight: SingleFlight = None):
+        self.load_balancer = load_balancer
+        self.cache = cache
+        self.single_flight = single_flight
+
+    def create(self, hedge=False, **kwargs):
+        if self.cache is None or not self.cache.is_cacheable(self.method_name, kwargs):
+            return self.send_once(hedge, **kwargs)
+        key = self.cache.key(self.method_name, kwargs)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.send_once(hedge, **kwargs)
+            self.cache.set(key, response)
+        return response
+
+    async def acreate(self, hedge=False, **kwargs):
+        if self.cache is None or not self.cache.is_cacheable(self.method_name, kwargs):
+            return await self.asend_once(hedge, **kwargs)
+        key = self.cache.key(self.method_name, kwargs)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.asend_once(hedge, **kwargs)
+            self.cache.set(key, response)
+        return response
+
+    def send_once(self, hedge=False, **kwargs):
+        """Sends the request, unless an identical request is in flight, whose response it then shares"""
+        if self.single_flight is None:
+            return self.send(hedge, **kwargs)
+        return self.single_flight.do(self.method_name, kwargs, lambda: self.send(hedge, **kwargs), kwargs.get("timeout"))
+
+    async def asend_once(self, hedge=False, **kwargs):
+        if self.single_flight is None:
+            return await self.asend(hedge, **kwargs)
+        return await self.single_flight.ado(self.method_name, kwargs, lambda: self.asend(hedge, **kwargs), kwargs.get("timeout"))
+
+    def send(self, hedge=False, **kwargs):
+        if hedge:
+            return self.load_balancer.try_send_hedged_request(self.method_name, **kwargs)
+        return self.load_balancer.try_send_request(self.method_name, **kwargs)
+
+    async def asend(self, hedge=False, **kwargs):
+        if hedge:
+            return await self.load_balancer.atry_send_hedged_request(self.method_name, **kwargs)
+        return await self.load_balancer.atry_send_request(self.method_name, **kwargs)
 
 
 class OpenAILoadBalancer:
-    class ChatCompletion:
-        def __init__(self, load_balancer: LoadBalancer):
-            self.load_balancer = load_balancer
+    class ChatCompletion(ApiResource):
+        method_name = 'chat_completion_create'
+
+    class Completion(ApiResource):
+        method_name = 'completion_create'
 
-        def create(self, **kwargs):
-            return self.load_balancer.try_send_request('chat_completion_create', **kwargs)
+    class Embedding(ApiResource):
+        method_name = 'embedding_create'
 
-    class Completion:
-        def __init__(self, load_balancer: LoadBalancer):
-            self.load_balancer = load_balancer
+        def __init__(self, load_balancer: LoadBalancer, batcher: EmbeddingBatcher = None, cache: ResponseCache = None, single_flight: SingleFlight = None):
+            super().__init__(load_balancer, cache, single_flight)
+            self.batcher = batcher
 
-        def create(self, **kwargs):
-            return self.load_balancer.try_send_request('completion_create', **kwargs)
+        def create(self, hedge=False, return_format=None, **kwargs):
+            """Returns the embeddings response, or, with return_format="numpy", an EmbeddingArray of the embeddings as a float32 matrix. The numpy format asks the endpoint for base64 embeddings, which are decoded straight into the matrix instead of into lists of Python floats."""
+            if return_format is None:
+                return super().create(hedge, **kwargs)
+            check_return_format(return_format)
+            kwargs.setdefault("encoding_format", "base64")
+            return to_embedding_array(super().create(hedge, **kwargs))
 
-    class Embedding:
-        def __init__(self, load_balancer: LoadBalancer):
-            self.load_balancer = load_balancer
+        async def acreate(self, hedge=False, return_format=None, **kwargs):
+            if return_format is None:
+                return await super().acreate(hedge, **kwargs)
+            check_return_format(return_format)
+            kwargs.setdefault("encoding_format", "base64")
+            return to_embedding_array(await super().acreate(hedge, **kwargs))
 
-        def create(self, **kwargs):
-            return self.load_balancer.try_send_request('embedding_create', **kwargs)
+        def send(self, hedge=False, **kwargs):
+            if self.batcher is not None and not hedge:
+                return self.batcher.create(**kwargs)
+            return super().send(hedge, **kwargs)
 
-    def __init__(self, load_balancer: LoadBalancer):
+    def __init__(self, load_balancer: LoadBalancer, embedding_batcher: EmbeddingBatcher = None, response_cache: ResponseCache = None, single_flight: SingleFlight = None):
         self.load_balancer = load_balancer
-        self.ChatCompletion = OpenAILoadBalancer.ChatCompletion(load_balancer)
-        self.Completion = OpenAILoadBalancer.Completion(load_balancer)
-        self.Embedding = OpenAILoadBalancer.Embedding(load_balancer)
+        self.response_cache = response_cache
+        self.single_flight = single_flight
+        self.ChatCompletion = OpenAILoadBalancer.ChatCompletion(
+            load_balancer, response_cache, single_flight)
+        self.Completion = OpenAILoadBalancer.Completion(
+            load_balancer, response_cache, single_flight)
+        self.Embedding = OpenAILoadBalancer.Embedding(
+            load_balancer, embedding_batcher, response_cache, single_flight)
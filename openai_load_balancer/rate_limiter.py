@@ -0,0 +1,68 @@
+import time
+
+# Rough number of characters per token for English text, used to estimate request cost before sending
+CHARS_PER_TOKEN = 4
+# The number of completion tokens the API assumes when max_tokens isn't passed in
+DEFAULT_MAX_TOKENS = 16
+
+
+class TokenBucket:
+    """A token bucket that refills continuously up to per_minute tokens every minute. It is not thread safe on its own, the owning ApiEndpoint guards it with its lock."""
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = per_minute
+        self.refill_rate = per_minute / 60.0
+        self.clock = clock
+        self.tokens = float(per_minute)
+        self.updated_time = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_time) * self.refill_rate)
+        self.updated_time = now
+
+    def cost(self, amount):
+        # A request that costs more than the whole bucket would never fit, so it only has to wait for a full bucket
+        return min(amount, self.capacity)
+
+    def has_capacity(self, amount):
+        self.refill()
+        return self.tokens >= self.cost(amount)
+
+    def consume(self, amount):
+        """Removes amount tokens from the bucket. Pass a negative amount to give tokens back."""
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+    def time_until_available(self, amount):
+        """Returns the number of seconds until amount tokens will be available"""
+        self.refill()
+        return max(0.0, (self.cost(amount) - self.tokens) / self.refill_rate)
+
+
+def count_tokens(value):
+    """Estimates the number of tokens in a prompt, message list or embedding input"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value) // CHARS_PER_TOKEN + 1
+    if isinstance(value, int):
+        # Inputs can already be tokenized, in which case each int is a token
+        return 1
+    if isinstance(value, dict):
+        return sum(count_tokens(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(count_tokens(item) for item in value)
+    return 0
+
+
+def estimate_tokens(method_name, kwargs):
+    """Estimates the number of tokens a request will use, counting both the prompt and the maximum number of completion tokens"""
+    if method_name == 'embedding_create':
+        return count_tokens(kwargs.get("input"))
+    prompt = kwargs.get("messages") if method_name == 'chat_completion_create' else kwargs.get(
+        "prompt")
+    completion_tokens = (kwargs.get("max_tokens") or DEFAULT_MAX_TOKENS) * \
+        max(kwargs.get("n") or 1, kwargs.get("best_of") or 1)
+    return count_tokens(prompt) + completion_tokens
@@ -0,0 +1,141 @@
+import random
+import time
+from openai import error
+
+# What to do after a request failed
+# The endpoint is rate limiting us: fail over to another endpoint with capacity, or wait for Retry-After
+RATE_LIMITED = "rate_limited"
+# The endpoint is unavailable (5xx, timeout, connection error): fail over, and retry after a backoff once every endpoint has failed
+TRANSIENT = "transient"
+# An error we don't know to be transient: fail over, but don't retry endpoints that already failed
+UNKNOWN = "unknown"
+# The request itself is invalid (400) or isn't allowed (401, 403): no other endpoint will do better, so don't retry at all
+DO_NOT_RETRY = "do_not_retry"
+
+
+class RetryPolicy:
+    """Classifies failed requests and decides how long to back off before retrying. The backoff is random exponential between min_backoff and max_backoff seconds, at least the endpoint's Retry-After, and is never longer than what is left of the request's deadline. A request is sent at most max_attempts times, or once to every endpoint if there are more endpoints than that."""
+
+    def __init__(self, max_attempts=5, min_backoff=1, max_backoff=60, rng=None):
+        self.max_attempts = max_attempts
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.rng = rng or random.Random()
+
+    def classify(self, exception):
+        if isinstance(exception, error.RateLimitError):
+            return RATE_LIMITED
+        if isinstance(exception, (error.AuthenticationError, error.PermissionError, error.InvalidAPIType)):
+            return DO_NOT_RETRY
+        if isinstance(exception, (error.Timeout, error.APIConnectionError, error.ServiceUnavailableError, error.TryAgain)):
+            return TRANSIENT
+        if isinstance(exception, error.OpenAIError) and exception.http_status is not None:
+            if exception.http_status == 429:
+                return RATE_LIMITED
+            if exception.http_status >= 500 or exception.http_status in (408, 409):
+                return TRANSIENT
+            # A 404 usually means the endpoint doesn't have the model or deployment, which another endpoint might have
+            if exception.http_status == 404:
+                return UNKNOWN
+            return DO_NOT_RETRY
+        if isinstance(exception, error.APIError):
+            return TRANSIENT
+        return UNKNOWN
+
+    def counts_as_failure(self, exception):
+        """Returns whether the exception counts towards the endpoint's failure_threshold. Rate limits and invalid requests aren't the endpoint's fault."""
+        if self.classify(exception) == RATE_LIMITED:
+            return False
+        return not isinstance(exception, error.InvalidRequestError) or getattr(exception, "http_status", None) == 404
+
+    def retry_after(self, exception):
+        """Returns the number of seconds the endpoint asked us to wait in its Retry-After header, or None"""
+        headers = {key.lower(): value for key, value in (
+            getattr(exception, "headers", None) or {}).items()}
+        try:
+            if "retry-after-ms" in headers:
+                return float(headers["retry-after-ms"]) / 1000
+            if "retry-after" in headers:
+                return float(headers["retry-after"])
+        except (TypeError, ValueError):
+            pass
+        return None
+
+    def backoff(self, retry_number, retry_after=None, remaining_time=None):
+        """Returns the number of seconds to wait before the retry_number-th retry (starting at 0)"""
+        backoff = self.rng.uniform(0, min(self.max_backoff,
+                                          self.min_backoff * 2 ** retry_number))
+        backoff = min(max(backoff, self.min_backoff,
+                      retry_after or 0), self.max_backoff)
+        if remaining_time is not None:
+            backoff = min(backoff, max(remaining_time, 0))
+        return backoff
+
+
+class RequestAttempts:
+    """Tracks the attempts of a single request across endpoints and retries, and its deadline if it has a timeout (in seconds)"""
+
+    def __init__(self, policy, endpoint_count, timeout=None):
+        self.policy = policy
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_attempts = max(policy.max_attempts, endpoint_count)
+        self.attempt_count = 0
+        self.retry_count = 0
+        # Endpoints that failed since the last retry, which aren't tried again until every endpoint failed
+        self.failed_endpoints = set()
+        self.retryable = False
+        self.retry_after = None
+        self.last_error = None
+
+    def remaining_time(self):
+        """Returns the number of seconds left until the deadline, or None if there is no deadline"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def request_kwargs(self, kwargs):
+        """Returns the request arguments, with the request_timeout capped by the time left until the deadline"""
+        remaining_time = self.remaining_time()
+        if remaining_time is None:
+            return kwargs
+        request_timeout = kwargs.get("request_timeout")
+        return dict(kwargs, request_timeout=min(request_timeout, remaining_time) if request_timeout else remaining_time)
+
+    def record_failure(self, endpoint, exception):
+        """Records a failed attempt. Raises the exception again if the request shouldn't be retried at all."""
+        self.attempt_count += 1
+        self.last_error = exception
+        action = self.policy.classify(exception)
+        if action == DO_NOT_RETRY:
+            raise exception
+        self.failed_endpoints.add(endpoint)
+        if action in (TRANSIENT, RATE_LIMITED):
+            self.retryable = True
+        if action == RATE_LIMITED:
+            self.retry_after = max(self.retry_after or 0,
+                                   self.policy.retry_after(exception) or 0) or None
+
+    def exhausted(self):
+        return self.attempt_count >= self.max_attempts or self.remaining_time() == 0
+
+    def start_retry(self):
+        """Called once every endpoint has failed. Returns the number of seconds to back off before retrying them, or None if the request shouldn't be retried."""
+        if not self.retryable or self.exhausted():
+            return None
+        remaining_time = self.remaining_time()
+        backoff = self.policy.backoff(
+            self.retry_count, self.retry_after, remaining_time)
+        if remaining_time is not None and backoff >= remaining_time:
+            # There would be no time left to send the request after backing off
+            return None
+        self.retry_count += 1
+        self.failed_endpoints.clear()
+        self.retryable = False
+        self.retry_after = None
+        return backoff
+
+    def error(self):
+        """Returns the exception to raise once the request can't be retried anymore"""
+        if self.remaining_time() == 0:
+            return Exception("Request deadline exceeded.")
+        return Exception("All endpoints failed.")
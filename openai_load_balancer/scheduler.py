@@ -0,0 +1,276 @@
+import asyncio
+import bisect
+import itertools
+import math
+import threading
+import time
+
+# The built in priority classes, highest priority first
+INTERACTIVE = "interactive"
+BATCH = "batch"
+# How often a waiting request checks for a free slot when it isn't waiting for rate limit budget. Finished requests notify the waiting ones, so this only matters if something else, like an endpoint recovering from cooldown, freed capacity.
+POLL_INTERVAL = 0.1
+
+
+def set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Waiter:
+    """A request attempt waiting in the scheduler's queue. Waiters are ordered by priority, then by deadline, then by arrival."""
+
+    def __init__(self, key, load_balancer, tokens, exclude, model, rank, deadline, loop=None, affinity_key=None):
+        self.key = key
+        self.load_balancer = load_balancer
+        self.tokens = tokens
+        self.exclude = exclude
+        self.model = model
+        self.affinity_key = affinity_key
+        self.rank = rank
+        self.deadline = deadline
+        self.loop = loop
+        # Set once the waiter got an endpoint, or an error
+        self.done = False
+        self.endpoint = None
+        self.error = None
+        self.event = threading.Event() if loop is None else loop.create_future()
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def finish(self, endpoint=None, error=None):
+        self.done = True
+        self.endpoint = endpoint
+        self.error = error
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(set_result, self.event)
+
+
+class RequestScheduler:
+    """Bounds the number of requests in flight, in total (max_concurrency) and to each endpoint (max_endpoint_concurrency, a number or a dict mapping endpoint names to numbers), and queues the requests that don't fit. Queued requests get the next free slot in order of their priority class, highest first (priorities), then of their deadline, then of their arrival, so interactive requests overtake batch requests. reserved_concurrency of the max_concurrency slots can only be used by the highest priority class, so that it never waits for lower priority requests to finish. At most max_queue_size requests wait: when the queue is full, a request is rejected right away, unless a lower priority request is waiting, which is rejected instead. Requests wait at most until their timeout, and at most max_queue_time seconds (a number, or a dict mapping priority classes to numbers) if set. Each attempt of a request, including failovers and retries, is scheduled separately."""
+
+    def __init__(self, max_concurrency=None, max_endpoint_concurrency=None, max_queue_size=1000, priorities=(INTERACTIVE, BATCH), reserved_concurrency=0, max_queue_time=None):
+        self.max_concurrency = max_concurrency
+        self.max_endpoint_concurrency = max_endpoint_concurrency
+        self.max_queue_size = max_queue_size
+        self.priorities = tuple(priorities)
+        self.ranks = {priority: rank for rank,
+                      priority in enumerate(self.priorities)}
+        self.reserved_concurrency = reserved_concurrency
+        self.max_queue_time = max_queue_time
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.endpoint_in_flight = {}
+        # The waiting requests, kept sorted so the first one is served first
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.admitted_count = 0
+        self.queued_count = 0
+        self.rejected_count = 0
+        self.timed_out_count = 0
+
+    def rank(self, priority):
+        if priority is None:
+            return 0
+        if priority not in self.ranks:
+            raise ValueError(
+                f"Unknown priority {priority!r}. Choose one of {', '.join(self.priorities)}.")
+        return self.ranks[priority]
+
+    def endpoint_limit(self, endpoint):
+        if isinstance(self.max_endpoint_concurrency, dict):
+            return self.max_endpoint_concurrency.get(endpoint.name)
+        return self.max_endpoint_concurrency
+
+    def has_endpoint_slot(self, endpoint):
+        limit = self.endpoint_limit(endpoint)
+        return limit is None or self.endpoint_in_flight.get(endpoint, 0) < limit
+
+    def has_slot(self, rank):
+        if self.max_concurrency is None:
+            return True
+        return self.in_flight < self.max_concurrency - (self.reserved_concurrency if rank > 0 else 0)
+
+    def queue_deadline(self, priority, timeout):
+        """Returns the time.monotonic() time until which a request can wait in the queue, or None if it can wait forever"""
+        max_queue_time = self.max_queue_time.get(priority) if isinstance(
+            self.max_queue_time, dict) else self.max_queue_time
+        limits = [limit for limit in (timeout, max_queue_time)
+                  if limit is not None]
+        return time.monotonic() + min(limits) if limits else None
+
+    def _try_admit(self, load_balancer, tokens, exclude, model, rank, affinity_key=None):
+        """Takes a slot and returns an endpoint for the request, or None if there is no free slot. Must be called while holding the lock."""
+        if not self.has_slot(rank):
+            return None
+        endpoint = load_balancer.get_next_active_endpoint(
+            tokens, exclude, model, self.has_endpoint_slot if self.max_endpoint_concurrency is not None else None, affinity_key)
+        if endpoint is None:
+            return None
+        self.in_flight += 1
+        self.endpoint_in_flight[endpoint] = self.endpoint_in_flight.get(
+            endpoint, 0) + 1
+        self.admitted_count += 1
+        return endpoint
+
+    def _dispatch(self):
+        """Gives free slots to the waiting requests, in order. Must be called while holding the lock."""
+        finished = False
+        for waiter in self.waiters:
+            if not self.has_slot(0):
+                break
+            try:
+                endpoint = self._try_admit(
+                    waiter.load_balancer, waiter.tokens, waiter.exclude, waiter.model, waiter.rank, waiter.affinity_key)
+            except Exception as e:
+                waiter.finish(error=e)
+                finished = True
+                continue
+            if endpoint is not None:
+                waiter.finish(endpoint)
+                finished = True
+        if finished:
+            self.waiters = [
+                waiter for waiter in self.waiters if not waiter.done]
+
+    def _enqueue(self, load_balancer, tokens, exclude, model, priority, rank, timeout, loop=None, affinity_key=None):
+        """Adds a waiter to the queue, or raises if the queue is full. Must be called while holding the lock."""
+        if len(self.waiters) >= self.max_queue_size:
+            # Shed the lowest priority, most recent waiter, if it has a lower priority than this request
+            lowest = max(self.waiters, key=lambda waiter: (
+                waiter.rank, waiter.key[2]), default=None)
+            if lowest is None or lowest.rank <= rank:
+                self.rejected_count += 1
+                raise Exception("The request queue is full.")
+            self.waiters.remove(lowest)
+            self.rejected_count += 1
+            lowest.finish(error=Exception("The request queue is full."))
+        deadline = self.queue_deadline(priority, timeout)
+        waiter = Waiter((rank, deadline if deadline is not None else math.inf, next(self.sequence)),
+                        load_balancer, tokens, exclude, model, rank, deadline, loop, affinity_key)
+        bisect.insort(self.waiters, waiter)
+        self.queued_count += 1
+        return waiter
+
+    def _give_up(self, waiter):
+        """Removes a waiter that stopped waiting. Returns whether it was still waiting, otherwise it already got its endpoint or error. Must be called while holding the lock."""
+        if waiter.done:
+            return False
+        self.waiters.remove(waiter)
+        waiter.done = True
+        return True
+
+    def _wait_time(self, waiter):
+        """Returns how long to wait before checking again whether rate limit budget has returned, as nothing else notifies the waiter of that"""
+        try:
+            wait_time = waiter.load_balancer.time_until_capacity(
+                waiter.tokens, waiter.model)
+        except Exception:
+            wait_time = 0.0
+        wait_time = max(wait_time, 0.01) if wait_time > 0 else POLL_INTERVAL
+        if waiter.deadline is not None:
+            wait_time = min(wait_time, waiter.deadline - time.monotonic())
+        return wait_time
+
+    def acquire(self, load_balancer, tokens=0, exclude=(), timeout=None, model=None, priority=None, affinity_key=None):
+        """Returns an endpoint for the request once there is a free slot for it, waiting in the queue if necessary. The slot has to be given back with release."""
+        rank = self.rank(priority)
+        with self.lock:
+            if not self.waiters:
+                endpoint = self._try_admit(
+                    load_balancer, tokens, exclude, model, rank, affinity_key)
+                if endpoint is not None:
+                    return endpoint
+            waiter = self._enqueue(load_balancer, tokens, exclude, model,
+                                   priority, rank, timeout, affinity_key=affinity_key)
+            # Other requests may be waiting for slots this one doesn't need, e.g. on a busy endpoint, so it is admitted right away if it can be, in priority order
+            self._dispatch()
+            if waiter.done:
+                # It didn't have to wait after all
+                self.queued_count -= 1
+        try:
+            while not waiter.done:
+                wait_time = self._wait_time(waiter)
+                if wait_time > 0:
+                    waiter.event.wait(wait_time)
+                with self.lock:
+                    if waiter.done:
+                        break
+                    self._dispatch()
+                    if not waiter.done and waiter.deadline is not None and time.monotonic() >= waiter.deadline:
+                        self._give_up(waiter)
+                        self.timed_out_count += 1
+                        raise Exception(
+                            "Timed out waiting in the request queue.")
+        except BaseException:
+            with self.lock:
+                if not self._give_up(waiter) and waiter.endpoint is not None:
+                    self._release(waiter.endpoint)
+            raise
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.endpoint
+
+    async def aacquire(self, load_balancer, tokens=0, exclude=(), timeout=None, model=None, priority=None, affinity_key=None):
+        """Async version of acquire, which waits without blocking the event loop"""
+        rank = self.rank(priority)
+        with self.lock:
+            if not self.waiters:
+                endpoint = self._try_admit(
+                    load_balancer, tokens, exclude, model, rank, affinity_key)
+                if endpoint is not None:
+                    return endpoint
+            waiter = self._enqueue(load_balancer, tokens, exclude, model,
+                                   priority, rank, timeout, asyncio.get_running_loop(), affinity_key)
+            # Other requests may be waiting for slots this one doesn't need, e.g. on a busy endpoint, so it is admitted right away if it can be, in priority order
+            self._dispatch()
+            if waiter.done:
+                # It didn't have to wait after all
+                self.queued_count -= 1
+        try:
+            while not waiter.done:
+                wait_time = self._wait_time(waiter)
+                if wait_time > 0:
+                    await asyncio.wait([waiter.event], timeout=wait_time)
+                with self.lock:
+                    if waiter.done:
+                        break
+                    self._dispatch()
+                    if not waiter.done and waiter.deadline is not None and time.monotonic() >= waiter.deadline:
+                        self._give_up(waiter)
+                        self.timed_out_count += 1
+                        raise Exception(
+                            "Timed out waiting in the request queue.")
+        except BaseException:
+            with self.lock:
+                if not self._give_up(waiter) and waiter.endpoint is not None:
+                    self._release(waiter.endpoint)
+            raise
+        if waiter.error is not None:
+            raise waiter.error
+        return waiter.endpoint
+
+    def _release(self, endpoint):
+        self.in_flight -= 1
+        self.endpoint_in_flight[endpoint] -= 1
+        self._dispatch()
+
+    def release(self, endpoint):
+        """Gives back the slot of a request to the endpoint once it has finished, and passes it on to the next waiting request"""
+        with self.lock:
+            self._release(endpoint)
+
+    def stats(self):
+        """Returns the number of requests in flight and waiting, and how many were admitted, had to wait, were rejected because the queue was full or timed out waiting"""
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self.waiters),
+                "admitted": self.admitted_count,
+                "waited": self.queued_count,
+                "rejected": self.rejected_count,
+                "timed_out": self.timed_out_count,
+            }
@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import threading
+from openai_load_balancer.cache import is_deterministic, request_key
+
+
+class Call:
+    """A request in flight that identical requests wait for instead of sending their own"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Shares one upstream call between identical requests that are in flight at the same time: the first request is sent, and the requests that arrive while it is in flight wait for it and get its response, or its error. Requests are identical if they have the same request_key, so the same request to Azure and OpenAI endpoints is shared: Azure engine names are mapped back to OpenAI model names with the inverse of model_engine_mapping, or with engine_model_mapping if passed in. is_shareable(method_name, kwargs) decides which requests are shared, by default the deterministic ones, since callers of other requests expect their own sample. Nothing is kept once the call completes. Shared responses are the same object for every caller, so treat them as read-only."""
+
+    def __init__(self, is_shareable=is_deterministic, model_engine_mapping=None, engine_model_mapping=None):
+        self.is_shareable = is_shareable
+        if engine_model_mapping is None:
+            engine_model_mapping = {engine: model for model,
+                                    engine in (model_engine_mapping or {}).items()}
+        self.engine_model_mapping = engine_model_mapping
+        self.lock = threading.Lock()
+        # key -> Call of the threaded requests in flight
+        self.calls = {}
+        # (event loop, key) -> [task, number of waiting callers] of the async requests in flight. Futures can't be awaited from another event loop, so each loop has its own calls.
+        self.async_calls = {}
+        self.upstream_count = 0
+        self.shared_count = 0
+
+    def key(self, method_name, kwargs):
+        return request_key(method_name, kwargs, engine_model_mapping=self.engine_model_mapping)
+
+    def do(self, method_name, kwargs, send, timeout=None):
+        """Returns the response of send(), or of the identical request in flight if there is one. The timeout isn't part of the request_key, so a caller that shares another request's call waits for it for at most timeout seconds."""
+        if not self.is_shareable(method_name, kwargs):
+            return send()
+        key = self.key(method_name, kwargs)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.upstream_count += 1
+            else:
+                self.shared_count += 1
+        if not leader:
+            if not call.event.wait(timeout):
+                raise Exception("Request deadline exceeded.")
+            if call.error is not None:
+                raise call.error
+            return call.response
+        try:
+            call.response = send()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            # Requests that arrive from now on make a new call
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.response
+
+    async def ado(self, method_name, kwargs, send, timeout=None):
+        """Async version of do, where send is a coroutine function. The upstream call runs in its own task, so a caller that is cancelled or times out doesn't fail the others; the call is only cancelled once every caller waiting for it is gone."""
+        if not self.is_shareable(method_name, kwargs):
+            return await send()
+        key = (asyncio.get_running_loop(), self.key(method_name, kwargs))
+        with self.lock:
+            entry = self.async_calls.get(key)
+            if entry is not None:
+                entry[1] += 1
+                self.shared_count += 1
+            else:
+                task = asyncio.ensure_future(send())
+                entry = self.async_calls[key] = [task, 1]
+                self.upstream_count += 1
+                task.add_done_callback(
+                    functools.partial(self.forget, key))
+        task = entry[0]
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    task.cancel()
+            if isinstance(e, asyncio.TimeoutError) and not task.done():
+                raise Exception("Request deadline exceeded.") from None
+            raise
+
+    def forget(self, key, task):
+        """Removes the call once its task is done, so that requests that arrive from now on make a new call"""
+        with self.lock:
+            entry = self.async_calls.get(key)
+            if entry is not None and entry[0] is task:
+                del self.async_calls[key]
+
+    def stats(self):
+        """Returns the number of upstream calls made, the number of requests that shared another request's call instead, so that many upstream calls were saved, and the number of calls in flight"""
+        with self.lock:
+            return {
+                "upstream_calls": self.upstream_count,
+                "saved_calls": self.shared_count,
+                "in_flight": len(self.calls) + len(self.async_calls),
+            }
@@ -0,0 +1,286 @@
+import bisect
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+
+
+class SelectionStrategy:
+    """Decides which endpoint the load balancer sends the next request to. Strategies are called from many threads at once without a lock, so they should only read the endpoints' state, and keep their own state in atomic operations such as next() on an itertools.count."""
+
+    def select(self, endpoints, is_eligible):
+        """Returns one of the passed in endpoints for which is_eligible(endpoint) is true, or None if there is no eligible endpoint"""
+        raise NotImplementedError
+
+    def request_affinity(self, method_name, kwargs, affinity_key=None):
+        """Returns the key that select routes the request by, or None to select without one. Strategies that return a key get it as select's affinity_key argument."""
+        return None
+
+    def weights_changed(self):
+        """Called after the weight of an endpoint has changed"""
+
+
+class RoundRobinStrategy(SelectionStrategy):
+    """Sends requests to each eligible endpoint in turn"""
+
+    def __init__(self):
+        # A rotating counter. next() on an itertools.count is atomic, so concurrent requests each get their own index without a lock.
+        self.counter = itertools.count()
+
+    def select(self, endpoints, is_eligible):
+        if not endpoints:
+            return None
+        start_index = next(self.counter)
+        for i in range(len(endpoints)):
+            # Start at the next endpoint in the list, and if it isn't eligible, try the ones after it
+            endpoint = endpoints[(start_index + i) % len(endpoints)]
+            if is_eligible(endpoint):
+                return endpoint
+        return None
+
+
+class LeastOutstandingRequestsStrategy(SelectionStrategy):
+    """Sends requests to the eligible endpoint with the fewest requests in flight. Ties are broken round-robin."""
+
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def score(self, endpoint):
+        return endpoint.in_flight
+
+    def select(self, endpoints, is_eligible):
+        best_endpoint, best_score = None, None
+        # Start scanning at a rotating offset so that endpoints with equal scores share the traffic
+        offset = next(self.counter)
+        for i in range(len(endpoints)):
+            endpoint = endpoints[(offset + i) % len(endpoints)]
+            if not is_eligible(endpoint):
+                continue
+            score = self.score(endpoint)
+            if best_score is None or score < best_score:
+                best_endpoint, best_score = endpoint, score
+        return best_endpoint
+
+
+class EwmaLatencyStrategy(LeastOutstandingRequestsStrategy):
+    """Sends requests to the eligible endpoint with the lowest expected latency, which is its latency moving average multiplied by the requests it already has in flight. Endpoints without any latency samples yet are tried first, but only with one request at a time until their first request finishes."""
+
+    def score(self, endpoint):
+        if endpoint.latency_ewma is None:
+            return 0.0 if endpoint.in_flight == 0 else float("inf")
+        return endpoint.latency_ewma * (endpoint.in_flight + 1)
+
+
+class PowerOfTwoChoicesStrategy(SelectionStrategy):
+    """Picks two eligible endpoints at random and sends the request to the one with fewer requests in flight, using the latency moving average as a tie breaker. This avoids herding onto a single endpoint while still steering traffic away from slow ones."""
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+
+    def select(self, endpoints, is_eligible):
+        eligible_endpoints = [
+            endpoint for endpoint in endpoints if is_eligible(endpoint)]
+        if len(eligible_endpoints) < 2:
+            return eligible_endpoints[0] if eligible_endpoints else None
+        return min(self.rng.sample(eligible_endpoints, 2), key=lambda endpoint: (endpoint.in_flight, endpoint.latency_ewma or 0.0))
+
+
+def smooth_weighted_schedule(endpoints, max_length):
+    """Returns one cycle of smooth weighted round-robin over the endpoints' effective weights: each endpoint appears in proportion to its weight, and an endpoint's turns are spread out evenly instead of coming in a burst. Endpoints with a weight of 0 don't appear."""
+    weights = [max(endpoint.effective_weight, 0) for endpoint in endpoints]
+    total = sum(weights)
+    if total <= 0:
+        return ()
+    if all(float(weight).is_integer() for weight in weights):
+        # For integer weights the schedule repeats after the sum of the weights divided by their greatest common divisor
+        length = int(total) // math.gcd(*(int(weight) for weight in weights))
+    else:
+        length = max_length
+    current_weights = [0.0] * len(endpoints)
+    schedule = []
+    for _ in range(min(length, max_length)):
+        for i, weight in enumerate(weights):
+            current_weights[i] += weight
+        best_index = max(range(len(endpoints)),
+                         key=current_weights.__getitem__)
+        current_weights[best_index] -= total
+        schedule.append(endpoints[best_index])
+    return tuple(schedule)
+
+
+class SmoothWeightedRoundRobinStrategy(SelectionStrategy):
+    """Sends each endpoint a share of the requests proportional to its weight, spread out evenly like nginx's smooth weighted round-robin. The schedule for each set of endpoints is computed once, and requests walk through it with a rotating counter, so selection takes no lock. Endpoints with a weight of 0 only get requests when no other endpoint is eligible."""
+
+    # Non-integer weights are approximated by a schedule of this length
+    MAX_SCHEDULE_LENGTH = 1000
+
+    def __init__(self):
+        self.counter = itertools.count()
+        # Maps a tuple of endpoints to their schedule. It is replaced as a whole when weights change.
+        self.schedules = {}
+
+    def weights_changed(self):
+        self.schedules = {}
+
+    def get_schedule(self, endpoints):
+        schedules = self.schedules
+        schedule = schedules.get(endpoints)
+        if schedule is None:
+            schedule = schedules[endpoints] = smooth_weighted_schedule(
+                endpoints, self.MAX_SCHEDULE_LENGTH)
+        return schedule
+
+    def select(self, endpoints, is_eligible):
+        endpoints = tuple(endpoints)
+        schedule = self.get_schedule(endpoints)
+        if schedule:
+            start_index = next(self.counter)
+            ineligible_endpoints = set()
+            for i in range(len(schedule)):
+                endpoint = schedule[(start_index + i) % len(schedule)]
+                if endpoint in ineligible_endpoints:
+                    continue
+                if is_eligible(endpoint):
+                    return endpoint
+                ineligible_endpoints.add(endpoint)
+        return next((endpoint for endpoint in endpoints if endpoint.effective_weight <= 0 and is_eligible(endpoint)), None)
+
+
+def stable_hash(value):
+    """Returns a 64 bit hash of the string that, unlike hash(), is the same in every process"""
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class AffinityStrategy(SelectionStrategy):
+    """Sends requests that share a prompt prefix to the same endpoint, so that they hit the endpoint's prompt cache. The key of a request is its affinity_key argument if passed in, otherwise the model and the first prefix_length characters of its first prefix_messages messages, or of its prompt. Keys are placed on a consistent hash ring, on which each endpoint has virtual_nodes points per unit of weight, and go to the first eligible endpoint after them on the ring. When an endpoint leaves or joins, for example when it goes into cooldown, only the keys it owns move. An endpoint that already has more than load_factor times its share of the requests in flight is skipped, so that a hot prefix spills over to the next endpoint on the ring instead of overloading one. Requests without a key, such as embeddings, are sent round-robin."""
+
+    def __init__(self, prefix_messages=1, prefix_length=4096, virtual_nodes=100, load_factor=2.0):
+        self.prefix_messages = prefix_messages
+        self.prefix_length = prefix_length
+        self.virtual_nodes = virtual_nodes
+        self.load_factor = load_factor
+        self.round_robin = RoundRobinStrategy()
+        # Maps a tuple of endpoints to their ring. It is replaced as a whole when weights change.
+        self.rings = {}
+
+    def weights_changed(self):
+        self.rings = {}
+
+    def request_affinity(self, method_name, kwargs, affinity_key=None):
+        if affinity_key is not None:
+            return stable_hash(str(affinity_key))
+        if kwargs.get("messages"):
+            prefix = json.dumps(kwargs["messages"][:self.prefix_messages],
+                                sort_keys=True, default=str)
+        elif isinstance(kwargs.get("prompt"), str):
+            prefix = kwargs["prompt"]
+        else:
+            return None
+        model = kwargs.get("model") or kwargs.get(
+            "engine") or kwargs.get("deployment_id")
+        return stable_hash(f"{model}\n{prefix[:self.prefix_length]}")
+
+    def get_ring(self, endpoints):
+        """Returns the sorted hashes of the endpoints' points on the ring, and the endpoint of each point. Points are hashed from the endpoint's name, so each endpoint keeps its points when other endpoints join or leave."""
+        rings = self.rings
+        ring = rings.get(endpoints)
+        if ring is None:
+            points = sorted((stable_hash(f"{endpoint.name}#{i}"), index)
+                            for index, endpoint in enumerate(endpoints)
+                            for i in range(math.ceil(self.virtual_nodes * max(endpoint.effective_weight, 0))))
+            ring = rings[endpoints] = (tuple(point for point, _ in points),
+                                       tuple(endpoints[index] for _, index in points))
+        return ring
+
+    def select(self, endpoints, is_eligible, affinity_key=None):
+        if affinity_key is None:
+            return self.round_robin.select(endpoints, is_eligible)
+        endpoints = tuple(endpoints)
+        hashes, owners = self.get_ring(endpoints)
+        if not hashes:
+            return self.round_robin.select(endpoints, is_eligible)
+        max_in_flight = math.ceil(self.load_factor * (sum(endpoint.in_flight for endpoint in endpoints) + 1) / len(endpoints)) \
+            if self.load_factor is not None else None
+        start_index = bisect.bisect(hashes, affinity_key)
+        seen_endpoints = set()
+        overloaded_endpoint = None
+        for i in range(len(owners)):
+            endpoint = owners[(start_index + i) % len(owners)]
+            if endpoint in seen_endpoints:
+                continue
+            seen_endpoints.add(endpoint)
+            if is_eligible(endpoint):
+                if max_in_flight is None or endpoint.in_flight < max_in_flight:
+                    return endpoint
+                if overloaded_endpoint is None:
+                    overloaded_endpoint = endpoint
+            if len(seen_endpoints) == len(endpoints):
+                break
+        # Every eligible endpoint is over its share, so keep the key where it belongs
+        return overloaded_endpoint
+
+
+class AdaptiveWeightPolicy:
+    """Lowers the effective weight of endpoints that answer with 429s, and gives it back while they don't. Every interval seconds, the effective weight of each endpoint that was rate limited during the interval is multiplied by decrease, but not below min_weight_ratio of its configured weight, and every other endpoint gets increase of its configured weight back."""
+
+    def __init__(self, interval=10, decrease=0.5, increase=0.1, min_weight_ratio=0.05, clock=time.monotonic):
+        self.interval = interval
+        self.decrease = decrease
+        self.increase = increase
+        self.min_weight_ratio = min_weight_ratio
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.rate_limited_endpoints = set()
+        self.next_update_time = clock() + interval
+
+    def record_rate_limit(self, endpoint):
+        with self.lock:
+            self.rate_limited_endpoints.add(endpoint)
+
+    def update(self, endpoints):
+        """Adjusts the effective weights of the endpoints once every interval. Returns whether any weight changed."""
+        now = self.clock()
+        if now < self.next_update_time:
+            return False
+        with self.lock:
+            if now < self.next_update_time:
+                return False
+            self.next_update_time = now + self.interval
+            rate_limited_endpoints, self.rate_limited_endpoints = self.rate_limited_endpoints, set()
+        changed = False
+        for endpoint in endpoints:
+            if endpoint in rate_limited_endpoints:
+                effective_weight = max(endpoint.effective_weight * self.decrease,
+                                       endpoint.weight * self.min_weight_ratio)
+            else:
+                effective_weight = min(endpoint.effective_weight + endpoint.weight * self.increase,
+                                       endpoint.weight)
+            if effective_weight != endpoint.effective_weight:
+                endpoint.effective_weight = effective_weight
+                changed = True
+        return changed
+
+
+STRATEGIES = {
+    "round_robin": RoundRobinStrategy,
+    "weighted_round_robin": SmoothWeightedRoundRobinStrategy,
+    "least_outstanding": LeastOutstandingRequestsStrategy,
+    "ewma": EwmaLatencyStrategy,
+    "power_of_two": PowerOfTwoChoicesStrategy,
+    "affinity": AffinityStrategy,
+}
+
+
+def get_strategy(strategy):
+    """Returns a SelectionStrategy instance. strategy can be None (round-robin), the name of one of the built in STRATEGIES, or a SelectionStrategy instance."""
+    if strategy is None:
+        return RoundRobinStrategy()
+    if isinstance(strategy, SelectionStrategy):
+        return strategy
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"Unknown strategy {strategy!r}. Choose one of {', '.join(STRATEGIES)} or pass a SelectionStrategy instance.")
+    return STRATEGIES[strategy]()
@@ -0,0 +1,134 @@
+import collections
+import functools
+import time
+import weakref
+
+# The streams that were dropped without being read to the end or closed. Their finalizers can run on any thread, in the middle of any code, including code that holds the locks finishing a stream takes, so they only queue the stream's finish here without taking a lock, and the load balancer finishes it before its next request.
+abandoned_streams = collections.deque()
+
+
+def finish_abandoned(endpoint, on_finish, time_to_first_token):
+    """Records that a stream that wasn't read to the end has stopped. This isn't counted as a failure of the endpoint."""
+    endpoint.finish_request()
+    if on_finish is not None:
+        on_finish(time_to_first_token, exception=None, completed=False)
+
+
+def finish_abandoned_streams():
+    """Finishes the streams that were dropped without being closed. Must not be called while holding a lock that finishing a stream takes."""
+    while True:
+        try:
+            finish = abandoned_streams.popleft()
+        except IndexError:
+            return
+        finish()
+
+
+class StreamedResponse:
+    """Iterates over the chunks of a streamed response, and records the outcome on the endpoint that produced it once the stream ends. The time to the first chunk is recorded as the request's latency, since the total time depends on the length of the response, and each chunk after it counts as one token for the tokens per second. An error in the middle of the stream is passed to on_finish, which records it as a failure of the endpoint, and is raised to the caller, as the chunks read so far can't be replayed on another endpoint. Use it as a context manager, or call close, to stop reading it early; a stream that is dropped without that stops counting as in flight before the load balancer's next request."""
+
+    def __init__(self, endpoint, chunks, first_chunk, start_time, on_finish=None):
+        self.endpoint = endpoint
+        self.chunks = chunks
+        self.first_chunk = first_chunk
+        self.start_time = start_time
+        self.first_chunk_time = time.monotonic()
+        self.chunk_count = 0
+        self.finished = False
+        # Called with the time to the first chunk once the stream ends, whether it was read to the end, and the error that ended it if any
+        self.on_finish = on_finish
+        self.finalizer = weakref.finalize(self, abandoned_streams.append, functools.partial(
+            finish_abandoned, endpoint, on_finish, self.first_chunk_time - start_time))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first_chunk is not None:
+            chunk, self.first_chunk = self.first_chunk, None
+            self.chunk_count += 1
+            return chunk
+        if self.finished:
+            raise StopIteration
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.finish(completed=True)
+            raise
+        except Exception as e:
+            self.finish(exception=e)
+            raise
+        self.chunk_count += 1
+        return chunk
+
+    def finish(self, completed=False, exception=None):
+        """Records the outcome of the stream on the endpoint, once"""
+        if self.finished:
+            return
+        self.finished = True
+        self.finalizer.detach()
+        time_to_first_token = self.first_chunk_time - self.start_time
+        if completed:
+            stream_duration = time.monotonic() - self.first_chunk_time
+            tokens_per_second = (self.chunk_count - 1) / \
+                stream_duration if self.chunk_count > 1 and stream_duration > 0 else None
+            self.endpoint.finish_request(time_to_first_token)
+            self.endpoint.record_stream(time_to_first_token, tokens_per_second)
+        else:
+            self.endpoint.finish_request()
+        if self.on_finish is not None:
+            self.on_finish(time_to_first_token,
+                           exception=exception, completed=completed)
+
+    def close(self):
+        """Stops reading the stream. This isn't counted as a failure of the endpoint."""
+        if not self.finished:
+            self.finish()
+            close = getattr(self.chunks, "close", None)
+            if close is not None:
+                close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncStreamedResponse(StreamedResponse):
+    """Async version of StreamedResponse. Use it as an async context manager, or call aclose, to stop reading it early: a dropped stream can't close the underlying stream, which is left to the garbage collector and the event loop."""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.first_chunk is not None:
+            chunk, self.first_chunk = self.first_chunk, None
+            self.chunk_count += 1
+            return chunk
+        if self.finished:
+            raise StopAsyncIteration
+        try:
+            chunk = await self.chunks.__anext__()
+        except StopAsyncIteration:
+            self.finish(completed=True)
+            raise
+        except Exception as e:
+            self.finish(exception=e)
+            raise
+        self.chunk_count += 1
+        return chunk
+
+    async def aclose(self):
+        """Stops reading the stream. This isn't counted as a failure of the endpoint."""
+        if not self.finished:
+            self.finish()
+            aclose = getattr(self.chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
@@ -15,9 +15,13 @@ setup(
     install_requires=[
         # Any required packages here
         'openai',
+        'aiohttp',
         'python-dotenv',
-        'tenacity'
     ],
+    extras_require={
+        # For Embedding.create(return_format="numpy")
+        'numpy': ['numpy'],
+    },
     classifiers=[
         # Full list at https://pypi.org/classifiers/
         'License :: OSI Approved :: MIT License',
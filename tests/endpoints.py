@@ -0,0 +1,16 @@
+from datetime import timedelta
+from openai_load_balancer.load_balancer import LoadBalancer
+
+
+def endpoint_configs(count=2, per_endpoint=None, **config):
+    """Returns the configurations of count OpenAI endpoints named endpoint-0, endpoint-1, ... at https://endpoint-0, https://endpoint-1, ..., with config added to each, and per_endpoint[i] added to the i-th one. count defaults to the length of per_endpoint. Tests mock the requests, so the endpoints are never reached."""
+    if per_endpoint is not None:
+        count = len(per_endpoint)
+    return [dict({"api_type": "open_ai", "base_url": f"https://endpoint-{i}", "api_key_env": "OPENAI_API_KEY",
+                  "name": f"endpoint-{i}"}, **config, **(per_endpoint[i] if per_endpoint is not None else {})) for i in range(count)]
+
+
+def make_load_balancer(configs=None, failure_threshold=5, cooldown_period=timedelta(minutes=10), **options):
+    """Returns a LoadBalancer of the passed in endpoint configurations, by default two from endpoint_configs"""
+    return LoadBalancer(endpoint_configs() if configs is None else configs,
+                        failure_threshold=failure_threshold, cooldown_period=cooldown_period, **options)
@@ -0,0 +1,89 @@
+import asyncio
+import threading
+from aiohttp import web
+
+
+class FakeOpenAIServer:
+    """A local stand-in for the OpenAI and Azure OpenAI APIs that runs on the current event loop. It answers the chat completion, completion and embedding routes after an optional delay, and records how many requests were in flight at once."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.request_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_thread_count = 0
+        self.requests = []
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completion)
+        app.router.add_post("/v1/completions", self.completion)
+        app.router.add_post("/v1/embeddings", self.embedding)
+        app.router.add_post(
+            "/openai/deployments/{engine}/chat/completions", self.chat_completion)
+        app.router.add_post(
+            "/openai/deployments/{engine}/completions", self.completion)
+        app.router.add_post(
+            "/openai/deployments/{engine}/embeddings", self.embedding)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def _handle(self, request):
+        body = await request.json()
+        self.requests.append({
+            "path": request.path,
+            "headers": dict(request.headers),
+            "body": body,
+            "peer": request.transport.get_extra_info("peername"),
+        })
+        self.request_count += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.max_thread_count = max(
+            self.max_thread_count, threading.active_count())
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return body
+
+    async def chat_completion(self, request):
+        body = await self._handle(request)
+        return web.json_response({
+            "id": f"chatcmpl-{self.request_count}",
+            "object": "chat.completion",
+            "model": body.get("model", request.match_info.get("engine")),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hello!"}}],
+            "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7},
+        })
+
+    async def completion(self, request):
+        body = await self._handle(request)
+        return web.json_response({
+            "id": f"cmpl-{self.request_count}",
+            "object": "text_completion",
+            "model": body.get("model", request.match_info.get("engine")),
+            "choices": [{"index": 0, "finish_reason": "stop", "text": "Hello!"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+        })
+
+    async def embedding(self, request):
+        body = await self._handle(request)
+        inputs = body["input"] if isinstance(
+            body["input"], list) else [body["input"]]
+        return web.json_response({
+            "object": "list",
+            "model": body.get("model", request.match_info.get("engine")),
+            "data": [{"object": "embedding", "index": i, "embedding": [0.1, 0.2, 0.3]} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        })
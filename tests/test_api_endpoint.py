@@ -1,4 +1,8 @@
-from datetime import datetime, timedelta
+import asyncio
+import threading
+import time
+import warnings
+from datetime import timedelta
 import pytest
 from openai_load_balancer.api_endpoint import ApiEndpoint
 
@@ -33,7 +37,7 @@ def test_api_endpoint_reset(api_endpoint):
 
 def test_api_endpoint_reactivate_after_cooldown(api_endpoint):
     api_endpoint.mark_failed()
-    api_endpoint.last_failed_time = datetime.now() - timedelta(minutes=11)
+    api_endpoint.last_failed_time = time.monotonic() - timedelta(minutes=11).total_seconds()
     assert api_endpoint.is_active(
         failure_threshold=5, cooldown_period=timedelta(minutes=10))
 
@@ -58,7 +62,7 @@ def test_api_endpoint_inactive_before_cooldown(api_endpoint):
         api_endpoint.mark_failed()
 
     # Set last_failed_time to 5 minutes ago (inside the cooldown period)
-    api_endpoint.last_failed_time = datetime.now() - timedelta(minutes=5)
+    api_endpoint.last_failed_time = time.monotonic() - timedelta(minutes=5).total_seconds()
 
     # Test should now correctly expect the endpoint to be inactive
     assert not api_endpoint.is_active(
@@ -69,3 +73,61 @@ def test_api_endpoint_failure_count_increment(api_endpoint):
     for i in range(1, 4):  # Test multiple failures
         api_endpoint.mark_failed()
         assert api_endpoint.failure_count == i
+
+
+def test_api_endpoint_resolves_credentials_once(monkeypatch):
+    monkeypatch.setenv("AZURE_API_BASE_URL_1", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_API_KEY_1", "azure-key")
+    endpoint = ApiEndpoint(api_type="azure", base_url="AZURE_API_BASE_URL_1",
+                           api_key_env="AZURE_API_KEY_1", version="2023-05-15")
+    monkeypatch.setenv("AZURE_API_KEY_1", "rotated-key")
+
+    assert endpoint.client_kwargs() == {
+        "api_key": "azure-key",
+        "api_base": "https://example.openai.azure.com",
+        "api_type": "azure",
+        "api_version": "2023-05-15",
+    }
+
+
+def test_api_endpoint_reactivates_after_cooldown_without_deadlock(api_endpoint):
+    for _ in range(5):
+        api_endpoint.mark_failed()
+    api_endpoint.last_failed_time = time.monotonic() - timedelta(minutes=11).total_seconds()
+    results = []
+    thread = threading.Thread(target=lambda: results.append(api_endpoint.is_active(
+        failure_threshold=5, cooldown_period=timedelta(minutes=10))), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert results == [True]
+    assert api_endpoint.failure_count == 0
+    assert not api_endpoint.lock.locked()
+
+
+def test_api_endpoint_has_no_instance_dict(api_endpoint):
+    with pytest.raises(AttributeError):
+        api_endpoint.unknown_attribute = True
+
+
+def test_api_endpoint_keeps_one_aiohttp_session_per_event_loop(api_endpoint):
+    async def get_sessions():
+        return await api_endpoint.aget_aiohttp_session(), await api_endpoint.aget_aiohttp_session()
+
+    first_session, same_session = asyncio.run(get_sessions())
+    assert first_session is same_session
+    assert not first_session.closed
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", ResourceWarning)
+        # The first loop was closed without aclose, so the next loop closes its session
+        second_session, _ = asyncio.run(get_sessions())
+        assert second_session is not first_session
+        assert first_session.closed
+        assert list(api_endpoint.aiohttp_sessions.values()) == [second_session]
+
+        async def close():
+            await api_endpoint.aclose()
+        asyncio.run(close())
+    assert second_session.closed
+    assert api_endpoint.aiohttp_sessions == {}
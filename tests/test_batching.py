@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from unittest.mock import Mock
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.batching import EmbeddingBatcher, normalize_embedding_input, split_usage
+
+
+def fake_embedding_response(method_name, input, model):
+    """Returns an embedding response where each embedding is the input it was made for"""
+    return OpenAIObject.construct_from({
+        "object": "list",
+        "model": model,
+        "data": [{"object": "embedding", "index": i, "embedding": [text]} for i, text in enumerate(input)],
+        "usage": {"prompt_tokens": 10 * len(input), "total_tokens": 10 * len(input)},
+    })
+
+
+@pytest.fixture
+def mock_load_balancer():
+    mock = Mock()
+    mock.try_send_request.side_effect = fake_embedding_response
+    return mock
+
+
+def embed_concurrently(batcher, inputs):
+    with ThreadPoolExecutor(max_workers=len(inputs)) as executor:
+        return list(executor.map(lambda text: batcher.create(model="text-embedding-ada-002", input=text), inputs))
+
+
+def test_concurrent_requests_are_sent_as_one_batch(mock_load_balancer):
+    batcher = EmbeddingBatcher(mock_load_balancer, max_wait=0.2)
+    inputs = [f"text {i}" for i in range(20)]
+
+    responses = embed_concurrently(batcher, inputs)
+
+    assert mock_load_balancer.try_send_request.call_count == 1
+    for text, response in zip(inputs, responses):
+        assert [item["embedding"] for item in response["data"]] == [[text]]
+        assert response["data"][0]["index"] == 0
+        assert response["usage"]["total_tokens"] == 10
+    assert batcher.stats() == {"requests": 20, "batches": 1}
+
+
+def test_list_inputs_keep_their_indices(mock_load_balancer):
+    batcher = EmbeddingBatcher(mock_load_balancer, max_wait=0)
+    response = batcher.create(
+        model="text-embedding-ada-002", input=["a", "b", "c"])
+    assert [(item["index"], item["embedding"]) for item in response["data"]] == [
+        (0, ["a"]), (1, ["b"]), (2, ["c"])]
+
+
+def test_batches_are_limited_to_max_batch_size(mock_load_balancer):
+    batcher = EmbeddingBatcher(
+        mock_load_balancer, max_wait=0.2, max_batch_size=5)
+
+    embed_concurrently(batcher, [f"text {i}" for i in range(20)])
+
+    batch_sizes = [len(call.kwargs["input"])
+                   for call in mock_load_balancer.try_send_request.call_args_list]
+    assert sum(batch_sizes) == 20
+    assert max(batch_sizes) <= 5
+
+
+def test_requests_with_different_arguments_are_not_batched_together(mock_load_balancer):
+    batcher = EmbeddingBatcher(mock_load_balancer, max_wait=0.2)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        list(executor.map(lambda model: batcher.create(
+            model=model, input="Hello"), ["model-a", "model-b"]))
+    assert mock_load_balancer.try_send_request.call_count == 2
+
+
+def test_batch_errors_are_raised_to_every_caller(mock_load_balancer):
+    mock_load_balancer.try_send_request.side_effect = Exception(
+        "All endpoints failed.")
+    batcher = EmbeddingBatcher(mock_load_balancer, max_wait=0.2)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(
+            batcher.create, model="text-embedding-ada-002", input="Hello") for _ in range(5)]
+    for future in futures:
+        assert str(future.exception()) == "All endpoints failed."
+
+
+def test_normalize_embedding_input():
+    assert normalize_embedding_input("a") == ["a"]
+    assert normalize_embedding_input([1, 2, 3]) == [[1, 2, 3]]
+    assert normalize_embedding_input(["a", "b"]) == ["a", "b"]
+    assert normalize_embedding_input([[1, 2], [3]]) == [[1, 2], [3]]
+
+
+def test_split_usage():
+    assert split_usage(10, [1, 1, 1]) == [4, 3, 3]
+    assert split_usage(7, [0, 0]) == [4, 3]
+    assert sum(split_usage(1001, [3, 5, 7])) == 1001
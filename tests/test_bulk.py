@@ -0,0 +1,125 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import patch
+from openai import error
+from openai.openai_object import OpenAIObject
+from openai_load_balancer import initialize_load_balancer
+from openai_load_balancer.bulk import run_bulk, main
+from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.retry_policy import RetryPolicy
+from tests.endpoints import endpoint_configs
+
+ENDPOINTS = endpoint_configs()
+
+
+@pytest.fixture
+def openai_load_balancer():
+    return initialize_load_balancer(ENDPOINTS, retry_policy=RetryPolicy(max_attempts=1))
+
+
+def write_lines(path, requests):
+    with open(path, "w") as f:
+        for request in requests:
+            f.write((request if isinstance(request, str)
+                    else json.dumps(request)) + "\n")
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class FakeApi:
+    """A fake asend_request that answers with the request's content, after a delay set by the request, and fails the prompts in fail"""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+
+    async def __call__(self, endpoint, method_name, **kwargs):
+        content = kwargs.get("input") or kwargs["messages"][0]["content"]
+        self.calls.append(content)
+        await asyncio.sleep(kwargs.get("delay", 0))
+        if content in self.fail:
+            raise error.InvalidRequestError("Invalid prompt", None, http_status=400)
+        return OpenAIObject.construct_from({"object": method_name, "content": content,
+                                            "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}})
+
+
+def chat(content, **kwargs):
+    return dict(model="gpt-3.5-turbo", messages=[{"role": "user", "content": content}], **kwargs)
+
+
+def test_bulk_sends_every_line_and_tags_the_responses(openai_load_balancer, tmp_path):
+    write_lines(tmp_path / "in.jsonl", [
+        chat("first"),
+        {"custom_id": "request-2", "url": "/v1/embeddings",
+            "body": {"model": "text-embedding-ada-002", "input": "second"}},
+        "",
+        "not json",
+        chat("fourth"),
+    ])
+    with patch.object(LoadBalancer, 'asend_request', new=FakeApi(fail={"fourth"})):
+        stats = run_bulk(openai_load_balancer, str(tmp_path / "in.jsonl"),
+                         str(tmp_path / "out.jsonl"), concurrency=2)
+
+    records = {record["id"]: record for record in read_records(
+        tmp_path / "out.jsonl")}
+    assert records[1]["response"]["content"] == "first"
+    assert records["request-2"]["response"] == {"object": "embedding_create", "content": "second",
+                                                "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5}}
+    assert records["request-2"]["line"] == 2
+    assert records[4]["error"]["type"] == "invalid_line"
+    assert records[5]["error"] == {
+        "type": "do_not_retry", "message": "Invalid prompt"}
+    assert {key: stats[key] for key in ("lines", "skipped", "succeeded", "failed", "errors", "prompt_tokens")} == {
+        "lines": 4, "skipped": 0, "succeeded": 2, "failed": 2, "errors": {"invalid_line": 1, "do_not_retry": 1}, "prompt_tokens": 6}
+
+
+def test_bulk_resumes_without_sending_completed_lines_again(openai_load_balancer, tmp_path):
+    write_lines(tmp_path / "in.jsonl",
+                [chat(f"prompt-{i}") for i in range(1, 11)])
+    with patch.object(LoadBalancer, 'asend_request', new=FakeApi(fail={"prompt-3", "prompt-7"})):
+        stats = run_bulk(openai_load_balancer, str(
+            tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"))
+    assert stats["failed"] == 2
+    # A crash while writing leaves a partial last line
+    with open(tmp_path / "out.jsonl", "a") as f:
+        f.write('{"id": 11, "line": 11, "resp')
+
+    api = FakeApi()
+    with patch.object(LoadBalancer, 'asend_request', new=api):
+        stats = run_bulk(openai_load_balancer, str(
+            tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"))
+
+    assert sorted(api.calls) == ["prompt-3", "prompt-7"]
+    assert (stats["skipped"], stats["succeeded"], stats["failed"]) == (8, 2, 0)
+    records = read_records(tmp_path / "out.jsonl")
+    assert sorted(record["line"] for record in records) == list(range(1, 11))
+    assert all("response" in record for record in records)
+
+
+def test_bulk_can_write_in_input_order(openai_load_balancer, tmp_path):
+    write_lines(tmp_path / "in.jsonl", [chat(f"prompt-{i}", delay=delay)
+                for i, delay in enumerate([0.05, 0.0, 0.03, 0.0, 0.01])])
+    with patch.object(LoadBalancer, 'asend_request', new=FakeApi()):
+        run_bulk(openai_load_balancer, str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"),
+                 concurrency=3, ordered=True, resume=False)
+    assert [record["line"] for record in read_records(
+        tmp_path / "out.jsonl")] == [1, 2, 3, 4, 5]
+
+
+def test_bulk_command_line(tmp_path, capsys):
+    with open(tmp_path / "config.json", "w") as f:
+        json.dump({"endpoints": ENDPOINTS, "cooldown_period": 60}, f)
+    write_lines(tmp_path / "in.jsonl", [{"model": "text-embedding-ada-002", "input": f"input-{i}"}
+                                        for i in range(3)])
+    with patch.object(LoadBalancer, 'asend_request', new=FakeApi()):
+        exit_code = main([str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl"),
+                          "--config", str(tmp_path / "config.json"), "--method", "embedding"])
+
+    assert exit_code == 0
+    assert json.loads(capsys.readouterr().out)["succeeded"] == 3
+    assert {record["response"]["object"] for record in read_records(
+        tmp_path / "out.jsonl")} == {"embedding_create"}
@@ -0,0 +1,110 @@
+import asyncio
+from unittest.mock import Mock, AsyncMock, patch
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.cache import ResponseCache, is_deterministic, request_key
+from openai_load_balancer.openai_interface import OpenAILoadBalancer
+
+MODEL_ENGINE_MAPPING = {"gpt-3.5-turbo": "gpt-35-turbo"}
+
+
+def make_response(content):
+    return OpenAIObject.construct_from({"object": "chat.completion", "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]})
+
+
+def test_request_key_is_shared_by_azure_and_openai_requests():
+    messages = [{"role": "user", "content": "Hello!"}]
+    openai_key = request_key('chat_completion_create', {
+                             "model": "gpt-3.5-turbo", "messages": messages, "temperature": 0}, MODEL_ENGINE_MAPPING)
+    azure_key = request_key('chat_completion_create', {
+                            "temperature": 0, "engine": "gpt-35-turbo", "messages": messages, "request_timeout": 10}, MODEL_ENGINE_MAPPING)
+    assert openai_key == azure_key
+    assert openai_key != request_key('chat_completion_create', {
+                                     "model": "gpt-4", "messages": messages, "temperature": 0}, MODEL_ENGINE_MAPPING)
+
+
+def test_cache_keys_map_deployment_names_back_to_the_model():
+    cache = ResponseCache(model_engine_mapping=MODEL_ENGINE_MAPPING, engine_model_mapping={
+                          "gpt-35-turbo": "gpt-3.5-turbo", "chat-deployment": "gpt-3.5-turbo"})
+    messages = [{"role": "user", "content": "Hello!"}]
+    assert cache.key('chat_completion_create', {"engine": "chat-deployment", "messages": messages}) == cache.key(
+        'chat_completion_create', {"model": "gpt-3.5-turbo", "messages": messages}) == request_key(
+        'chat_completion_create', {"engine": "gpt-35-turbo", "messages": messages}, MODEL_ENGINE_MAPPING)
+
+
+def test_is_deterministic():
+    assert is_deterministic('embedding_create', {"input": "Hello"})
+    assert is_deterministic('chat_completion_create', {"temperature": 0})
+    assert not is_deterministic('chat_completion_create', {})
+    assert not is_deterministic('chat_completion_create', {
+                                "temperature": 0, "n": 3})
+    assert not is_deterministic('chat_completion_create', {
+                                "temperature": 0, "stream": True})
+
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2)
+    cache.set("a", make_response("a"))
+    cache.set("b", make_response("b"))
+    cache.get("a")
+    cache.set("c", make_response("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats() == {"hits": 2, "disk_hits": 0,
+                             "misses": 1, "evictions": 1, "entries": 2}
+
+
+def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl=60)
+    with patch('openai_load_balancer.cache.time.time', return_value=1000):
+        cache.set("a", make_response("a"))
+    with patch('openai_load_balancer.cache.time.time', return_value=1059):
+        assert cache.get("a") is not None
+    with patch('openai_load_balancer.cache.time.time', return_value=1061):
+        assert cache.get("a") is None
+
+
+def test_disk_cache_survives_restarts(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResponseCache(path=path)
+    cache.set("a", make_response("Hello!"))
+    cache.close()
+
+    cache = ResponseCache(path=path)
+    response = cache.get("a")
+    assert response.choices[0].message.content == "Hello!"
+    assert cache.stats()["disk_hits"] == 1
+    cache.close()
+
+
+def test_openai_load_balancer_serves_cacheable_requests_from_cache():
+    mock_load_balancer = Mock()
+    mock_load_balancer.try_send_request.return_value = make_response("Hello!")
+    mock_load_balancer.atry_send_request = AsyncMock(
+        return_value=make_response("Hello!"))
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, response_cache=ResponseCache())
+    test_kwargs = {"messages": [
+        {"role": "user", "content": "Hello!"}], "model": "gpt-3.5-turbo", "temperature": 0}
+
+    first_response = openai_load_balancer.ChatCompletion.create(**test_kwargs)
+    second_response = asyncio.run(
+        openai_load_balancer.ChatCompletion.acreate(**test_kwargs))
+
+    assert first_response is second_response
+    assert mock_load_balancer.try_send_request.call_count == 1
+    mock_load_balancer.atry_send_request.assert_not_awaited()
+
+
+def test_openai_load_balancer_does_not_cache_sampled_requests():
+    mock_load_balancer = Mock()
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, response_cache=ResponseCache())
+    test_kwargs = {"messages": [
+        {"role": "user", "content": "Hello!"}], "model": "gpt-3.5-turbo", "temperature": 0.7}
+
+    openai_load_balancer.ChatCompletion.create(**test_kwargs)
+    openai_load_balancer.ChatCompletion.create(**test_kwargs)
+
+    assert mock_load_balancer.try_send_request.call_count == 2
+    assert openai_load_balancer.response_cache.stats()["misses"] == 0
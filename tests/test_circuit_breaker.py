@@ -0,0 +1,106 @@
+import time
+from openai_load_balancer.circuit_breaker import CircuitBreaker
+from tests.endpoints import make_load_balancer
+
+
+class FakeProbe:
+    """Fails while failing is set, and counts the probes it was sent"""
+
+    def __init__(self):
+        self.failing = True
+        self.probed = []
+
+    def __call__(self, load_balancer, endpoint, timeout):
+        self.probed.append(endpoint.name)
+        if self.failing:
+            raise Exception("Connection refused")
+
+
+def make_breaker_load_balancer(**options):
+    circuit_breaker = CircuitBreaker(probe=FakeProbe(), **options)
+    # The tests run the prober by hand instead of in its thread
+    circuit_breaker.stop()
+    return make_load_balancer(failure_threshold=2, circuit_breaker=circuit_breaker)
+
+
+def trip(load_balancer, endpoint):
+    for _ in range(load_balancer.failure_threshold):
+        load_balancer.record_failure(endpoint, Exception("Failed request"))
+
+
+def test_probed_endpoint_closes_after_trial_requests_succeed():
+    load_balancer = make_breaker_load_balancer(
+        probe_interval=0, success_threshold=2, half_open_requests=1)
+    circuit_breaker = load_balancer.circuit_breaker
+    endpoint = load_balancer.api_endpoints[0]
+    trip(load_balancer, endpoint)
+
+    assert load_balancer.get_health().active_endpoints == (
+        load_balancer.api_endpoints[1],)
+    assert circuit_breaker.stats()["endpoint-0"]["state"] == "open"
+
+    circuit_breaker.run_once()
+    assert circuit_breaker.stats()["endpoint-0"]["failed_probes"] == 1
+    assert endpoint not in load_balancer.get_health().active_endpoints
+
+    circuit_breaker.probe.failing = False
+    circuit_breaker.run_once()
+    assert circuit_breaker.probe.probed == ["endpoint-0", "endpoint-0"]
+    assert circuit_breaker.stats()["endpoint-0"]["state"] == "half_open"
+    assert endpoint in load_balancer.get_health().half_open_endpoints
+
+    # While its trial request is in flight, the half open endpoint gets no other requests
+    endpoint.start_request()
+    assert {load_balancer.get_next_active_endpoint().name for _ in range(4)} == {
+        "endpoint-1"}
+    endpoint.finish_request()
+    assert {load_balancer.get_next_active_endpoint().name for _ in range(4)} == {
+        "endpoint-0", "endpoint-1"}
+
+    load_balancer.record_success(endpoint)
+    assert circuit_breaker.stats()["endpoint-0"]["state"] == "half_open"
+    load_balancer.record_success(endpoint)
+    assert circuit_breaker.stats()["endpoint-0"]["state"] == "closed"
+    assert endpoint.failure_count == 0
+    assert not load_balancer.get_health().half_open_endpoints
+
+    history = circuit_breaker.get_history("endpoint-0")
+    assert [(change["from"], change["to"]) for change in history] == [
+        ("closed", "open"), ("open", "half_open"), ("half_open", "closed")]
+    assert [change["reason"] for change in history] == [
+        "request failed with Exception", "probe succeeded", "trial requests succeeded"]
+    assert circuit_breaker.get_history("endpoint-1") == []
+
+
+def test_failed_trial_request_reopens_with_longer_probe_interval():
+    load_balancer = make_breaker_load_balancer(
+        probe_interval=1, max_probe_interval=30)
+    circuit_breaker = load_balancer.circuit_breaker
+    circuit_breaker.probe.failing = False
+    endpoint = load_balancer.api_endpoints[0]
+    trip(load_balancer, endpoint)
+    assert 0 < circuit_breaker.run_once() <= 1
+
+    circuit_breaker.probe_endpoint(endpoint)
+    load_balancer.record_failure(endpoint, Exception("Failed request"))
+
+    stats = circuit_breaker.stats()["endpoint-0"]
+    assert stats["state"] == "open"
+    assert stats["trips"] == 2
+    assert 1 < stats["next_probe_in"] <= 2
+    assert endpoint not in load_balancer.get_health().active_endpoints
+
+
+def test_cooldown_period_half_opens_circuit_without_successful_probe():
+    load_balancer = make_breaker_load_balancer(probe_interval=60)
+    circuit_breaker = load_balancer.circuit_breaker
+    endpoint = load_balancer.api_endpoints[0]
+    trip(load_balancer, endpoint)
+
+    endpoint.last_failed_time = time.monotonic() - 601
+    assert circuit_breaker.run_once() is None
+
+    assert circuit_breaker.probe.probed == []
+    assert circuit_breaker.stats()["endpoint-0"]["state"] == "half_open"
+    assert endpoint in load_balancer.get_health().half_open_endpoints
+    assert 'circuit_state{endpoint="endpoint-0"} 1' in load_balancer.get_prometheus_metrics()
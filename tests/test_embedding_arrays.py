@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from unittest.mock import Mock, AsyncMock
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.batching import EmbeddingBatcher
+from openai_load_balancer.bulk import read_embeddings
+from openai_load_balancer.embedding_arrays import to_embedding_array
+from openai_load_balancer.openai_interface import OpenAILoadBalancer
+
+np = pytest.importorskip("numpy")
+
+
+def encode(vector):
+    return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+
+def fake_embedding_response(method_name, input, model, encoding_format=None):
+    """Returns an embedding response where each embedding is [i, i + 0.5] for the i-th input, base64 encoded if requested"""
+    inputs = input if isinstance(input, list) else [input]
+    return OpenAIObject.construct_from({
+        "object": "list",
+        "model": model,
+        "data": [{"object": "embedding", "index": i, "embedding": encode([i, i + 0.5]) if encoding_format == "base64" else [i, i + 0.5]}
+                 for i in range(len(inputs))],
+        "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+    })
+
+
+def test_to_embedding_array_decodes_base64_and_lists_in_index_order():
+    response = {"model": "text-embedding-ada-002", "usage": {"total_tokens": 2}, "data": [
+        {"index": 1, "embedding": [3.0, 4.0]},
+        {"index": 0, "embedding": encode([1.0, 2.0])},
+    ]}
+
+    result = to_embedding_array(response)
+
+    assert result.embeddings.dtype == np.float32
+    assert result.embeddings.flags["C_CONTIGUOUS"]
+    assert result.embeddings.tolist() == [[1.0, 2.0], [3.0, 4.0]]
+    assert result.usage == {"total_tokens": 2}
+    assert result.model == "text-embedding-ada-002"
+
+
+def test_create_with_numpy_return_format_requests_base64():
+    mock_load_balancer = Mock()
+    mock_load_balancer.try_send_request.side_effect = fake_embedding_response
+    mock_load_balancer.atry_send_request = AsyncMock(
+        side_effect=fake_embedding_response)
+    openai_load_balancer = OpenAILoadBalancer(mock_load_balancer)
+
+    result = openai_load_balancer.Embedding.create(
+        model="text-embedding-ada-002", input=["a", "b", "c"], return_format="numpy")
+    async_result = asyncio.run(openai_load_balancer.Embedding.acreate(
+        model="text-embedding-ada-002", input="a", return_format="numpy"))
+
+    assert mock_load_balancer.try_send_request.call_args.kwargs["encoding_format"] == "base64"
+    assert result.embeddings.shape == (3, 2)
+    assert result.embeddings[2].tolist() == [2.0, 2.5]
+    assert result.usage["total_tokens"] == 3
+    assert async_result.embeddings.tolist() == [[0.0, 0.5]]
+    with pytest.raises(ValueError):
+        openai_load_balancer.Embedding.create(
+            model="text-embedding-ada-002", input="a", return_format="pandas")
+
+
+def test_batched_requests_are_split_before_decoding():
+    mock_load_balancer = Mock()
+    mock_load_balancer.try_send_request.side_effect = fake_embedding_response
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, EmbeddingBatcher(mock_load_balancer, max_wait=0.2))
+    start_barrier = threading.Barrier(4)
+
+    def embed(text):
+        start_barrier.wait()
+        return openai_load_balancer.Embedding.create(model="text-embedding-ada-002", input=[text, text], return_format="numpy")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(embed, ["a", "b", "c", "d"]))
+
+    assert mock_load_balancer.try_send_request.call_count == 1
+    # Each caller gets its own two rows of the batch
+    assert sorted(result.embeddings[0, 0] for result in results) == [0, 2, 4, 6]
+    assert all(result.embeddings.shape == (2, 2) for result in results)
+
+
+def test_read_embeddings_loads_a_bulk_output_file(tmp_path):
+    path = tmp_path / "out.jsonl"
+    records = [
+        {"id": "second", "line": 2, "response": {
+            "data": [{"index": 0, "embedding": encode([3.0, 4.0])}]}},
+        {"id": 3, "line": 3, "error": {"type": "do_not_retry"}},
+        {"id": "first", "line": 1, "response": {"data": [
+            {"index": 1, "embedding": encode([2.0, 2.0])}, {"index": 0, "embedding": encode([1.0, 1.0])}]}},
+    ]
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+    ids, embeddings = read_embeddings(str(path))
+
+    assert ids == ["first", "first", "second"]
+    assert embeddings.dtype == np.float32
+    assert embeddings.tolist() == [[1.0, 1.0], [2.0, 2.0], [3.0, 4.0]]
@@ -0,0 +1,139 @@
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import pytest
+from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.health_state import MmapHealthState
+from openai_load_balancer.circuit_breaker import CircuitBreaker
+from tests.endpoints import endpoint_configs, make_load_balancer
+
+pytest.importorskip("fcntl")
+
+
+def make_shared_load_balancer(path, **config):
+    return make_load_balancer(endpoint_configs(**config), failure_threshold=2, health_state=MmapHealthState(path))
+
+
+def fail_endpoint(path, name):
+    load_balancer = make_shared_load_balancer(path)
+    endpoint = next(
+        endpoint for endpoint in load_balancer.api_endpoints if endpoint.name == name)
+    for _ in range(load_balancer.failure_threshold):
+        load_balancer.record_failure(endpoint, Exception("Failed request"))
+
+
+def test_cooldowns_are_shared_between_load_balancers(tmp_path):
+    path = str(tmp_path / "health")
+    worker_1, worker_2 = make_shared_load_balancer(path), make_shared_load_balancer(path)
+    fail_endpoint(path, "endpoint-0")
+
+    for load_balancer in (worker_1, worker_2):
+        assert [endpoint.name for endpoint in load_balancer.get_health().active_endpoints] == [
+            "endpoint-1"]
+        assert load_balancer.api_endpoints[0].failure_count == 2
+        assert load_balancer.get_metrics()["endpoints"]["endpoint-0"]["in_cooldown"]
+
+    worker_2.api_endpoints[0].last_failed_time = time.monotonic() - 601
+    assert {worker_1.get_next_active_endpoint().name for _ in range(2)} == {
+        "endpoint-0", "endpoint-1"}
+    assert worker_2.api_endpoints[0].failure_count == 0
+    assert worker_2.api_endpoints[0].total_cooldown_time() > 0
+    assert len(worker_2.get_health().active_endpoints) == 2
+
+
+def test_cooldowns_are_shared_between_processes(tmp_path):
+    path = str(tmp_path / "health")
+    load_balancer = make_shared_load_balancer(path)
+    process = multiprocessing.get_context("spawn").Process(
+        target=fail_endpoint, args=(path, "endpoint-1"))
+    process.start()
+    process.join(timeout=60)
+
+    assert process.exitcode == 0
+    assert [load_balancer.get_next_active_endpoint().name for _ in range(3)] == [
+        "endpoint-0"] * 3
+
+
+def test_half_open_circuits_are_shared(tmp_path):
+    path = str(tmp_path / "health")
+    workers = [make_load_balancer(failure_threshold=2, health_state=MmapHealthState(path),
+                                  circuit_breaker=CircuitBreaker(probe=lambda *args: None, success_threshold=2))
+               for _ in range(2)]
+    for worker in workers:
+        worker.circuit_breaker.stop()
+    fail_endpoint(path, "endpoint-0")
+
+    workers[0].circuit_breaker.probe_endpoint(workers[0].api_endpoints[0])
+    assert workers[1].api_endpoints[0].get_health().half_open_successes == 0
+    assert workers[1].get_health().half_open_endpoints == {
+        workers[1].api_endpoints[0]}
+
+    workers[1].record_success(workers[1].api_endpoints[0])
+    assert workers[0].api_endpoints[0].get_health().half_open_successes == 1
+    workers[0].record_success(workers[0].api_endpoints[0])
+    assert workers[1].api_endpoints[0].failure_count == 0
+    assert len(workers[1].get_health().active_endpoints) == 2
+    assert not workers[1].get_health().half_open_endpoints
+
+
+def write_slots(path, writes):
+    """Writes the same value to every field of endpoint-0's slot, a different value each time"""
+    state = MmapHealthState(path).endpoint_state("endpoint-0")
+    for i in range(1, writes + 1):
+        with state.lock:
+            values = state.read(locked=True)
+            values[2:] = [i] + [float(i)] * 9
+            state.write(values)
+
+
+def test_reads_never_mix_two_writes(tmp_path):
+    path = str(tmp_path / "health")
+    state = MmapHealthState(path).endpoint_state("endpoint-0")
+    process = multiprocessing.get_context("spawn").Process(
+        target=write_slots, args=(path, 50000))
+    process.start()
+    reads = 0
+    while process.is_alive():
+        values = state.read()
+        # Before the first write, the slot holds its initial values
+        if values[2] > 0:
+            assert values[3:] == [float(values[2])] * 9
+            reads += 1
+    process.join(timeout=60)
+
+    assert process.exitcode == 0
+    assert reads > 0
+    assert state.read()[2] == 50000
+
+
+def test_endpoints_are_updated_independently(tmp_path):
+    backend = MmapHealthState(str(tmp_path / "health"))
+    state_0, state_1 = backend.endpoint_state(
+        "endpoint-0"), backend.endpoint_state("endpoint-1")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with state_0.lock:
+            # Would wait for endpoint-0's lock if the slots shared one
+            executor.submit(state_1.mark_failed).result(timeout=5)
+    assert state_1.get_health().failure_count == 1
+    assert state_0.get_health().failure_count == 0
+
+
+def test_rate_limits_are_shared(tmp_path):
+    path = str(tmp_path / "health")
+    workers = [make_shared_load_balancer(path, requests_per_minute=50, tokens_per_minute=10 ** 6)
+               for _ in range(4)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        acquired = list(executor.map(
+            lambda i: workers[i % 4].api_endpoints[0].try_acquire(10), range(200)))
+    assert sum(acquired) == 50
+
+    workers[0].api_endpoints[1].throttle(60)
+    assert not workers[1].api_endpoints[1].has_capacity()
+    assert workers[2].api_endpoints[1].time_until_capacity() > 50
+
+
+def test_shared_state_needs_unique_names(tmp_path):
+    with pytest.raises(ValueError):
+        LoadBalancer([{"api_type": "open_ai", "base_url": "https://api.openai.com/v1", "api_key_env": "OPENAI_API_KEY"}] * 2,
+                     failure_threshold=5, cooldown_period=timedelta(minutes=10), health_state=MmapHealthState(str(tmp_path / "health")))
@@ -0,0 +1,116 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import patch
+from openai_load_balancer.api_endpoint import ApiEndpoint
+from openai_load_balancer.hedging import HedgingPolicy
+from openai_load_balancer.load_balancer import LoadBalancer
+from tests.endpoints import make_load_balancer
+
+
+@pytest.fixture
+def load_balancer():
+    load_balancer = make_load_balancer(
+        hedging_policy=HedgingPolicy(delay=0.05, max_hedge_ratio=1.0))
+    yield load_balancer
+    load_balancer.close()
+
+
+def slow_first_endpoint(load_balancer):
+    """Returns a fake send_request where the first endpoint takes 0.5 seconds to answer and the second answers immediately"""
+    def send_request(endpoint, method_name, **kwargs):
+        if endpoint is load_balancer.api_endpoints[0]:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+    return send_request
+
+
+def test_hedged_request_uses_backup_when_primary_is_slow(load_balancer):
+    with patch.object(LoadBalancer, 'send_request', side_effect=slow_first_endpoint(load_balancer)):
+        assert load_balancer.try_send_hedged_request(
+            'chat_completion_create', messages=[]) == "fast"
+
+    assert load_balancer.hedging_policy.stats() == {
+        "requests": 1, "hedges": 1, "hedge_wins": 1, "hedge_rate": 1.0, "hedge_win_rate": 1.0}
+
+
+def test_hedged_request_does_not_hedge_fast_primary(load_balancer):
+    with patch.object(LoadBalancer, 'send_request', return_value="fast") as mock_send_request:
+        assert load_balancer.try_send_hedged_request(
+            'chat_completion_create', messages=[]) == "fast"
+
+    assert mock_send_request.call_count == 1
+    assert load_balancer.hedging_policy.stats()["hedges"] == 0
+
+
+def test_hedge_ratio_bounds_backup_requests(load_balancer):
+    load_balancer.hedging_policy.max_hedge_ratio = 0
+    with patch.object(LoadBalancer, 'send_request', side_effect=slow_first_endpoint(load_balancer)):
+        assert load_balancer.try_send_hedged_request(
+            'chat_completion_create', messages=[]) == "slow"
+
+    assert load_balancer.hedging_policy.stats()["hedges"] == 0
+
+
+def test_hedged_request_fails_over_when_both_requests_fail(load_balancer):
+    with patch.object(LoadBalancer, 'send_request', side_effect=[Exception("Failed request"), "Success"]):
+        assert load_balancer.try_send_hedged_request(
+            'chat_completion_create', messages=[]) == "Success"
+
+
+def test_async_hedged_request_cancels_loser(load_balancer):
+    cancelled = []
+
+    async def asend_request(endpoint, method_name, **kwargs):
+        if endpoint is load_balancer.api_endpoints[0]:
+            try:
+                await asyncio.sleep(0.5)
+            except asyncio.CancelledError:
+                cancelled.append(endpoint)
+                raise
+            return "slow"
+        return "fast"
+
+    with patch.object(LoadBalancer, 'asend_request', side_effect=asend_request):
+        assert asyncio.run(load_balancer.atry_send_hedged_request(
+            'embedding_create', input="Hello")) == "fast"
+
+    primary_endpoint = load_balancer.api_endpoints[0]
+    assert cancelled == [primary_endpoint]
+    # The cancelled request isn't counted as a failure
+    assert primary_endpoint.failure_count == 0
+    assert primary_endpoint.in_flight == 0
+
+
+def test_hedge_delay_uses_live_percentile():
+    policy = HedgingPolicy(percentile=0.95, min_samples=20)
+    endpoint = ApiEndpoint(
+        api_type="open_ai", base_url="https://api.openai.com/v1", api_key_env="OPENAI_API_KEY")
+    assert policy.hedge_delay(endpoint) is None
+    for latency in range(1, 101):
+        endpoint.start_request()
+        endpoint.finish_request(latency / 100)
+    assert policy.hedge_delay(endpoint) == 0.95
+
+
+def test_hedged_request_waits_for_primary_when_no_other_endpoint_is_active(load_balancer):
+    for _ in range(load_balancer.failure_threshold):
+        load_balancer.record_failure(
+            load_balancer.api_endpoints[1], Exception("Failed request"))
+
+    def send_request(endpoint, method_name, **kwargs):
+        time.sleep(0.2)
+        return "slow"
+
+    async def asend_request(endpoint, method_name, **kwargs):
+        await asyncio.sleep(0.2)
+        return "slow"
+    with patch.object(LoadBalancer, 'send_request', side_effect=send_request), \
+            patch.object(LoadBalancer, 'asend_request', side_effect=asend_request):
+        assert load_balancer.try_send_hedged_request(
+            'chat_completion_create', messages=[]) == "slow"
+        assert asyncio.run(load_balancer.atry_send_hedged_request(
+            'chat_completion_create', messages=[])) == "slow"
+
+    assert load_balancer.hedging_policy.stats()["hedges"] == 0
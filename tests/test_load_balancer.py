@@ -1,8 +1,15 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+import openai
 import pytest
 from unittest.mock import patch, create_autospec, Mock
 from openai_load_balancer.load_balancer import LoadBalancer
 from openai_load_balancer.api_endpoint import ApiEndpoint
+from tests.fake_openai_server import FakeOpenAIServer
+from tests.endpoints import endpoint_configs, make_load_balancer
 
 
 @pytest.fixture
@@ -195,3 +202,240 @@ def test_all_endpoints_inactive(load_balancer):
     with pytest.raises(Exception) as excinfo:
         load_balancer.try_send_request('test_method', test_arg='value')
     assert str(excinfo.value) == "All endpoints are inactive."
+
+
+def test_async_requests_share_one_event_loop(monkeypatch):
+    """Test that many async requests are in flight at once across all endpoints without the balancer adding threads."""
+    monkeypatch.setenv("FAKE_OPENAI_API_KEY", "sk-test")
+
+    async def run():
+        servers = [await FakeOpenAIServer(delay=0.2).start() for _ in range(2)]
+        endpoint_configs = [{"api_type": "open_ai", "base_url": f"{server.url}/v1",
+                             "api_key_env": "FAKE_OPENAI_API_KEY"} for server in servers]
+        load_balancer = LoadBalancer(
+            endpoint_configs, failure_threshold=5, cooldown_period=timedelta(minutes=10))
+        thread_count = threading.active_count()
+        try:
+            responses = await asyncio.gather(*[
+                load_balancer.atry_send_request(
+                    'chat_completion_create', model="gpt-3.5-turbo", messages=[{"role": "user", "content": "Hello!"}])
+                for _ in range(100)])
+        finally:
+            await load_balancer.aclose()
+            for server in servers:
+                await server.stop()
+        assert len(responses) == 100
+        assert all(response.choices[0].message.content ==
+                   "Hello!" for response in responses)
+        # Every request was in flight at the same time, split evenly between the two endpoints
+        assert [server.max_in_flight for server in servers] == [50, 50]
+        assert max(server.max_thread_count for server in servers) == thread_count
+
+    asyncio.run(run())
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.asend_request')
+def test_async_handle_endpoint_failure(mock_asend_request, load_balancer):
+    mock_endpoint1 = create_autospec(ApiEndpoint, instance=True)
+    mock_endpoint2 = create_autospec(ApiEndpoint, instance=True)
+    mock_endpoint1.is_active.return_value = True
+    mock_endpoint2.is_active.return_value = True
+    load_balancer.api_endpoints = [mock_endpoint1, mock_endpoint2]
+
+    mock_asend_request.side_effect = [Exception("Failed request"), "Success"]
+
+    result = asyncio.run(load_balancer.atry_send_request(
+        'test_method', test_arg='value'))
+
+    assert mock_asend_request.call_count == 2
+    assert result == "Success"
+    assert mock_endpoint1.mark_failed.called
+    mock_endpoint2.reset.assert_called()
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.asend_request')
+def test_async_all_endpoints_failure(mock_asend_request, load_balancer):
+    mock_asend_request.side_effect = Exception("Failed request")
+
+    with pytest.raises(Exception) as excinfo:
+        asyncio.run(load_balancer.atry_send_request(
+            'test_method', test_arg='value'))
+
+    assert str(excinfo.value) == "All endpoints failed."
+
+
+@patch('openai.ChatCompletion.create', return_value="Success")
+def test_send_request_uses_per_request_credentials(mock_create, load_balancer, monkeypatch):
+    """Test that requests pass the endpoint's credentials instead of modifying the global openai configuration."""
+    monkeypatch.setattr(openai, "api_key", "global-key")
+    endpoint = load_balancer.api_endpoints[1]
+    endpoint.api_key = "sk-endpoint"
+
+    load_balancer.send_request(
+        endpoint, 'chat_completion_create', model="gpt-3.5-turbo", messages=[])
+
+    mock_create.assert_called_once_with(
+        model="gpt-3.5-turbo", messages=[], api_key="sk-endpoint", api_base="https://api.openai.com/v1", api_type="open_ai", api_version=None)
+    assert openai.api_key == "global-key"
+
+
+def test_concurrent_requests_keep_their_endpoint_credentials(load_balancer):
+    """Test that concurrent requests from many threads never mix up the credentials of different endpoints."""
+    for i, endpoint in enumerate(load_balancer.api_endpoints):
+        endpoint.api_key = f"key-{i}"
+        endpoint.api_base = f"https://endpoint-{i}"
+    mismatches = []
+
+    def fake_create(**kwargs):
+        time.sleep(0.001)
+        if kwargs["api_key"].split("-")[1] != kwargs["api_base"].split("-")[1]:
+            mismatches.append(kwargs)
+        return "Success"
+
+    with patch('openai.ChatCompletion.create', side_effect=fake_create):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(lambda _: load_balancer.try_send_request(
+                'chat_completion_create', model="gpt-3.5-turbo", messages=[]), range(200)))
+
+    assert results == ["Success"] * 200
+    assert mismatches == []
+
+
+def test_async_requests_reuse_pooled_connections(monkeypatch):
+    """Test that async requests to an endpoint reuse the keep-alive connections of the endpoint's session."""
+    monkeypatch.setenv("FAKE_OPENAI_API_KEY", "sk-test")
+
+    async def run():
+        server = await FakeOpenAIServer().start()
+        load_balancer = LoadBalancer([{"api_type": "open_ai", "base_url": f"{server.url}/v1", "api_key_env": "FAKE_OPENAI_API_KEY"}],
+                                     failure_threshold=5, cooldown_period=timedelta(minutes=10))
+        try:
+            for _ in range(10):
+                await load_balancer.atry_send_request('embedding_create', model="text-embedding-ada-002", input="Hello")
+        finally:
+            await load_balancer.aclose()
+            await server.stop()
+        assert server.request_count == 10
+        assert len({request["peer"] for request in server.requests}) == 1
+        assert {request["headers"]["Authorization"]
+                for request in server.requests} == {"Bearer sk-test"}
+
+    asyncio.run(run())
+
+
+def test_selection_takes_no_lock(load_balancer):
+    # Taking the lock would raise
+    load_balancer.lock = None
+    selected = [load_balancer.get_next_active_endpoint() for _ in range(4)]
+    assert selected == load_balancer.api_endpoints * 2
+
+
+def test_endpoint_in_cooldown_is_skipped_until_it_recovers(load_balancer):
+    first_endpoint, second_endpoint = load_balancer.api_endpoints
+    for _ in range(load_balancer.failure_threshold):
+        load_balancer.record_failure(first_endpoint, Exception("Failed request"))
+    assert load_balancer.health.active_endpoints == (second_endpoint,)
+    assert [load_balancer.get_next_active_endpoint()
+            for _ in range(3)] == [second_endpoint] * 3
+
+    first_endpoint.last_failed_time = time.monotonic(
+    ) - load_balancer.cooldown_period.total_seconds() - 1
+    assert {load_balancer.get_next_active_endpoint()
+            for _ in range(2)} == {first_endpoint, second_endpoint}
+    assert first_endpoint.failure_count == 0
+
+
+def test_concurrent_selection_is_balanced(load_balancer):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        selected = list(executor.map(
+            lambda _: load_balancer.get_next_active_endpoint(), range(1000)))
+    assert [selected.count(endpoint)
+            for endpoint in load_balancer.api_endpoints] == [500, 500]
+
+
+@pytest.fixture
+def model_load_balancer(monkeypatch):
+    monkeypatch.setenv("AZURE_API_BASE_URL_1", "https://resource-1.openai.azure.com")
+    monkeypatch.setenv("AZURE_API_BASE_URL_2", "https://resource-2.openai.azure.com")
+    endpoint_configs = [
+        {"api_type": "azure", "base_url": "AZURE_API_BASE_URL_1", "api_key_env": "AZURE_API_KEY_1",
+         "version": "2023-05-15", "models": ["gpt-3.5-turbo"]},
+        {"api_type": "azure", "base_url": "AZURE_API_BASE_URL_2", "api_key_env": "AZURE_API_KEY_2",
+         "version": "2023-05-15", "models": {"gpt-4": "gpt4-prod", "gpt-3.5-turbo": "chat-prod"}},
+        {"api_type": "open_ai", "base_url": "https://api.openai.com/v1",
+         "api_key_env": "OPENAI_API_KEY_1"},
+    ]
+    return LoadBalancer(endpoint_configs, failure_threshold=5, cooldown_period=timedelta(minutes=10),
+                        model_engine_mapping={"gpt-4": "gpt4", "gpt-3.5-turbo": "gpt-35-turbo"})
+
+
+def test_requests_are_only_routed_to_endpoints_serving_the_model(model_load_balancer):
+    azure_gpt35, azure_both, openai_endpoint = model_load_balancer.api_endpoints
+    assert {model_load_balancer.get_next_active_endpoint(model="gpt-4") for _ in range(6)} == {
+        azure_both, openai_endpoint}
+    assert {model_load_balancer.get_next_active_endpoint(model="gpt-3.5-turbo") for _ in range(6)} == {
+        azure_gpt35, azure_both, openai_endpoint}
+    # Models no endpoint declared go to the endpoints that serve every model
+    assert {model_load_balancer.get_next_active_endpoint(model="text-embedding-ada-002") for _ in range(3)} == {
+        openai_endpoint}
+    assert model_load_balancer.request_model({"engine": "gpt4"}) == "gpt-4"
+    assert model_load_balancer.request_model({"engine": "gpt4-prod"}) == "gpt-4"
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value="Success")
+def test_requests_with_an_engine_are_routed_by_model(mock_send_request, model_load_balancer):
+    for _ in range(4):
+        model_load_balancer.try_send_request(
+            'chat_completion_create', engine="gpt4", messages=[])
+    assert model_load_balancer.api_endpoints[0] not in {
+        call.args[0] for call in mock_send_request.call_args_list}
+
+
+def test_unknown_model_without_default_endpoints_raises(model_load_balancer):
+    model_load_balancer.api_endpoints = model_load_balancer.api_endpoints[:2]
+    with pytest.raises(Exception) as excinfo:
+        model_load_balancer.try_send_request(
+            'chat_completion_create', model="gpt-5", messages=[])
+    assert str(excinfo.value) == "No endpoint serves the model gpt-5."
+
+
+def test_prepare_request_uses_the_endpoints_deployment_names(model_load_balancer):
+    azure_gpt35, azure_both, openai_endpoint = model_load_balancer.api_endpoints
+    assert model_load_balancer.prepare_request(
+        azure_gpt35, model="gpt-3.5-turbo")["engine"] == "gpt-35-turbo"
+    assert model_load_balancer.prepare_request(
+        azure_both, model="gpt-3.5-turbo")["engine"] == "chat-prod"
+    assert model_load_balancer.prepare_request(
+        azure_both, engine="gpt-35-turbo")["engine"] == "chat-prod"
+    request = model_load_balancer.prepare_request(
+        openai_endpoint, engine="gpt4-prod")
+    assert request["model"] == "gpt-4" and "engine" not in request
+
+
+def test_higher_priority_endpoints_are_only_used_as_fallback():
+    load_balancer = make_load_balancer(endpoint_configs(per_endpoint=[{"priority": 1}, {"priority": 0}, {"priority": 0}]),
+                                       failure_threshold=1)
+    fallback_endpoint, first_endpoint, second_endpoint = load_balancer.api_endpoints
+    assert {load_balancer.get_next_active_endpoint() for _ in range(6)} == {
+        first_endpoint, second_endpoint}
+    assert load_balancer.get_next_active_endpoint(
+        exclude={first_endpoint, second_endpoint}) == fallback_endpoint
+
+    load_balancer.record_failure(first_endpoint, Exception("Failed request"))
+    load_balancer.record_failure(second_endpoint, Exception("Failed request"))
+    assert load_balancer.get_next_active_endpoint() == fallback_endpoint
+
+
+def test_load_balancing_disabled_gives_every_endpoint_its_own_tier():
+    load_balancer = make_load_balancer(endpoint_configs(per_endpoint=[{"priority": 1}, {"priority": 0}, {"priority": 0}]),
+                                       failure_threshold=1, load_balancing_enabled=False)
+    fallback_endpoint, first_endpoint, second_endpoint = load_balancer.api_endpoints
+    assert load_balancer.get_priority_tiers(load_balancer.get_health().active_endpoints) == (
+        (first_endpoint,), (second_endpoint,), (fallback_endpoint,))
+    assert {load_balancer.get_next_active_endpoint() for _ in range(6)} == {
+        first_endpoint}
+
+    load_balancer.record_failure(first_endpoint, Exception("Failed request"))
+    assert load_balancer.get_next_active_endpoint() == second_endpoint
+    load_balancer.record_failure(second_endpoint, Exception("Failed request"))
+    assert load_balancer.get_next_active_endpoint() == fallback_endpoint
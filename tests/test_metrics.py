@@ -0,0 +1,105 @@
+import time
+from datetime import timedelta
+import pytest
+from unittest.mock import patch
+from openai import error
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.metrics import MetricsRegistry, to_prometheus
+from openai_load_balancer.retry_policy import RetryPolicy
+from tests.endpoints import make_load_balancer
+
+
+@pytest.fixture
+def load_balancer():
+    return make_load_balancer(failure_threshold=1, retry_policy=RetryPolicy(min_backoff=0.01, max_backoff=0.01))
+
+
+def make_response():
+    return OpenAIObject.construct_from({"object": "chat.completion", "choices": [],
+                                        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}})
+
+
+def test_requests_latency_and_tokens_are_recorded(load_balancer):
+    with patch.object(LoadBalancer, 'send_request', side_effect=[make_response(), make_response()]):
+        for _ in range(2):
+            load_balancer.try_send_request(
+                'chat_completion_create', model="gpt-3.5-turbo", messages=[])
+
+    metrics = load_balancer.get_metrics()
+    for name in ("endpoint-0", "endpoint-1"):
+        endpoint_metrics = metrics["endpoints"][name]
+        assert endpoint_metrics["requests"] == {
+            "gpt-3.5-turbo": {"success": 1}}
+        assert endpoint_metrics["latency"]["gpt-3.5-turbo"]["count"] == 1
+        assert endpoint_metrics["latency"]["gpt-3.5-turbo"]["buckets"][0.1] == 1
+        assert endpoint_metrics["tokens"] == {
+            "gpt-3.5-turbo": {"prompt": 10, "completion": 5}}
+        assert endpoint_metrics["in_flight"] == 0
+
+
+def test_failovers_retries_and_errors_are_recorded(load_balancer):
+    rate_limit = error.RateLimitError("Too many requests", http_status=429)
+    unavailable = error.ServiceUnavailableError("Unavailable", http_status=503)
+    with patch.object(LoadBalancer, 'send_request', side_effect=[rate_limit, unavailable, make_response()]):
+        load_balancer.try_send_request(
+            'chat_completion_create', model="gpt-4", messages=[])
+
+    metrics = load_balancer.get_metrics()
+    assert metrics["failovers"] == 1
+    assert metrics["retries"] == 1
+    assert metrics["endpoints"]["endpoint-0"]["requests"]["gpt-4"] == {
+        "rate_limited": 1, "success": 1}
+    assert metrics["endpoints"]["endpoint-1"]["requests"]["gpt-4"] == {
+        "transient": 1}
+    assert metrics["endpoints"]["endpoint-1"]["in_cooldown"]
+
+
+def test_cooldown_time_is_recorded(load_balancer):
+    endpoint = load_balancer.api_endpoints[0]
+    endpoint.mark_failed()
+    endpoint.last_failed_time = time.monotonic() - 120
+    assert not endpoint.is_active(1, timedelta(minutes=10))
+    assert 119 < endpoint.total_cooldown_time() < 130
+    endpoint.reset()
+    assert load_balancer.get_metrics(
+    )["endpoints"]["endpoint-0"]["cooldown_seconds"] == pytest.approx(endpoint.cooldown_time)
+    assert not load_balancer.get_metrics()["endpoints"]["endpoint-0"]["in_cooldown"]
+
+
+def test_hooks_are_called_around_requests(load_balancer):
+    calls = []
+    load_balancer.metrics.add_before_request_hook(
+        lambda endpoint, method_name, kwargs: calls.append(("before", endpoint.name)))
+    load_balancer.metrics.add_after_request_hook(
+        lambda endpoint, method_name, kwargs, outcome, latency, response: calls.append(("after", endpoint.name, outcome)))
+    with patch.object(LoadBalancer, 'send_request', side_effect=[Exception("Failed request"), make_response()]):
+        load_balancer.try_send_request(
+            'chat_completion_create', model="gpt-4", messages=[])
+
+    assert calls == [("before", "endpoint-0"), ("after", "endpoint-0", "unknown"),
+                     ("before", "endpoint-1"), ("after", "endpoint-1", "success")]
+
+
+def test_prometheus_text_format(load_balancer):
+    load_balancer.api_endpoints[1].name = 'endpoint "1"'
+    with patch.object(LoadBalancer, 'send_request', return_value=make_response()):
+        load_balancer.try_send_request(
+            'chat_completion_create', model="gpt-4", messages=[])
+
+    text = load_balancer.get_prometheus_metrics()
+    assert '# TYPE openai_load_balancer_requests_total counter' in text
+    assert 'openai_load_balancer_requests_total{endpoint="endpoint-0",model="gpt-4",outcome="success"} 1' in text
+    assert 'openai_load_balancer_request_latency_seconds_bucket{endpoint="endpoint-0",model="gpt-4",le="+Inf"} 1' in text
+    assert 'openai_load_balancer_tokens_total{endpoint="endpoint-0",model="gpt-4",type="prompt"} 10' in text
+    assert 'openai_load_balancer_in_flight_requests{endpoint="endpoint \\"1\\""} 0' in text
+    assert 'openai_load_balancer_failovers_total 0' in text
+    assert text.endswith("\n")
+
+
+def test_endpoints_with_the_same_name_are_told_apart():
+    load_balancer = LoadBalancer([{"api_type": "open_ai", "base_url": "https://api.openai.com/v1",
+                                   "api_key_env": "OPENAI_API_KEY"}] * 2, failure_threshold=5, cooldown_period=timedelta(minutes=10))
+    assert list(load_balancer.get_metrics()["endpoints"]) == [
+        "open_ai:https://api.openai.com/v1#0", "open_ai:https://api.openai.com/v1#1"]
+    assert to_prometheus(MetricsRegistry().snapshot([])).count("# TYPE") == 8
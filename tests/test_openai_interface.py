@@ -1,11 +1,13 @@
 import pytest
-from unittest.mock import Mock
+import asyncio
+from unittest.mock import Mock, AsyncMock
 from openai_load_balancer.openai_interface import OpenAILoadBalancer
 
 
 @pytest.fixture
 def mock_load_balancer():
     mock = Mock()
+    mock.atry_send_request = AsyncMock()
     return mock
 
 
@@ -36,3 +38,54 @@ def test_embedding_create(openai_load_balancer, mock_load_balancer):
     openai_load_balancer.Embedding.create(**test_kwargs)
     mock_load_balancer.try_send_request.assert_called_once_with(
         'embedding_create', **test_kwargs)
+
+
+def test_chat_completion_acreate(openai_load_balancer, mock_load_balancer):
+    test_kwargs = {"messages": [
+        {"role": "user", "content": "Hello!"}
+    ], "model": "gpt-3.5-turbo"}
+    asyncio.run(openai_load_balancer.ChatCompletion.acreate(**test_kwargs))
+    mock_load_balancer.atry_send_request.assert_awaited_once_with(
+        'chat_completion_create', **test_kwargs)
+
+
+def test_completion_acreate(openai_load_balancer, mock_load_balancer):
+    test_kwargs = {"prompt": "Hello", "model": "text-davinci-003"}
+    asyncio.run(openai_load_balancer.Completion.acreate(**test_kwargs))
+    mock_load_balancer.atry_send_request.assert_awaited_once_with(
+        'completion_create', **test_kwargs)
+
+
+def test_embedding_acreate(openai_load_balancer, mock_load_balancer):
+    test_kwargs = {"input": "Hello", "model": "text-embedding-ada-002"}
+    asyncio.run(openai_load_balancer.Embedding.acreate(**test_kwargs))
+    mock_load_balancer.atry_send_request.assert_awaited_once_with(
+        'embedding_create', **test_kwargs)
+
+
+def test_chat_completion_create_hedged(openai_load_balancer, mock_load_balancer):
+    test_kwargs = {"messages": [
+        {"role": "user", "content": "Hello!"}
+    ], "model": "gpt-3.5-turbo"}
+    openai_load_balancer.ChatCompletion.create(hedge=True, **test_kwargs)
+    mock_load_balancer.try_send_hedged_request.assert_called_once_with(
+        'chat_completion_create', **test_kwargs)
+    mock_load_balancer.try_send_request.assert_not_called()
+
+
+def test_embedding_acreate_hedged(openai_load_balancer, mock_load_balancer):
+    mock_load_balancer.atry_send_hedged_request = AsyncMock()
+    test_kwargs = {"input": "Hello", "model": "text-embedding-ada-002"}
+    asyncio.run(openai_load_balancer.Embedding.acreate(hedge=True, **test_kwargs))
+    mock_load_balancer.atry_send_hedged_request.assert_awaited_once_with(
+        'embedding_create', **test_kwargs)
+
+
+def test_embedding_create_batched(mock_load_balancer):
+    mock_batcher = Mock()
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, embedding_batcher=mock_batcher)
+    test_kwargs = {"input": "Hello", "model": "text-embedding-ada-002"}
+    openai_load_balancer.Embedding.create(**test_kwargs)
+    mock_batcher.create.assert_called_once_with(**test_kwargs)
+    mock_load_balancer.try_send_request.assert_not_called()
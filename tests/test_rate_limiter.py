@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+from openai_load_balancer.api_endpoint import ApiEndpoint
+from openai_load_balancer.rate_limiter import TokenBucket, estimate_tokens
+from tests.endpoints import endpoint_configs, make_load_balancer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_limited_load_balancer(endpoint_limits, **kwargs):
+    return make_load_balancer(endpoint_configs(per_endpoint=endpoint_limits), **kwargs)
+
+
+def test_token_bucket_refills_over_time():
+    clock = FakeClock()
+    bucket = TokenBucket(60, clock=clock)
+    bucket.consume(60)
+    assert not bucket.has_capacity(1)
+    assert bucket.time_until_available(1) == pytest.approx(1.0)
+    clock.now = 1.0
+    assert bucket.has_capacity(1)
+    clock.now = 1000.0
+    bucket.refill()
+    assert bucket.tokens == 60
+
+
+def test_token_bucket_caps_oversized_requests():
+    bucket = TokenBucket(100, clock=FakeClock())
+    assert bucket.has_capacity(1000)
+
+
+def test_estimate_tokens():
+    assert estimate_tokens('embedding_create', {"input": "a" * 40}) == 11
+    assert estimate_tokens('embedding_create', {"input": [[1, 2, 3], "abcd"]}) == 5
+    assert estimate_tokens('chat_completion_create', {"messages": [
+                           {"role": "user", "content": "a" * 40}], "max_tokens": 100}) == 113
+    assert estimate_tokens('completion_create', {
+                           "prompt": "a" * 8, "n": 2}) == 3 + 32
+
+
+def test_api_endpoint_try_acquire():
+    endpoint = ApiEndpoint(api_type="open_ai", base_url="https://api.openai.com/v1",
+                           api_key_env="OPENAI_API_KEY", requests_per_minute=2, tokens_per_minute=100)
+    assert endpoint.try_acquire(60)
+    # Not enough tokens left, and nothing is taken from the request budget
+    assert not endpoint.try_acquire(60)
+    assert endpoint.try_acquire(40)
+    # Out of requests
+    assert not endpoint.try_acquire(0)
+    assert endpoint.time_until_capacity(0) > 0
+
+
+def test_selection_skips_endpoints_without_budget():
+    load_balancer = make_limited_load_balancer(
+        [{"requests_per_minute": 1}, {"requests_per_minute": 1000}])
+    endpoints = load_balancer.api_endpoints
+    assert load_balancer.get_next_active_endpoint() == endpoints[0]
+    for _ in range(5):
+        assert load_balancer.get_next_active_endpoint() == endpoints[1]
+
+
+def test_load_balancing_disabled_falls_back_when_out_of_budget():
+    load_balancer = make_limited_load_balancer(
+        [{"requests_per_minute": 1}, {}], load_balancing_enabled=False)
+    endpoints = load_balancer.api_endpoints
+    assert load_balancer.get_next_active_endpoint() == endpoints[0]
+    assert load_balancer.get_next_active_endpoint() == endpoints[1]
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.asend_request', return_value={"usage": {"total_tokens": 10}})
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value={"usage": {"total_tokens": 10}})
+def test_requests_wait_for_budget_when_all_endpoints_are_saturated(mock_send_request, mock_asend_request):
+    load_balancer = make_limited_load_balancer([{"requests_per_minute": 600}])
+    load_balancer.api_endpoints[0].request_bucket.tokens = 0.9
+
+    assert load_balancer.try_send_request(
+        'chat_completion_create', messages=[]) == {"usage": {"total_tokens": 10}}
+    load_balancer.api_endpoints[0].request_bucket.tokens = 0.9
+    assert asyncio.run(load_balancer.atry_send_request(
+        'chat_completion_create', messages=[])) == {"usage": {"total_tokens": 10}}
+
+
+def test_requests_fail_fast_when_rate_limit_queue_is_full():
+    load_balancer = make_limited_load_balancer(
+        [{"requests_per_minute": 1}], rate_limit_queue_size=0)
+    load_balancer.api_endpoints[0].try_acquire()
+
+    with pytest.raises(Exception) as excinfo:
+        load_balancer.try_send_request('chat_completion_create', messages=[])
+    assert str(excinfo.value) == "All endpoints are rate limited and the rate limit queue is full."
+
+
+def test_requests_time_out_waiting_for_budget():
+    load_balancer = make_limited_load_balancer(
+        [{"requests_per_minute": 1}], rate_limit_queue_timeout=0.05)
+    load_balancer.api_endpoints[0].try_acquire()
+
+    with pytest.raises(Exception) as excinfo:
+        load_balancer.try_send_request('chat_completion_create', messages=[])
+    assert str(excinfo.value) == "Timed out waiting for rate limit budget."
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value={"usage": {"total_tokens": 10}})
+def test_token_budget_is_corrected_with_actual_usage(mock_send_request):
+    load_balancer = make_limited_load_balancer([{"tokens_per_minute": 1000}])
+    load_balancer.try_send_request(
+        'chat_completion_create', messages=[], max_tokens=500)
+    assert load_balancer.api_endpoints[0].token_bucket.tokens == pytest.approx(
+        990, abs=1)
@@ -0,0 +1,110 @@
+import random
+import time
+import pytest
+from unittest.mock import patch
+from openai import error
+from openai_load_balancer.load_balancer import LoadBalancer
+from tests.endpoints import make_load_balancer
+from openai_load_balancer.retry_policy import RetryPolicy, RATE_LIMITED, TRANSIENT, UNKNOWN, DO_NOT_RETRY
+
+
+@pytest.fixture
+def load_balancer():
+    return make_load_balancer(retry_policy=RetryPolicy(min_backoff=0.01, max_backoff=0.05))
+
+
+@pytest.mark.parametrize("exception, action", [
+    (error.RateLimitError("Too many requests", http_status=429), RATE_LIMITED),
+    (error.ServiceUnavailableError("Unavailable", http_status=503), TRANSIENT),
+    (error.APIError("Internal error", http_status=500), TRANSIENT),
+    (error.Timeout("Timed out"), TRANSIENT),
+    (error.APIConnectionError("Connection reset"), TRANSIENT),
+    (error.InvalidRequestError("Bad request", None, http_status=400), DO_NOT_RETRY),
+    (error.InvalidRequestError("Deployment not found", None, http_status=404), UNKNOWN),
+    (error.AuthenticationError("Invalid key", http_status=401), DO_NOT_RETRY),
+    (Exception("Failed request"), UNKNOWN),
+])
+def test_classify(exception, action):
+    assert RetryPolicy().classify(exception) == action
+
+
+def test_retry_after():
+    policy = RetryPolicy()
+    assert policy.retry_after(error.RateLimitError(
+        "Too many requests", headers={"Retry-After": "7"})) == 7
+    assert policy.retry_after(error.RateLimitError(
+        "Too many requests", headers={"retry-after-ms": "1500"})) == 1.5
+    assert policy.retry_after(error.RateLimitError("Too many requests")) is None
+
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(min_backoff=1, max_backoff=60, rng=random.Random(0))
+    for retry_number in range(10):
+        assert 1 <= policy.backoff(retry_number) <= 60
+    assert policy.backoff(0, retry_after=30) == 30
+    assert policy.backoff(0, retry_after=120) == 60
+    assert policy.backoff(5, retry_after=30, remaining_time=2) == 2
+
+
+def test_invalid_request_is_not_retried(load_balancer):
+    invalid_request = error.InvalidRequestError(
+        "Bad request", None, http_status=400)
+    with patch.object(LoadBalancer, 'send_request', side_effect=invalid_request) as mock_send_request:
+        with pytest.raises(error.InvalidRequestError):
+            load_balancer.try_send_request(
+                'chat_completion_create', messages=[])
+
+    assert mock_send_request.call_count == 1
+    assert load_balancer.api_endpoints[0].failure_count == 0
+
+
+def test_rate_limited_endpoint_fails_over_immediately(load_balancer):
+    first_endpoint, second_endpoint = load_balancer.api_endpoints
+    rate_limit = error.RateLimitError(
+        "Too many requests", http_status=429, headers={"Retry-After": "30"})
+    with patch.object(LoadBalancer, 'send_request', side_effect=[rate_limit, "Success"]):
+        start_time = time.monotonic()
+        assert load_balancer.try_send_request(
+            'chat_completion_create', messages=[]) == "Success"
+
+    assert time.monotonic() - start_time < 0.5
+    # Rate limits don't count as failures, but the endpoint isn't used until its Retry-After has passed
+    assert first_endpoint.failure_count == 0
+    assert not first_endpoint.has_capacity()
+    assert load_balancer.get_next_active_endpoint() == second_endpoint
+
+
+def test_transient_errors_are_retried_after_every_endpoint_failed(load_balancer):
+    unavailable = error.ServiceUnavailableError("Unavailable", http_status=503)
+    with patch.object(LoadBalancer, 'send_request', side_effect=[unavailable, unavailable, "Success"]) as mock_send_request:
+        assert load_balancer.try_send_request(
+            'chat_completion_create', messages=[]) == "Success"
+    assert mock_send_request.call_count == 3
+
+
+def test_retries_stop_after_max_attempts(load_balancer):
+    unavailable = error.ServiceUnavailableError("Unavailable", http_status=503)
+    with patch.object(LoadBalancer, 'send_request', side_effect=unavailable) as mock_send_request:
+        with pytest.raises(Exception) as excinfo:
+            load_balancer.try_send_request(
+                'chat_completion_create', messages=[])
+    assert str(excinfo.value) == "All endpoints failed."
+    assert excinfo.value.__cause__ is unavailable
+    assert mock_send_request.call_count == 5
+
+
+def test_timeout_bounds_retries_and_backoff(load_balancer):
+    load_balancer.retry_policy = RetryPolicy(min_backoff=10, max_backoff=60)
+    unavailable = error.ServiceUnavailableError("Unavailable", http_status=503)
+
+    def send_request(endpoint, method_name, **kwargs):
+        assert 0 < kwargs["request_timeout"] <= 0.3
+        time.sleep(0.05)
+        raise unavailable
+
+    with patch.object(LoadBalancer, 'send_request', side_effect=send_request):
+        start_time = time.monotonic()
+        with pytest.raises(Exception):
+            load_balancer.try_send_request(
+                'chat_completion_create', messages=[], timeout=0.3)
+    assert time.monotonic() - start_time < 0.5
@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import patch
+from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.scheduler import RequestScheduler
+from tests.endpoints import endpoint_configs, make_load_balancer
+
+
+class ConcurrencyTracker:
+    """A fake send_request that takes a while and records how many requests were in flight at once, in total and per endpoint"""
+
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.max_in_flight = 0
+        self.max_endpoint_in_flight = 0
+
+    def __call__(self, endpoint, method_name, **kwargs):
+        with self.lock:
+            self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+            self.max_in_flight = max(
+                self.max_in_flight, sum(self.in_flight.values()))
+            self.max_endpoint_in_flight = max(
+                self.max_endpoint_in_flight, self.in_flight[endpoint])
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight[endpoint] -= 1
+        return "Success"
+
+
+@pytest.mark.parametrize("scheduler, max_in_flight, max_endpoint_in_flight", [
+    (RequestScheduler(max_concurrency=3), 3, 3),
+    (RequestScheduler(max_endpoint_concurrency=1), 2, 1),
+    (RequestScheduler(max_endpoint_concurrency={"endpoint-0": 2, "endpoint-1": 1}), 3, 2),
+])
+def test_concurrency_is_bounded(scheduler, max_in_flight, max_endpoint_in_flight):
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    tracker = ConcurrencyTracker()
+    with patch.object(LoadBalancer, 'send_request', side_effect=tracker):
+        threads = [threading.Thread(target=load_balancer.try_send_request, args=('chat_completion_create',))
+                   for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert tracker.max_in_flight == max_in_flight
+    assert tracker.max_endpoint_in_flight <= max_endpoint_in_flight
+    assert scheduler.stats()["in_flight"] == 0
+    assert scheduler.stats()["admitted"] == 16
+
+
+def wait_until_queued(scheduler, count):
+    while scheduler.stats()["queued"] < count:
+        time.sleep(0.001)
+
+
+def test_higher_priority_requests_are_served_first():
+    scheduler = RequestScheduler(max_concurrency=1)
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    endpoint = scheduler.acquire(load_balancer)
+    order = []
+
+    def request(name, priority):
+        acquired_endpoint = scheduler.acquire(
+            load_balancer, priority=priority)
+        order.append(name)
+        scheduler.release(acquired_endpoint)
+
+    threads = []
+    for i, (name, priority) in enumerate([("batch-1", "batch"), ("batch-2", "batch"), ("interactive", "interactive")]):
+        threads.append(threading.Thread(target=request, args=(name, priority)))
+        threads[-1].start()
+        wait_until_queued(scheduler, i + 1)
+    scheduler.release(endpoint)
+    for thread in threads:
+        thread.join()
+
+    assert order == ["interactive", "batch-1", "batch-2"]
+
+
+def test_full_queue_rejects_requests_right_away():
+    scheduler = RequestScheduler(max_concurrency=1, max_queue_size=1)
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    endpoint = scheduler.acquire(load_balancer)
+    errors = []
+
+    def request(priority):
+        try:
+            scheduler.release(scheduler.acquire(
+                load_balancer, priority=priority))
+        except Exception as e:
+            errors.append((priority, str(e)))
+
+    batch_thread = threading.Thread(target=request, args=("batch",))
+    batch_thread.start()
+    wait_until_queued(scheduler, 1)
+    start_time = time.monotonic()
+    request("batch")
+    assert time.monotonic() - start_time < 0.5
+    assert errors == [("batch", "The request queue is full.")]
+
+    # An interactive request takes the place of the waiting batch request
+    interactive_thread = threading.Thread(
+        target=request, args=("interactive",))
+    interactive_thread.start()
+    batch_thread.join()
+    scheduler.release(endpoint)
+    interactive_thread.join()
+    assert errors == [("batch", "The request queue is full.")] * 2
+    assert scheduler.stats()["rejected"] == 2
+
+    with pytest.raises(ValueError):
+        scheduler.acquire(load_balancer, priority="urgent")
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value="Success")
+def test_time_in_the_queue_counts_against_the_timeout(mock_send_request):
+    scheduler = RequestScheduler(
+        max_concurrency=1, max_queue_time={"batch": 0.05})
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    scheduler.acquire(load_balancer)
+
+    for kwargs in ({"timeout": 0.05}, {"priority": "batch"}):
+        start_time = time.monotonic()
+        with pytest.raises(Exception) as excinfo:
+            load_balancer.try_send_request('chat_completion_create', **kwargs)
+        assert str(excinfo.value) == "Timed out waiting in the request queue."
+        assert time.monotonic() - start_time < 1
+    mock_send_request.assert_not_called()
+    assert scheduler.stats()["timed_out"] == 2
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_async_requests_wait_for_a_slot():
+    scheduler = RequestScheduler(max_concurrency=1)
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    in_flight = []
+    max_in_flight = []
+
+    async def send(endpoint, method_name, **kwargs):
+        in_flight.append(endpoint)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(endpoint)
+        return "Success"
+
+    async def run():
+        return await asyncio.gather(*(load_balancer.atry_send_request('chat_completion_create', priority="batch") for _ in range(5)))
+
+    with patch.object(LoadBalancer, 'asend_request', side_effect=send):
+        assert asyncio.run(run()) == ["Success"] * 5
+    assert max(max_in_flight) == 1
+    assert scheduler.stats()["in_flight"] == 0
+    assert scheduler.stats()["waited"] == 4
+
+
+def test_queued_requests_do_not_hold_up_requests_to_free_endpoints():
+    scheduler = RequestScheduler(max_endpoint_concurrency=1)
+    load_balancer = make_load_balancer(endpoint_configs(
+        per_endpoint=[{"models": ["x"]}, {"models": ["y"]}]), scheduler=scheduler)
+    busy_endpoint = scheduler.acquire(load_balancer, model="x")
+    blocked = threading.Thread(target=lambda: scheduler.release(
+        scheduler.acquire(load_balancer, model="x")))
+    blocked.start()
+    wait_until_queued(scheduler, 1)
+
+    try:
+        start_time = time.monotonic()
+        endpoint = scheduler.acquire(load_balancer, model="y")
+        scheduler.release(endpoint)
+        async_endpoint = asyncio.run(
+            scheduler.aacquire(load_balancer, model="y"))
+        scheduler.release(async_endpoint)
+        assert time.monotonic() - start_time < 0.05
+        assert endpoint.name == async_endpoint.name == "endpoint-1"
+        assert scheduler.stats()["queued"] == 1
+        assert scheduler.stats()["waited"] == 1
+    finally:
+        scheduler.release(busy_endpoint)
+        blocked.join()
+    assert scheduler.stats()["in_flight"] == 0
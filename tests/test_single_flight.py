@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import pytest
+from unittest.mock import Mock
+from openai.openai_object import OpenAIObject
+from openai_load_balancer.single_flight import SingleFlight
+from openai_load_balancer.openai_interface import OpenAILoadBalancer
+
+TEST_KWARGS = {"messages": [{"role": "user", "content": "Hello!"}],
+               "model": "gpt-3.5-turbo", "temperature": 0}
+
+
+def make_response(content):
+    return OpenAIObject.construct_from({"object": "chat.completion", "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]})
+
+
+def test_concurrent_identical_requests_share_one_call():
+    release = threading.Event()
+    mock_load_balancer = Mock()
+
+    def try_send_request(method_name, **kwargs):
+        release.wait(5)
+        return make_response("Hello!")
+    mock_load_balancer.try_send_request.side_effect = try_send_request
+    single_flight = SingleFlight()
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, single_flight=single_flight)
+
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(
+        openai_load_balancer.ChatCompletion.create(**TEST_KWARGS))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while single_flight.stats()["saved_calls"] < 4:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert mock_load_balancer.try_send_request.call_count == 1
+    assert len(responses) == 5
+    assert all(response is responses[0] for response in responses)
+    assert single_flight.stats() == {
+        "upstream_calls": 1, "saved_calls": 4, "in_flight": 0}
+
+    # Once the call is done, the next request makes a new one
+    openai_load_balancer.ChatCompletion.create(**TEST_KWARGS)
+    assert mock_load_balancer.try_send_request.call_count == 2
+
+
+def test_waiting_requests_get_the_error():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def send():
+        started.set()
+        release.wait(5)
+        raise Exception("All endpoints failed.")
+
+    def request():
+        try:
+            single_flight.do('embedding_create', {"input": "Hello"}, send)
+        except Exception as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=request)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=request)
+    follower.start()
+    while single_flight.stats()["saved_calls"] < 1:
+        threading.Event().wait(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert [str(e) for e in errors] == ["All endpoints failed."] * 2
+    assert single_flight.stats()["in_flight"] == 0
+
+
+def test_only_shareable_requests_are_shared():
+    single_flight = SingleFlight()
+    kwargs = dict(TEST_KWARGS, temperature=1)
+    send = Mock(return_value=make_response("Hello!"))
+
+    single_flight.do('chat_completion_create', kwargs, send)
+
+    send.assert_called_once()
+    assert single_flight.stats()["upstream_calls"] == 0
+
+
+def test_requests_to_a_deployment_share_the_model_key():
+    single_flight = SingleFlight(engine_model_mapping={
+                                 "gpt-35-turbo": "gpt-3.5-turbo", "chat-deployment": "gpt-3.5-turbo"})
+    azure_kwargs = dict(TEST_KWARGS, engine="chat-deployment")
+    del azure_kwargs["model"]
+
+    assert single_flight.key('chat_completion_create', azure_kwargs) == single_flight.key(
+        'chat_completion_create', TEST_KWARGS)
+
+
+def test_async_requests_share_one_call():
+    calls = []
+
+    async def send():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return make_response("Hello!")
+    single_flight = SingleFlight()
+
+    async def run():
+        return await asyncio.gather(*(single_flight.ado('chat_completion_create', TEST_KWARGS, send) for _ in range(5)))
+    responses = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert all(response is responses[0] for response in responses)
+    assert single_flight.stats() == {
+        "upstream_calls": 1, "saved_calls": 4, "in_flight": 0}
+
+
+def test_cancelling_one_async_caller_does_not_cancel_the_call():
+    async def send():
+        await asyncio.sleep(0.05)
+        return make_response("Hello!")
+    single_flight = SingleFlight()
+
+    async def run():
+        first = asyncio.ensure_future(single_flight.ado(
+            'chat_completion_create', TEST_KWARGS, send))
+        second = asyncio.ensure_future(single_flight.ado(
+            'chat_completion_create', TEST_KWARGS, send))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return first, await second
+    first, response = asyncio.run(run())
+
+    assert response.choices[0].message.content == "Hello!"
+    assert first.cancelled()
+
+
+def test_waiting_requests_keep_their_own_deadline():
+    release = threading.Event()
+    mock_load_balancer = Mock()
+
+    def try_send_request(method_name, **kwargs):
+        release.wait(5)
+        return make_response("Hello!")
+    mock_load_balancer.try_send_request.side_effect = try_send_request
+    single_flight = SingleFlight()
+    openai_load_balancer = OpenAILoadBalancer(
+        mock_load_balancer, single_flight=single_flight)
+
+    leader = threading.Thread(
+        target=lambda: openai_load_balancer.ChatCompletion.create(**TEST_KWARGS))
+    leader.start()
+    while single_flight.stats()["in_flight"] < 1:
+        threading.Event().wait(0.01)
+    start_time = time.monotonic()
+    with pytest.raises(Exception, match="Request deadline exceeded."):
+        openai_load_balancer.ChatCompletion.create(timeout=0.1, **TEST_KWARGS)
+    assert time.monotonic() - start_time < 1
+    release.set()
+    leader.join()
+
+    assert mock_load_balancer.try_send_request.call_count == 1
+
+
+def test_async_waiting_requests_keep_their_own_deadline():
+    async def send():
+        await asyncio.sleep(0.3)
+        return make_response("Hello!")
+    single_flight = SingleFlight()
+
+    async def run():
+        leader = asyncio.ensure_future(single_flight.ado(
+            'chat_completion_create', TEST_KWARGS, send))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Exception, match="Request deadline exceeded."):
+            await single_flight.ado('chat_completion_create', TEST_KWARGS, send, timeout=0.05)
+        # The call goes on for the caller without a deadline
+        return await leader
+    response = asyncio.run(run())
+
+    assert response.choices[0].message.content == "Hello!"
+    assert single_flight.stats() == {
+        "upstream_calls": 1, "saved_calls": 1, "in_flight": 0}
@@ -0,0 +1,231 @@
+import heapq
+import random
+from datetime import timedelta
+import pytest
+from unittest.mock import patch
+from openai_load_balancer.api_endpoint import ApiEndpoint
+from openai_load_balancer.load_balancer import LoadBalancer
+from tests.endpoints import endpoint_configs, make_load_balancer
+from openai_load_balancer.strategies import RoundRobinStrategy, LeastOutstandingRequestsStrategy, EwmaLatencyStrategy, PowerOfTwoChoicesStrategy, SmoothWeightedRoundRobinStrategy, AdaptiveWeightPolicy, AffinityStrategy, smooth_weighted_schedule, get_strategy
+
+
+def make_endpoints(count):
+    return [ApiEndpoint(api_type="open_ai", base_url=f"https://endpoint-{i}", api_key_env="OPENAI_API_KEY") for i in range(count)]
+
+
+def always_eligible(endpoint):
+    return True
+
+
+def simulate(strategy, latencies, request_count=2000, interval=0.2, seed=0):
+    """Simulates requests arriving every interval seconds at endpoints with the passed in mean latencies, and returns the latency of every request."""
+    rng = random.Random(seed)
+    endpoints = make_endpoints(len(latencies))
+    completions = []
+    results = []
+    for i in range(request_count):
+        now = i * interval
+        # Finish the requests that completed before this one arrived, so the strategy sees up to date stats
+        while completions and completions[0][0] <= now:
+            _, _, endpoint, latency = heapq.heappop(completions)
+            endpoint.finish_request(latency)
+        endpoint = strategy.select(endpoints, always_eligible)
+        endpoint.start_request()
+        latency = latencies[endpoints.index(
+            endpoint)] * rng.uniform(0.8, 1.2)
+        heapq.heappush(completions, (now + latency, i, endpoint, latency))
+        results.append(latency)
+    return sorted(results)
+
+
+def percentile(sorted_latencies, q):
+    return sorted_latencies[int(q * (len(sorted_latencies) - 1))]
+
+
+def test_latency_aware_strategies_improve_latency_with_heterogeneous_endpoints():
+    latencies = [0.8, 6.0, 0.8]
+    round_robin = simulate(RoundRobinStrategy(), latencies)
+    ewma = simulate(EwmaLatencyStrategy(), latencies)
+    least_outstanding = simulate(LeastOutstandingRequestsStrategy(), latencies)
+    power_of_two = simulate(PowerOfTwoChoicesStrategy(
+        rng=random.Random(0)), latencies)
+
+    assert percentile(round_robin, 0.99) > 4.8
+    assert percentile(ewma, 0.99) < 1.0
+    for result in (least_outstanding, power_of_two):
+        assert sum(result) / len(result) < sum(round_robin) / \
+            len(round_robin) / 2
+
+
+def test_least_outstanding_picks_fewest_in_flight():
+    endpoints = make_endpoints(3)
+    endpoints[0].start_request()
+    endpoints[2].start_request()
+    assert LeastOutstandingRequestsStrategy().select(
+        endpoints, always_eligible) == endpoints[1]
+
+
+def test_ewma_prefers_faster_endpoint():
+    endpoints = make_endpoints(2)
+    for endpoint, latency in zip(endpoints, [2.0, 0.5]):
+        endpoint.start_request()
+        endpoint.finish_request(latency)
+    assert EwmaLatencyStrategy().select(
+        endpoints, always_eligible) == endpoints[1]
+
+
+@pytest.mark.parametrize("strategy", ["round_robin", "least_outstanding", "ewma", "power_of_two"])
+def test_strategies_skip_ineligible_endpoints(strategy):
+    endpoints = make_endpoints(3)
+    strategy = get_strategy(strategy)
+    for _ in range(10):
+        assert strategy.select(
+            endpoints, lambda endpoint: endpoint is endpoints[1]) == endpoints[1]
+    assert strategy.select(endpoints, lambda endpoint: False) is None
+
+
+def test_get_strategy_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        get_strategy("random")
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value="Success")
+def test_try_send_request_records_endpoint_stats(mock_send_request):
+    load_balancer = LoadBalancer([{"api_type": "open_ai", "base_url": "https://api.openai.com/v1", "api_key_env": "OPENAI_API_KEY"}],
+                                 failure_threshold=5, cooldown_period=timedelta(minutes=10), strategy="ewma")
+    load_balancer.try_send_request('test_method', test_arg='value')
+
+    endpoint = load_balancer.api_endpoints[0]
+    assert endpoint.in_flight == 0
+    assert endpoint.latency_ewma is not None
+
+
+def make_weighted_endpoints(weights, **kwargs):
+    return [ApiEndpoint(api_type="open_ai", base_url=f"https://endpoint-{i}", api_key_env="OPENAI_API_KEY", weight=weight, **kwargs)
+            for i, weight in enumerate(weights)]
+
+
+def test_weighted_round_robin_is_proportional_and_smooth():
+    endpoints = make_weighted_endpoints([240, 30])
+    strategy = SmoothWeightedRoundRobinStrategy()
+    selected = [strategy.select(endpoints, always_eligible)
+                for _ in range(9)]
+    assert selected.count(endpoints[0]) == 8
+    # The small endpoint's turn comes in the middle of the cycle instead of after a burst of the big one
+    assert selected[4] == endpoints[1]
+
+    endpoints = make_weighted_endpoints([5, 1, 1])
+    assert smooth_weighted_schedule(endpoints, 100) == (
+        endpoints[0], endpoints[0], endpoints[1], endpoints[0], endpoints[2], endpoints[0], endpoints[0])
+
+
+def test_zero_weight_endpoints_are_only_a_fallback():
+    endpoints = make_weighted_endpoints([1, 0])
+    strategy = SmoothWeightedRoundRobinStrategy()
+    assert {strategy.select(endpoints, always_eligible)
+            for _ in range(10)} == {endpoints[0]}
+    assert strategy.select(
+        endpoints, lambda endpoint: endpoint is endpoints[1]) == endpoints[1]
+
+
+def test_weights_can_change_at_runtime():
+    load_balancer = make_load_balancer(endpoint_configs(
+        per_endpoint=[{"weight": 3}, {"weight": 1}]))
+    assert isinstance(load_balancer.strategy,
+                      SmoothWeightedRoundRobinStrategy)
+    endpoints = load_balancer.api_endpoints
+    selected = [load_balancer.get_next_active_endpoint() for _ in range(400)]
+    assert selected.count(endpoints[0]) == 300
+
+    load_balancer.set_weight("endpoint-0", 1)
+    load_balancer.set_weight(endpoints[1], 4)
+    selected = [load_balancer.get_next_active_endpoint() for _ in range(500)]
+    assert selected.count(endpoints[1]) == 400
+    with pytest.raises(ValueError):
+        load_balancer.set_weight("endpoint-0", -1)
+    with pytest.raises(ValueError):
+        load_balancer.set_weight("endpoint-2", 1)
+
+
+def test_adaptive_weights_back_off_rate_limited_endpoints():
+    now = [0.0]
+    policy = AdaptiveWeightPolicy(
+        interval=10, decrease=0.5, increase=0.25, clock=lambda: now[0])
+    endpoints = make_weighted_endpoints([4, 4])
+    policy.record_rate_limit(endpoints[0])
+    assert not policy.update(endpoints)
+
+    now[0] = 10
+    assert policy.update(endpoints)
+    assert [endpoint.effective_weight for endpoint in endpoints] == [2, 4]
+    now[0] = 20
+    assert policy.update(endpoints)
+    assert [endpoint.effective_weight for endpoint in endpoints] == [3, 4]
+    now[0] = 30
+    policy.update(endpoints)
+    now[0] = 40
+    assert not policy.update(endpoints)
+    assert [endpoint.weight for endpoint in endpoints] == [4, 4]
+    assert [endpoint.effective_weight for endpoint in endpoints] == [4, 4]
+
+
+def test_affinity_sends_the_same_prefix_to_the_same_endpoint():
+    endpoints = make_endpoints(4)
+    strategy = AffinityStrategy()
+    keys = [strategy.request_affinity('chat_completion_create', {"model": "gpt-4", "messages": [
+        {"role": "system", "content": f"System prompt {i}"}, {"role": "user", "content": f"Question {j}"}]}) for i in range(200) for j in range(2)]
+
+    selected = [strategy.select(endpoints, always_eligible, key)
+                for key in keys]
+    # Both questions with the same system prompt go to the same endpoint, and the prompts are spread over every endpoint
+    assert selected[0::2] == selected[1::2]
+    assert all(selected.count(endpoint) > 40 for endpoint in endpoints)
+    assert strategy.request_affinity('chat_completion_create', {
+        "messages": []}, affinity_key="conversation-1") == strategy.request_affinity('completion_create', {}, affinity_key="conversation-1")
+    assert strategy.request_affinity('embedding_create', {"input": "Hello"}) is None
+
+
+def test_affinity_only_moves_the_keys_of_an_endpoint_that_leaves():
+    endpoints = make_endpoints(4)
+    strategy = AffinityStrategy()
+    keys = [strategy.request_affinity('chat_completion_create', {}, affinity_key=i)
+            for i in range(400)]
+    before = [strategy.select(endpoints, always_eligible, key)
+              for key in keys]
+
+    after = [strategy.select(endpoints[1:], always_eligible, key)
+             for key in keys]
+
+    assert all(old == new for old, new in zip(before, after)
+               if old is not endpoints[0])
+    # Ineligible endpoints fall back to the next endpoint on the ring, the same as if they had left
+    assert [strategy.select(endpoints, lambda endpoint: endpoint is not endpoints[0], key)
+            for key in keys] == after
+
+
+def test_affinity_spills_over_from_overloaded_endpoints():
+    endpoints = make_endpoints(3)
+    strategy = AffinityStrategy(load_factor=2.0)
+    key = strategy.request_affinity(
+        'chat_completion_create', {}, affinity_key="hot")
+    home = strategy.select(endpoints, always_eligible, key)
+
+    # 5 requests in flight is more than twice the share of 6 requests over 3 endpoints
+    home.in_flight = 5
+    assert strategy.select(endpoints, always_eligible, key) is not home
+    # If every endpoint is over its share, the key stays at home
+    for endpoint in endpoints:
+        endpoint.in_flight = 10
+    assert strategy.select(endpoints, always_eligible, key) is home
+
+
+@patch('openai_load_balancer.load_balancer.LoadBalancer.send_request', return_value="Success")
+def test_affinity_key_routes_requests_through_the_load_balancer(mock_send_request):
+    load_balancer = make_load_balancer(
+        endpoint_configs(3), strategy="affinity")
+    for _ in range(5):
+        load_balancer.try_send_request(
+            'chat_completion_create', affinity_key="conversation-1", messages=[])
+
+    assert len({call.args[0] for call in mock_send_request.call_args_list}) == 1
+    assert all("affinity_key" not in call.kwargs for call in mock_send_request.call_args_list)
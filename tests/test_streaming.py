@@ -0,0 +1,140 @@
+import asyncio
+import gc
+import threading
+import pytest
+from unittest.mock import patch
+from openai_load_balancer.load_balancer import LoadBalancer
+from openai_load_balancer.scheduler import RequestScheduler
+from tests.endpoints import make_load_balancer
+
+
+@pytest.fixture
+def load_balancer():
+    return make_load_balancer()
+
+
+def chunks(count, error_after=None):
+    for i in range(count):
+        if i == error_after:
+            raise ConnectionError("Connection reset")
+        yield {"choices": [{"delta": {"content": str(i)}}]}
+
+
+async def achunks(count, error_after=None):
+    for chunk in chunks(count, error_after):
+        yield chunk
+
+
+def test_stream_fails_over_before_first_chunk(load_balancer):
+    first_endpoint, second_endpoint = load_balancer.api_endpoints
+    with patch.object(LoadBalancer, 'send_request', side_effect=[chunks(3, error_after=0), chunks(3)]):
+        response = load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)
+        assert len(list(response)) == 3
+
+    assert first_endpoint.failure_count == 1
+    assert second_endpoint.failure_count == 0
+    assert second_endpoint.in_flight == 0
+    assert second_endpoint.time_to_first_token_ewma is not None
+    assert second_endpoint.tokens_per_second_ewma is not None
+    assert second_endpoint.latency_ewma == second_endpoint.time_to_first_token_ewma
+
+
+def test_mid_stream_error_is_attributed_to_endpoint(load_balancer):
+    first_endpoint = load_balancer.api_endpoints[0]
+    with patch.object(LoadBalancer, 'send_request', return_value=chunks(3, error_after=2)) as mock_send_request:
+        response = load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)
+        with pytest.raises(ConnectionError):
+            list(response)
+
+    assert mock_send_request.call_count == 1
+    assert first_endpoint.failure_count == 1
+    assert first_endpoint.in_flight == 0
+
+
+def test_stream_failure_is_not_reset_before_stream_ends(load_balancer):
+    first_endpoint = load_balancer.api_endpoints[0]
+    first_endpoint.failure_count = 2
+    with patch.object(LoadBalancer, 'send_request', return_value=chunks(3)):
+        response = load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)
+        assert first_endpoint.failure_count == 2
+        list(response)
+    assert first_endpoint.failure_count == 0
+
+
+def test_abandoned_stream_is_not_a_failure(load_balancer):
+    first_endpoint, second_endpoint = load_balancer.api_endpoints
+    with patch.object(LoadBalancer, 'send_request', side_effect=[chunks(3), chunks(3)]):
+        closed_response = load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)
+        next(closed_response)
+        closed_response.close()
+        dropped_response = load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)
+        del dropped_response
+        gc.collect()
+        # The dropped stream is finished before the next request, or metrics snapshot
+        assert sum(endpoint.in_flight for endpoint in load_balancer.api_endpoints) == 1
+        load_balancer.get_metrics()
+
+    for endpoint in (first_endpoint, second_endpoint):
+        assert endpoint.in_flight == 0
+        assert endpoint.failure_count == 0
+
+
+def test_async_stream_fails_over_before_first_chunk(load_balancer):
+    first_endpoint, second_endpoint = load_balancer.api_endpoints
+
+    async def run():
+        response = await load_balancer.atry_send_request('chat_completion_create', messages=[], stream=True)
+        return [chunk async for chunk in response]
+
+    with patch.object(LoadBalancer, 'asend_request', side_effect=[achunks(3, error_after=0), achunks(3)]):
+        assert len(asyncio.run(run())) == 3
+
+    assert first_endpoint.failure_count == 1
+    assert second_endpoint.in_flight == 0
+    assert second_endpoint.time_to_first_token_ewma is not None
+
+
+def test_dropping_a_stream_while_holding_the_scheduler_lock_does_not_deadlock():
+    scheduler = RequestScheduler(max_concurrency=1)
+    load_balancer = make_load_balancer(scheduler=scheduler)
+    with patch.object(LoadBalancer, 'send_request', side_effect=[chunks(3), chunks(3)]):
+        responses = [load_balancer.try_send_request(
+            'chat_completion_create', messages=[], stream=True)]
+
+        def drop_response():
+            with scheduler.lock:
+                responses.clear()
+                gc.collect()
+
+        # A daemon thread, so that a deadlock fails the test instead of hanging it
+        thread = threading.Thread(target=drop_response, daemon=True)
+        thread.start()
+        thread.join(timeout=1)
+        assert not thread.is_alive()
+        assert scheduler.stats()["in_flight"] == 1
+
+        # The next request finishes the dropped stream, which gives back its slot
+        with load_balancer.try_send_request('chat_completion_create', messages=[], stream=True) as response:
+            next(response)
+    assert scheduler.stats()["in_flight"] == 0
+    assert all(endpoint.in_flight == 0 for endpoint in load_balancer.api_endpoints)
+
+
+def test_async_stream_context_manager_closes_the_stream(load_balancer):
+    stream = achunks(3)
+
+    async def run():
+        async with await load_balancer.atry_send_request('chat_completion_create', messages=[], stream=True) as response:
+            return await response.__anext__()
+
+    with patch.object(LoadBalancer, 'asend_request', return_value=stream):
+        assert asyncio.run(run())["choices"][0]["delta"]["content"] == "0"
+
+    assert stream.ag_running is False and stream.ag_frame is None
+    assert all(endpoint.in_flight == 0 for endpoint in load_balancer.api_endpoints)
+    assert all(endpoint.failure_count == 0 for endpoint in load_balancer.api_endpoints)